@@ -1,4 +1,4 @@
-import bcrypt
+import os
 import jwt
 from fastapi import Depends, HTTPException, status, Request, Cookie
 from fastapi.security import OAuth2PasswordBearer, HTTPBearer, OAuth2
@@ -7,14 +7,21 @@ from fastapi.security.utils import get_authorization_scheme_param
 from starlette.requests import Request
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Union
-import aiosqlite
-from database import DATABASE_PATH
+from repositories import repository
+from user_cache import user_cache
+from passwords import hash_password, check_password, needs_rehash, record_rehash
 
 # JWT Configuration
 SECRET_KEY = "your_super_secret_key_for_jwt_token_generation"  # In production, store securely
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 1 week
 
+# Users allowed to read the internal stats under /api, comma separated;
+# nobody when unset
+ADMIN_USERNAMES = frozenset(
+    name.strip() for name in os.environ.get("ADMIN_USERNAMES", "").split(",") if name.strip()
+)
+
 # Custom OAuth2 scheme that checks both cookies and headers
 class OAuth2PasswordBearerWithCookie(OAuth2):
     def __init__(
@@ -54,27 +61,33 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
 oauth2_scheme = OAuth2PasswordBearerWithCookie(tokenUrl="users/token", auto_error=True)
 oauth2_scheme_optional = OAuth2PasswordBearerWithCookie(tokenUrl="users/token", auto_error=False)
 
-def verify_password(plain_password, hashed_password):
-    """Verify a password against its hash."""
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def verify_password(plain_password, hashed_password):
+    """Verify a password against its hash; 503 when too many are queued."""
+    return await check_password(plain_password, hashed_password)
 
-def get_password_hash(password):
-    """Generate a bcrypt hash for the password."""
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+async def get_password_hash(password):
+    """Generate a bcrypt hash for the password; 503 when too many are queued."""
+    return await hash_password(password)
 
 async def authenticate_user(username: str, password: str):
     """Authenticate a user by username and password."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = await cursor.fetchone()
+    user = await repository.users.get_by_username(username)
     
     if not user:
         return False
-    if not verify_password(password, user['password']):
+    if not await verify_password(password, user['password']):
         return False
-    return dict(user)
+    
+    # Move the stored hash to the configured cost while we have the password
+    if needs_rehash(user['password']):
+        try:
+            new_hash = await get_password_hash(password)
+        except HTTPException:
+            return user  # Busy; try again on a later login
+        user = await repository.users.update(user['id'], {"password": new_hash})
+        user_cache.invalidate(user['id'])
+        record_rehash()
+    return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create a JWT access token."""
@@ -87,6 +100,70 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def decode_token(token: str) -> Optional[dict]:
+    """The claims of a valid token, None if it is expired, forged or has no subject."""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    if payload.get("sub") is None:
+        return None
+    return payload
+
+# Marks a user row that has not been looked up yet
+_UNLOADED = object()
+
+class AuthContext:
+    """
+    Who is making a request, resolved once and kept on request.state.
+
+    The token is decoded up front; the user row is only read when
+    something needs more than the claims, and then shared by every later
+    caller in the same request.
+    """
+
+    def __init__(self, token: Optional[str], claims: Optional[dict]):
+        self.token = token
+        self.claims = claims
+        self._user = _UNLOADED
+
+    @property
+    def authenticated(self) -> bool:
+        """Whether the request carries a valid token; no database access."""
+        return self.claims is not None
+
+    @property
+    def username(self) -> Optional[str]:
+        return self.claims["sub"] if self.claims else None
+
+    @property
+    def user_id(self) -> Optional[int]:
+        """From the uid claim; None for tokens issued before it existed."""
+        return self.claims.get("uid") if self.claims else None
+
+    async def user(self) -> Optional[dict]:
+        """The user row, None if the token is invalid or the user is gone."""
+        if self._user is _UNLOADED:
+            self._user = None
+            if self.claims:
+                # Usually served from user_cache without a database read
+                if self.user_id is not None:
+                    user = await user_cache.get(self.user_id)
+                else:
+                    user = await user_cache.get_by_username(self.username)
+                if user and user["username"] == self.username:
+                    self._user = user
+        return self._user
+
+async def get_auth(request: Request) -> AuthContext:
+    """The request's AuthContext, created on first use."""
+    auth = getattr(request.state, "auth", None)
+    if auth is None:
+        token = await get_token_from_request(request)
+        auth = AuthContext(token, decode_token(token) if token else None)
+        request.state.auth = auth
+    return auth
+
 async def get_token_from_request(request: Request) -> Optional[str]:
     """Get token from cookies or authorization header."""
     # Check cookies first
@@ -102,70 +179,40 @@ async def get_token_from_request(request: Request) -> Optional[str]:
     
     return token
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
     """Get the current user from the JWT token."""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except jwt.PyJWTError:
-        raise credentials_exception
-    
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = await cursor.fetchone()
+    # oauth2_scheme has already answered 401 when there is no token at all
+    user = await (await get_auth(request)).user()
     
     if user is None:
-        raise credentials_exception
-    return dict(user)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
 
-async def get_current_user_optional(token: Optional[str] = Depends(oauth2_scheme_optional)):
+async def get_current_user_optional(request: Request):
     """
     Similar to get_current_user, but returns None if no valid token is provided,
     instead of raising an exception.
     """
-    if not token:
-        return None
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-    except jwt.PyJWTError:
-        return None
-    
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = await cursor.fetchone()
-    
-    if user is None:
-        return None
-    
-    return dict(user)
+    return await (await get_auth(request)).user()
+
+async def get_current_admin(current_user: dict = Depends(get_current_user)):
+    """The current user, if listed in ADMIN_USERNAMES."""
+    if current_user["username"] not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not allowed"
+        )
+    return current_user
 
 async def verify_token(token: str) -> bool:
     """Verify if a token is valid without returning user details."""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return False
-        
-        # Check if user exists
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-            user_exists = await cursor.fetchone() is not None
-        
-        return user_exists
-    except jwt.PyJWTError:
-        return False
\ No newline at end of file
+    claims = decode_token(token)
+    if claims is None:
+        return False
+    
+    # Check if user exists
+    return await AuthContext(token, claims).user() is not None
\ No newline at end of file
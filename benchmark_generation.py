@@ -0,0 +1,52 @@
+"""
+Tail latency of image generation against the local stub provider.
+
+Runs the same requests through ResilientBackend with and without hedging,
+with stub latencies drawn from a distribution (see parse_latency), so p99
+behaviour can be compared offline.
+
+    python benchmark_generation.py [requests] [latency] [hedge after]
+    python benchmark_generation.py 500 tail:0.05:0.05:1 0.1
+"""
+import asyncio
+import sys
+import time
+
+from generation_backends import ResilientBackend, StubBackend, CircuitBreaker
+
+def percentile(values: list, share: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+async def measure(backend: ResilientBackend, requests: int, concurrency: int = 50) -> list:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await backend.generate(f"benchmark {i}")
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies
+
+async def run(requests: int, latency: str, hedge_after: float):
+    print(f"{requests} requests, stub latency {latency}")
+    for name, hedge in (("no hedging", 0), (f"hedge after {hedge_after:g}s", hedge_after)):
+        stub = StubBackend(latency=latency, size=8)
+        backend = ResilientBackend(stub, timeout=30, hedge_after=hedge, breaker=CircuitBreaker(failures=10 ** 6))
+        latencies = await measure(backend, requests)
+        print(
+            f"{name:20} p50 {percentile(latencies, 0.5) * 1000:7.1f} ms"
+            f"  p95 {percentile(latencies, 0.95) * 1000:7.1f} ms"
+            f"  p99 {percentile(latencies, 0.99) * 1000:7.1f} ms"
+            f"  provider calls {stub.calls}"
+        )
+
+if __name__ == "__main__":
+    asyncio.run(run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        sys.argv[2] if len(sys.argv) > 2 else "tail:0.05:0.05:1",
+        float(sys.argv[3]) if len(sys.argv) > 3 else 0.1,
+    ))
@@ -0,0 +1,112 @@
+"""
+Compare the ASGI AuthMiddleware with the BaseHTTPMiddleware version it replaced.
+
+Both wrap the same small app and are called directly through ASGI, so
+the numbers are the middleware's own cost without a server or network.
+
+    python benchmark_middleware.py [requests per case]
+"""
+import asyncio
+import sys
+import time
+from datetime import timedelta
+
+import jwt
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
+
+from auth import create_access_token, get_token_from_request, SECRET_KEY, ALGORITHM
+from middleware import AuthMiddleware
+
+async def legacy_auth_middleware(request: Request, call_next):
+    """The decorator-based middleware from main.py, kept as the baseline."""
+    public_paths = [
+        "/login", "/register", "/static", "/images", "/users/token", "/users/register",
+        "/api/health", "/api/auth/status", "/explore", "/",
+    ]
+    is_public = False
+    for path in public_paths:
+        if request.url.path == path or request.url.path.startswith(path + "/"):
+            is_public = True
+            break
+    api_paths = ["/users/", "/posts/"]
+    is_api = False
+    for path in api_paths:
+        if request.url.path.startswith(path):
+            is_api = True
+            break
+    if is_public:
+        return await call_next(request)
+
+    token = await get_token_from_request(request)
+    if not token:
+        if is_api:
+            return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content={"detail": "Not authenticated"})
+        return RedirectResponse(url=f"/login?next={request.url.path}", status_code=status.HTTP_302_FOUND)
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if not payload.get("sub"):
+            raise jwt.PyJWTError("Invalid token")
+    except jwt.PyJWTError:
+        if is_api:
+            return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content={"detail": "Invalid token"})
+        return RedirectResponse(url=f"/login?next={request.url.path}", status_code=status.HTTP_302_FOUND)
+    return await call_next(request)
+
+def build_app(legacy: bool) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/static/{name}")
+    async def static_file(name: str):
+        return PlainTextResponse("x" * 1024)
+
+    @app.get("/posts/{post_id}")
+    async def post(post_id: int):
+        return {"id": post_id}
+
+    if legacy:
+        app.middleware("http")(legacy_auth_middleware)
+    else:
+        app.add_middleware(AuthMiddleware)
+    return app
+
+async def call(app, path: str, headers: list):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": headers, "client": ("127.0.0.1", 1), "server": ("test", 80),
+    }
+    status_code = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+
+    await app(scope, receive, send)
+    return status_code
+
+async def run(requests: int):
+    token = create_access_token({"sub": "bench", "uid": 1}, timedelta(minutes=5))
+    cases = {
+        "static file": ("/static/app.js", []),
+        "api, valid token": ("/posts/1", [(b"authorization", f"Bearer {token}".encode())]),
+        "api, no token": ("/posts/1", []),
+    }
+    apps = {"BaseHTTPMiddleware": build_app(legacy=True), "ASGI AuthMiddleware": build_app(legacy=False)}
+
+    print(f"{requests} requests per case")
+    for case, (path, headers) in cases.items():
+        for name, app in apps.items():
+            status_code = await call(app, path, headers)
+            started = time.perf_counter()
+            for _ in range(requests):
+                await call(app, path, headers)
+            elapsed = time.perf_counter() - started
+            print(f"{case:18} {name:20} {status_code}  {elapsed / requests * 1e6:8.1f} us/request")
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
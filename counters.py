@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+
+import aiosqlite
+
+from database import db_pool, write_queue, initialize_database
+
+# Rows re-counted per write; keeps each chunk short so other writes interleave
+RECONCILE_CHUNK_SIZE = 500
+
+# How often the app re-counts everything, 0 disables the periodic job
+RECONCILE_INTERVAL = float(os.environ.get("COUNTER_RECONCILE_INTERVAL", "86400"))  # seconds
+
+# Outcome of the last reconciliation, exposed through /api/metrics
+reconcile_stats = {"runs": 0, "posts_repaired": 0, "users_repaired": 0}
+
+async def _repair_posts(db: aiosqlite.Connection, first_id: int, last_id: int) -> int:
+    cursor = await db.execute("""
+        UPDATE posts SET like_count = (SELECT COUNT(*) FROM likes WHERE post_id = posts.id)
+        WHERE id BETWEEN ? AND ?
+          AND like_count != (SELECT COUNT(*) FROM likes WHERE post_id = posts.id)
+    """, (first_id, last_id))
+    return cursor.rowcount
+
+async def _repair_users(db: aiosqlite.Connection, first_id: int, last_id: int) -> int:
+    cursor = await db.execute("""
+        UPDATE users SET
+            follower_count = (SELECT COUNT(*) FROM followers WHERE followed_id = users.id),
+            following_count = (SELECT COUNT(*) FROM followers WHERE follower_id = users.id),
+            post_count = (SELECT COUNT(*) FROM posts WHERE user_id = users.id)
+        WHERE id BETWEEN ? AND ?
+          AND (follower_count != (SELECT COUNT(*) FROM followers WHERE followed_id = users.id)
+            OR following_count != (SELECT COUNT(*) FROM followers WHERE follower_id = users.id)
+            OR post_count != (SELECT COUNT(*) FROM posts WHERE user_id = users.id))
+    """, (first_id, last_id))
+    return cursor.rowcount
+
+async def _reconcile_table(table: str, repair) -> int:
+    async with db_pool.read() as db:
+        cursor = await db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        max_id = (await cursor.fetchone())[0]
+
+    repaired = 0
+    for first_id in range(1, max_id + 1, RECONCILE_CHUNK_SIZE):
+        repaired += await write_queue.submit(repair, first_id, first_id + RECONCILE_CHUNK_SIZE - 1)
+    return repaired
+
+async def reconcile_counters() -> dict:
+    """
+    Recount likes, followers, following and posts and fix any drift.
+
+    The triggers keep the counters exact, so this only finds something
+    after the tables were edited by hand or restored from a partial copy.
+    """
+    posts_repaired = await _reconcile_table("posts", _repair_posts)
+    users_repaired = await _reconcile_table("users", _repair_users)
+
+    reconcile_stats["runs"] += 1
+    reconcile_stats["posts_repaired"] = posts_repaired
+    reconcile_stats["users_repaired"] = users_repaired
+    if posts_repaired or users_repaired:
+        print(f"Repaired counters on {posts_repaired} posts and {users_repaired} users")
+    return dict(reconcile_stats)
+
+async def reconcile_periodically(interval: float = RECONCILE_INTERVAL):
+    """Run reconcile_counters() every interval seconds."""
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_counters()
+        except Exception as e:
+            print(f"Counter reconciliation failed: {str(e)}")
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["reconcile"]:
+        print("Usage: python counters.py reconcile")
+        sys.exit(1)
+    initialize_database()
+
+    async def main():
+        try:
+            print(await reconcile_counters())
+        finally:
+            await write_queue.stop()
+            await db_pool.close()
+
+    asyncio.run(main())
@@ -2,137 +2,348 @@ import aiosqlite
 import sqlite3
 import os
 import asyncio
-from pathlib import Path
+import time
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
 
 DATABASE_PATH = "imageshare.db"
 
-async def get_db():
-    """Create and return an async database connection."""
-    db = await aiosqlite.connect(DATABASE_PATH)
-    db.row_factory = aiosqlite.Row
-    return db
-
-async def init_db():
-    """Initialize the database with required tables if they don't exist."""
-    # First, ensure the tables exist by using regular sqlite3 (for simplicity in creating the tables)
-    if not Path(DATABASE_PATH).exists():
-        # Create the tables synchronously if the database doesn't exist yet
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            bio TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Create posts table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            prompt TEXT NOT NULL,
-            image_data TEXT NOT NULL,
-            caption TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-        ''')
-        
-        # Create followers table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS followers (
-            follower_id INTEGER NOT NULL,
-            followed_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (follower_id, followed_id),
-            FOREIGN KEY (follower_id) REFERENCES users (id),
-            FOREIGN KEY (followed_id) REFERENCES users (id)
-        )
-        ''')
-        
-        # Create likes table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            user_id INTEGER NOT NULL,
-            post_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, post_id),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (post_id) REFERENCES posts (id)
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        print("Database tables created successfully")
-    else:
-        print("Database already exists, skipping table creation")
+# Connection pool sizing
+READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "4"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a connection
+
+# SQLite tuning. NORMAL is durable against app crashes in WAL mode; only an
+# OS crash or power loss can drop the last few commits.
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Applied once to every pooled connection when it is opened
+CONNECTION_PRAGMAS = (
+    f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}",
+    f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}",
+    f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Group commit: the writer task folds up to this many queued writes into
+# one transaction, optionally lingering a little to let a batch fill up
+WRITE_BATCH_MAX = int(os.environ.get("DB_WRITE_BATCH_MAX", "64"))
+WRITE_BATCH_WINDOW = float(os.environ.get("DB_WRITE_BATCH_WINDOW_MS", "0")) / 1000
 
 def initialize_database():
-    """Initialize the database synchronously."""
-    # Create database tables synchronously if they don't exist
-    if not Path(DATABASE_PATH).exists():
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            bio TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Create posts table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            prompt TEXT NOT NULL,
-            image_data TEXT NOT NULL,
-            caption TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-        ''')
-        
-        # Create followers table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS followers (
-            follower_id INTEGER NOT NULL,
-            followed_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (follower_id, followed_id),
-            FOREIGN KEY (follower_id) REFERENCES users (id),
-            FOREIGN KEY (followed_id) REFERENCES users (id)
-        )
-        ''')
-        
-        # Create likes table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            user_id INTEGER NOT NULL,
-            post_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, post_id),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (post_id) REFERENCES posts (id)
+    """Create or upgrade the database schema."""
+    # Imported here because migrations reads DATABASE_PATH from this module
+    from migrations import migrate
+    
+    enable_wal()
+    version = migrate(DATABASE_PATH)
+    print(f"Database schema at version {version}")
+
+def enable_wal():
+    """
+    Switch the database to write-ahead logging.
+
+    Readers then no longer block the writer (or each other), and commits
+    only append to the log. The setting is stored in the database file.
+    """
+    conn = sqlite3.connect(DATABASE_PATH)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+class PoolStats:
+    """Wait-time counters for one side of the pool."""
+
+    def __init__(self):
+        self.acquired = 0
+        self.waited = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        self.acquired += 1
+        if wait > 0.001:
+            self.waited += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.total_wait / self.acquired * 1000, 3) if self.acquired else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+class ConnectionPool:
+    """
+    Long-lived aiosqlite connections shared by all requests.
+
+    Reads are spread over a fixed set of read-only connections; writes go
+    through a single writer connection so they never fight each other for
+    SQLite's database lock. Connections are opened on first use (or by the
+    app lifespan) and configured once.
+    """
+
+    def __init__(self, path: str, read_size: int = READ_POOL_SIZE, timeout: float = POOL_TIMEOUT):
+        self.path = path
+        self.read_size = read_size
+        self.timeout = timeout
+        self._readers = None
+        self._all_readers = []
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self.read_stats = PoolStats()
+        self.write_stats = PoolStats()
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        # The writer runs in autocommit mode; the write queue issues BEGIN/SAVEPOINT itself
+        conn = await aiosqlite.connect(self.path, isolation_level="" if read_only else None)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            # Guard against writes slipping onto a reader
+            await conn.execute("PRAGMA query_only = ON")
+        else:
+            await conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+
+    async def open(self):
+        """Open all connections if they are not open yet."""
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            readers = asyncio.Queue()
+            for _ in range(self.read_size):
+                conn = await self._connect(read_only=True)
+                self._all_readers.append(conn)
+                readers.put_nowait(conn)
+            self._readers = readers
+            self._writer = await self._connect(read_only=False)
+
+    async def close(self):
+        """Close every connection, called on app shutdown."""
+        async with self._open_lock:
+            for conn in self._all_readers:
+                await conn.close()
+            if self._writer is not None:
+                await self._writer.close()
+            self._all_readers = []
+            self._readers = None
+            self._writer = None
+
+    def _timeout(self, stats: PoolStats):
+        stats.timeouts += 1
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database is busy, please try again"
         )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        print("Database tables created successfully")
-    else:
-        print("Database already exists, skipping table creation")
\ No newline at end of file
+
+    @asynccontextmanager
+    async def read(self):
+        """Borrow a read-only connection."""
+        if self._writer is None:
+            await self.open()
+
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(self._readers.get(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timeout(self.read_stats)
+        self.read_stats.record(time.perf_counter() - started)
+
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """
+        Borrow the writer connection.
+
+        Anything left uncommitted when the block exits is rolled back, the
+        same as closing a per-request connection would have done.
+        """
+        if self._writer is None:
+            await self.open()
+
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._write_lock.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timeout(self.write_stats)
+        self.write_stats.record(time.perf_counter() - started)
+
+        try:
+            yield self._writer
+        finally:
+            try:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+            finally:
+                self._write_lock.release()
+
+    def stats(self) -> dict:
+        """Pool size and wait-time statistics."""
+        idle = self._readers.qsize() if self._readers is not None else 0
+        return {
+            "open": self._writer is not None,
+            "read_pool_size": self.read_size,
+            "readers_idle": idle,
+            "readers_in_use": len(self._all_readers) - idle,
+            "writer_in_use": self._write_lock.locked(),
+            "reads": self.read_stats.as_dict(),
+            "writes": self.write_stats.as_dict(),
+        }
+
+db_pool = ConnectionPool(DATABASE_PATH)
+
+class WriteQueue:
+    """
+    Single async task that performs every write.
+
+    Callers submit a coroutine function taking the writer connection; the
+    task runs queued writes back to back inside one transaction and
+    commits once, so a burst of likes and follows costs one fsync instead
+    of one each. Every write runs inside its own savepoint, so one that
+    raises is rolled back alone and its exception goes to its caller while
+    the rest of the batch still commits. Write functions must not commit.
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_max: int = WRITE_BATCH_MAX, batch_window: float = WRITE_BATCH_WINDOW):
+        self.pool = pool
+        self.batch_max = batch_max
+        self.batch_window = batch_window
+        self._queue = None
+        self._task = None
+
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+        self.max_batch = 0
+        self.batch_sizes = {"1": 0, "2-4": 0, "5-16": 0, "17+": 0}
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.total_commit_time = 0.0
+
+    def start(self):
+        """Start the writer task if it is not running."""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Finish queued writes and stop the writer task."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, fn, *args):
+        """Run fn(db, *args) on the writer and return its result once committed."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, args, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        if self.batch_window:
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.batch_max:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        while len(batch) < self.batch_max and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._execute(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _execute(self, batch: list):
+        started = time.perf_counter()
+        for _, _, _, submitted in batch:
+            wait = started - submitted
+            self.total_queue_wait += wait
+            self.max_queue_wait = max(self.max_queue_wait, wait)
+
+        results = []
+        try:
+            async with self.pool.write() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                for fn, args, future, _ in batch:
+                    await db.execute("SAVEPOINT batch_item")
+                    try:
+                        result = await fn(db, *args)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO batch_item")
+                        await db.execute("RELEASE batch_item")
+                        results.append((future, None, e))
+                    else:
+                        await db.execute("RELEASE batch_item")
+                        results.append((future, result, None))
+
+                commit_started = time.perf_counter()
+                await db.commit()
+                self.total_commit_time += time.perf_counter() - commit_started
+        except Exception as e:
+            # The transaction itself failed, so nothing in the batch was kept
+            print(f"Write batch failed: {str(e)}")
+            results = [(future, None, e) for _, _, future, _ in batch]
+
+        size = len(batch)
+        self.batches += 1
+        self.items += size
+        self.max_batch = max(self.max_batch, size)
+        bucket = "1" if size == 1 else "2-4" if size <= 4 else "5-16" if size <= 16 else "17+"
+        self.batch_sizes[bucket] += 1
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                self.failed += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        """Batch size and queue latency statistics."""
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "writes": self.items,
+            "failed": self.failed,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch,
+            "batch_sizes": dict(self.batch_sizes),
+            "avg_queue_wait_ms": round(self.total_queue_wait / self.items * 1000, 3) if self.items else 0.0,
+            "max_queue_wait_ms": round(self.max_queue_wait * 1000, 3),
+            "avg_commit_ms": round(self.total_commit_time / self.batches * 1000, 3) if self.batches else 0.0,
+        }
+
+write_queue = WriteQueue(db_pool)
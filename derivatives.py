@@ -0,0 +1,189 @@
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import aiosqlite
+
+from database import db_pool, write_queue
+from storage import BlobStore, IMAGE_STORE_PATH, image_url, release_image, delete_blobs
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is optional, posts just keep their original image
+    Image = None
+    features = None
+
+# Widths generated for every stored image; images narrower than the
+# smallest one get a single variant at their own width
+DERIVATIVE_WIDTHS = (256, 512, 1024)
+
+# Width used by grid tiles in the explore, feed and profile views
+THUMBNAIL_WIDTH = 512
+
+# Number of worker processes doing the resizing and encoding
+DERIVATIVE_WORKERS = 2
+
+# Encoder settings per output format
+_ENCODERS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "avif": {"format": "AVIF", "quality": 50, "speed": 6},
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pending = set()
+
+def available_formats() -> List[str]:
+    """Output formats supported by the installed Pillow build."""
+    if Image is None:
+        return []
+    formats = ["webp"] if features.check("webp") else []
+    if "AVIF" in Image.registered_extensions().values():
+        formats.append("avif")
+    return formats
+
+def render_derivatives(store_root: str, source_hash: str, widths, formats) -> List[dict]:
+    """
+    Resize and re-encode a stored image, writing each variant back to the store.
+
+    Runs inside a worker process, so it only takes and returns plain values.
+    """
+    store = BlobStore(store_root)
+    variants = []
+
+    with Image.open(store.path(source_hash)) as source:
+        source = source.convert("RGB")
+
+        fitting = [width for width in widths if width <= source.width] or [source.width]
+        for width in fitting:
+            height = round(source.height * width / source.width)
+            resized = source if width == source.width else source.resize((width, height), Image.LANCZOS)
+
+            for fmt in formats:
+                buffer = io.BytesIO()
+                resized.save(buffer, **_ENCODERS[fmt])
+                info = store.put(buffer.getvalue())
+                variants.append({
+                    "width": width,
+                    "height": height,
+                    "format": fmt,
+                    "image_hash": info["image_hash"],
+                    "image_size": info["image_size"],
+                })
+
+    return variants
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS)
+    return _pool
+
+def shutdown_pool():
+    """Stop the worker processes, called on app shutdown."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+async def generate_derivatives(source_hash: str):
+    """Produce the resized variants of an image and record them."""
+    formats = available_formats()
+    if not formats:
+        return
+
+    loop = asyncio.get_running_loop()
+    try:
+        variants = await loop.run_in_executor(
+            _get_pool(), render_derivatives, IMAGE_STORE_PATH, source_hash, DERIVATIVE_WIDTHS, formats
+        )
+    except Exception as e:
+        print(f"Error generating derivatives for {source_hash}: {str(e)}")
+        return
+
+    await write_queue.submit(_record_variants, source_hash, variants)
+
+    # The post may have been deleted while this ran, after its variants
+    # were released. Checking once they are recorded means either this or
+    # the delete sees the other. Posts may live in another database than
+    # image_variants, so the check cannot share the write.
+    from repositories import repository
+    if not await repository.posts.references_image(source_hash):
+        orphans = await write_queue.submit(release_image, source_hash)
+        await delete_blobs(orphans, repository.posts.references_image)
+
+async def _record_variants(db: aiosqlite.Connection, source_hash: str, variants: List[dict]):
+    await db.executemany("""
+        INSERT OR REPLACE INTO image_variants (source_hash, width, height, format, image_hash, image_size)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (source_hash, v["width"], v["height"], v["format"], v["image_hash"], v["image_size"])
+        for v in variants
+    ])
+
+def schedule_derivatives(source_hash: str):
+    """Generate derivatives in the background without delaying the response."""
+    task = asyncio.create_task(generate_derivatives(source_hash))
+    # Keep a reference so the task is not garbage collected while running
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+async def backfill_derivatives():
+    """Generate variants for stored images that do not have any yet."""
+    if not available_formats():
+        return
+
+    async with db_pool.read() as db:
+        cursor = await db.execute("""
+            SELECT DISTINCT p.image_hash FROM posts p
+            WHERE p.image_hash IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM image_variants v WHERE v.source_hash = p.image_hash)
+        """)
+        hashes = [row[0] for row in await cursor.fetchall()]
+
+    for source_hash in hashes:
+        await generate_derivatives(source_hash)
+
+def variants_query(source_hashes) -> Tuple[str, list]:
+    """SQL and parameters reading the variants of several images, narrowest first."""
+    placeholders = ", ".join("?" for _ in source_hashes)
+    return f"""
+        SELECT source_hash, width, format, image_hash FROM image_variants
+        WHERE source_hash IN ({placeholders})
+        ORDER BY width
+    """, list(source_hashes)
+
+def _srcset(variants: List[dict]) -> Optional[str]:
+    return ", ".join(f"{v['url']} {v['width']}w" for v in variants) or None
+
+async def attach_variants(db: aiosqlite.Connection, posts: List[dict], width: int = THUMBNAIL_WIDTH):
+    """
+    Add thumbnail_url, image_srcset, image_srcset_avif and image_variants
+    to serialized posts.
+
+    Uses one query for the whole page. Posts whose variants are missing or
+    still being generated fall back to the original image.
+    """
+    hashes = {post["image_hash"] for post in posts if post.get("image_hash")}
+    variants = {}
+
+    if hashes:
+        cursor = await db.execute(*variants_query(hashes))
+        for source_hash, variant_width, fmt, variant_hash in await cursor.fetchall():
+            variants.setdefault(source_hash, []).append({
+                "width": variant_width,
+                "format": fmt,
+                "url": image_url(variant_hash),
+            })
+
+    for post in posts:
+        post_variants = variants.get(post.get("image_hash"), [])
+        webp = [v for v in post_variants if v["format"] == "webp"]
+        thumbnail = next((v for v in webp if v["width"] >= width), webp[-1] if webp else None)
+
+        post["image_variants"] = post_variants
+        post["thumbnail_url"] = thumbnail["url"] if thumbnail else post.get("image_url")
+        post["image_srcset"] = _srcset(webp)
+        post["image_srcset_avif"] = _srcset([v for v in post_variants if v["format"] == "avif"])
+
+    return posts
@@ -0,0 +1,571 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+
+from generation_backends import build_backend, CircuitOpenError, GenerationTimeout
+
+# Jobs running at once across all users
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "4"))
+
+# Jobs of one user running at once; the rest wait their turn
+GENERATION_USER_CONCURRENCY = int(os.environ.get("GENERATION_USER_CONCURRENCY", "1"))
+
+# Jobs one user may have queued or running before new ones get a 429
+GENERATION_USER_QUEUE_LIMIT = int(os.environ.get("GENERATION_USER_QUEUE_LIMIT", "5"))
+
+# Jobs waiting across all users before new ones get a 503
+GENERATION_QUEUE_LIMIT = int(os.environ.get("GENERATION_QUEUE_LIMIT", "200"))
+
+# How long a finished job can still be polled
+GENERATION_JOB_TTL = float(os.environ.get("GENERATION_JOB_TTL", "600"))  # seconds
+
+# Memory given to the images of finished jobs waiting to be polled, per
+# worker; the oldest jobs are forgotten early past it
+GENERATION_JOB_STORE_BYTES = int(os.environ.get("GENERATION_JOB_STORE_MB", "128")) * 1024 * 1024
+
+# Memory given to recently generated images, served again for the same
+# prompt and parameters unless the request asks for a fresh one; 0 disables.
+# Shared by all users on purpose, so a prompt many people send at once costs
+# one provider call: two users asking for the same prompt may get, and
+# publish, the same picture. Users who want their own send fresh.
+GENERATION_CACHE_BYTES = int(os.environ.get("GENERATION_CACHE_MB", "64")) * 1024 * 1024
+
+# How long a generated image is served from the cache
+GENERATION_CACHE_TTL = float(os.environ.get("GENERATION_CACHE_TTL", "3600"))  # seconds
+
+# Most images one preview may ask for
+GENERATION_MAX_VARIANTS = int(os.environ.get("GENERATION_MAX_VARIANTS", "4"))
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+# Error status of jobs cancelled because their request went away, as nginx
+# logs a client closing the connection
+CLIENT_CLOSED_REQUEST = 499
+
+# Replaceable, e.g. with a ResilientBackend around a StubBackend in tests
+generator = build_backend()
+
+async def close_generator():
+    """Close the provider's pooled connections, called on app shutdown."""
+    await generator.close()
+
+def normalize_prompt(prompt: str) -> str:
+    """A prompt with Unicode and whitespace differences folded away."""
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+def generation_key(prompt: str) -> str:
+    """Hash of what decides a generated image: generator, parameters and prompt."""
+    key = {"generator": generator.name, "params": generator.params, "prompt": normalize_prompt(prompt)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+class GenerationCache:
+    """
+    Recently generated images by generation_key, least recently used first.
+
+    Bounded by the size of the base64 images it holds. Identical prompts
+    in a burst are answered from here once the first one has been
+    generated, whichever user sent them.
+    """
+
+    def __init__(self, max_bytes: int = GENERATION_CACHE_BYTES, ttl: float = GENERATION_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (expiry on the monotonic clock, image)
+        self._images: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def _drop(self, key: str):
+        _, image_data = self._images.pop(key)
+        self._bytes -= len(image_data)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._images.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._drop(key)
+            self._stats["expirations"] += 1
+            entry = None
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        self._images.move_to_end(key)
+        self._stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key: str, image_data: str):
+        if not self.enabled or len(image_data) > self.max_bytes:
+            return
+        if key in self._images:
+            self._drop(key)
+        self._images[key] = (time.monotonic() + self.ttl, image_data)
+        self._bytes += len(image_data)
+        while self._bytes > self.max_bytes:
+            self._drop(next(iter(self._images)))
+            self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._images),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+generation_cache = GenerationCache()
+
+# Generator calls in progress by generation_key; identical requests wait
+# on the same call instead of making their own
+_in_flight: Dict[str, "asyncio.Task[str]"] = {}
+_generation_stats = {"generator_calls": 0, "coalesced": 0, "fresh": 0, "variant_batches": 0, "variants": 0}
+
+async def _generate(key: str, prompt: str) -> str:
+    _generation_stats["generator_calls"] += 1
+    image_data = await generator.generate(prompt)
+    generation_cache.put(key, image_data)
+    return image_data
+
+def _http_error(error: Exception) -> HTTPException:
+    """The response for a failed generation."""
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, CircuitOpenError):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(error),
+            headers={"Retry-After": str(round(error.retry_after))},
+        )
+    print(f"Image generation error: {str(error)}")
+    return HTTPException(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT if isinstance(error, GenerationTimeout) else status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail=f"Error generating image: {str(error)}"
+    )
+
+async def generate_image(prompt: str, fresh: bool = False) -> str:
+    """
+    One base64 encoded image for a prompt; 500 if the generator fails.
+
+    The same prompt and parameters share a recent image or a call already
+    in progress, across users, unless fresh asks for a new variation.
+    """
+    key = generation_key(prompt)
+    try:
+        if fresh:
+            _generation_stats["fresh"] += 1
+            return await _generate(key, prompt)
+
+        if generation_cache.enabled:
+            image_data = generation_cache.get(key)
+            if image_data is not None:
+                return image_data
+
+        task = _in_flight.get(key)
+        if task is None:
+            # A task of its own, so a caller going away does not cancel the
+            # call for the others waiting on it
+            task = _in_flight[key] = asyncio.create_task(_generate(key, prompt))
+            task.add_done_callback(lambda _: _in_flight.pop(key, None))
+        else:
+            _generation_stats["coalesced"] += 1
+        return await asyncio.shield(task)
+    except Exception as e:
+        raise _http_error(e)
+
+async def generate_variants(prompt: str, n: int) -> AsyncIterator[str]:
+    """
+    n images of one prompt from a single batched call, each yielded as it
+    is ready. Always fresh; variants are for choosing between, so neither
+    the cache nor in-flight calls are shared.
+    """
+    _generation_stats["variant_batches"] += 1
+    try:
+        async for image_data in generator.generate_variants(prompt, n):
+            _generation_stats["variants"] += 1
+            yield image_data
+    except Exception as e:
+        raise _http_error(e)
+
+def generation_stats() -> dict:
+    """Generator calls saved by coalescing and the cache, for /api/metrics."""
+    stats = {
+        "generator": generator.name,
+        "in_flight": len(_in_flight),
+        **_generation_stats,
+        "cache": generation_cache.stats(),
+    }
+    if hasattr(generator, "stats"):
+        stats["backend"] = generator.stats()
+    return stats
+
+def _payload_size(value) -> int:
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_payload_size(item) for item in value.values())
+    if isinstance(value, list):
+        return sum(_payload_size(item) for item in value)
+    return 0
+
+class GenerationJob:
+    """One queued generation and, once it has run, its result or error."""
+
+    def __init__(self, user_id: int, kind: str, prompt: str, work: Callable[["GenerationJob"], Awaitable[dict]]):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.kind = kind
+        self.prompt = prompt
+        self.work = work
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.error_status: Optional[int] = None
+        self.error_headers: Optional[dict] = None
+        # Images of a multi-variant preview, added as they arrive
+        self.variants: List[dict] = []
+        # Bumped on every change; watchers wait on the event for the next one
+        self.version = 0
+        self._changed = asyncio.Event()
+        # Bytes of result and variants counted against the job store
+        self.size = 0
+        # The work while it runs, and whether cancel() stopped it
+        self.task: Optional["asyncio.Task[dict]"] = None
+        self.cancelled = False
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def _update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.version += 1
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def add_variant(self, variant: dict):
+        self.variants.append(variant)
+        self._update()
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "prompt": self.prompt,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+            "variants": self.variants,
+        }
+
+    async def watch(self, heartbeat: float) -> AsyncIterator[Optional[dict]]:
+        """
+        The job's state now and after every change until it finishes.
+
+        Yields None when nothing changed for heartbeat seconds, so streams
+        can keep idle connections open.
+        """
+        seen = -1
+        while True:
+            if self.version != seen:
+                seen = self.version
+                yield self.as_dict()
+                if self.finished:
+                    return
+                continue
+            try:
+                await asyncio.wait_for(self._changed.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+
+    def payload_size(self) -> int:
+        """Approximate bytes held by the result and variants, mostly base64 images."""
+        return _payload_size(self.result) + _payload_size(self.variants)
+
+    async def outcome(self) -> dict:
+        """Wait for the job and return its result, or raise its error."""
+        while not self.finished:
+            await self._changed.wait()
+        if self.status == FAILED:
+            raise HTTPException(status_code=self.error_status, detail=self.error, headers=self.error_headers)
+        return self.result
+
+class GenerationQueue:
+    """
+    Generation jobs run by a fixed pool of workers.
+
+    Each user has their own queue and the workers take from them in
+    turn, so one user queueing several prompts does not delay everyone
+    else; GENERATION_USER_CONCURRENCY caps how many of one user's jobs
+    run at once. Jobs live in this worker's memory, so with several
+    server workers a job is only visible through the one it was
+    submitted to. Finished jobs are kept for polling until job_ttl
+    passes or their images outgrow max_bytes, oldest first; jobs a
+    request waits on through wait() are forgotten as soon as it has
+    their outcome, and cancelled if it goes away first.
+    """
+
+    def __init__(
+        self,
+        workers: int = GENERATION_WORKERS,
+        user_concurrency: int = GENERATION_USER_CONCURRENCY,
+        user_queue_limit: int = GENERATION_USER_QUEUE_LIMIT,
+        queue_limit: int = GENERATION_QUEUE_LIMIT,
+        job_ttl: float = GENERATION_JOB_TTL,
+        max_bytes: int = GENERATION_JOB_STORE_BYTES,
+    ):
+        self.workers = workers
+        self.user_concurrency = user_concurrency
+        self.user_queue_limit = user_queue_limit
+        self.queue_limit = queue_limit
+        self.job_ttl = job_ttl
+        self.max_bytes = max_bytes
+        self._jobs: Dict[str, GenerationJob] = {}
+        # Finished jobs as (expiry, id), oldest first
+        self._expiry: Deque[Tuple[float, str]] = deque()
+        self._stored_bytes = 0
+        self._queues: Dict[int, Deque[GenerationJob]] = {}
+        self._running: Dict[int, int] = {}
+        # Users with a queued job and a free slot, in the order they are served
+        self._ready: Deque[int] = deque()
+        self._queued = 0
+        # Set when a user becomes ready; idle workers wait on it
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._stats = {
+            "submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "rejected": 0, "evicted": 0,
+            "wait_ms_total": 0.0, "wait_ms_max": 0.0, "run_ms_total": 0.0, "run_ms_max": 0.0,
+        }
+
+    def start(self):
+        """Start the workers, called on app startup."""
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers and fail the jobs they did not finish."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in self._jobs.values():
+            if not job.finished:
+                job._update(status=FAILED, error="Server shutting down", error_status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def _drop(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self._stored_bytes -= job.size
+
+    def _sweep(self):
+        now = time.monotonic()
+        while self._expiry and self._expiry[0][0] <= now:
+            self._drop(self._expiry.popleft()[1])
+        # Past the byte budget the oldest finished jobs go early
+        while self._stored_bytes > self.max_bytes and len(self._expiry) > 1:
+            job_id = self._expiry.popleft()[1]
+            if job_id in self._jobs:
+                self._drop(job_id)
+                self._stats["evicted"] += 1
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        self._sweep()
+        return self._jobs.get(job_id)
+
+    def submit(self, user_id: int, kind: str, prompt: str, work: Callable[[GenerationJob], Awaitable[dict]]) -> GenerationJob:
+        """
+        Queue work for a user and return its job right away.
+
+        work is called with the job once a worker takes it and returns the
+        job's result; raise HTTPException for errors meant for the client.
+        """
+        self._sweep()
+        queue = self._queues.get(user_id)
+        pending = (len(queue) if queue else 0) + self._running.get(user_id, 0)
+        if pending >= self.user_queue_limit:
+            self._stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many images generating, wait for one to finish",
+                headers={"Retry-After": "5"},
+            )
+        if self._queued >= self.queue_limit:
+            self._stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Image generation is busy, please try again",
+                headers={"Retry-After": "5"},
+            )
+
+        job = GenerationJob(user_id, kind, prompt, work)
+        self._jobs[job.id] = job
+        if not queue:
+            queue = self._queues[user_id] = deque()
+            # The user was not waiting for a turn; give them one if a slot is free
+            if self._running.get(user_id, 0) < self.user_concurrency:
+                self._ready.append(user_id)
+                self._wakeup.set()
+        queue.append(job)
+        self._queued += 1
+        self._stats["submitted"] += 1
+        return job
+
+    def cancel(self, job: GenerationJob):
+        """Take a job out of its queue, or stop its work if it is running."""
+        if job.finished or job.cancelled:
+            return
+        job.cancelled = True
+        self._stats["cancelled"] += 1
+        if job.task is not None:
+            # _run() records the outcome once the work has stopped
+            job.task.cancel()
+            return
+
+        queue = self._queues[job.user_id]
+        queue.remove(job)
+        self._queued -= 1
+        if not queue:
+            del self._queues[job.user_id]
+            if job.user_id in self._ready:
+                self._ready.remove(job.user_id)
+        job._update(status=FAILED, error="Cancelled", error_status=CLIENT_CLOSED_REQUEST, finished_at=time.time())
+
+    async def wait(self, job: GenerationJob, request: Optional[Request] = None) -> dict:
+        """
+        Wait for a job the client is not going to poll and return its result.
+
+        If request is given and the client disconnects first, the job is
+        cancelled: nobody could read its result any more, nor find out
+        about a post it published. The job is forgotten once this returns,
+        so its images are freed with the response instead of being held
+        for job_ttl.
+        """
+        watcher = asyncio.create_task(self._cancel_on_disconnect(job, request)) if request else None
+        try:
+            return await job.outcome()
+        except asyncio.CancelledError:
+            self.cancel(job)
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self._drop(job.id)
+
+    async def _cancel_on_disconnect(self, job: GenerationJob, request: Request):
+        # The body has been read, so the next message is the disconnect
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        self.cancel(job)
+
+    def _take(self) -> GenerationJob:
+        user_id = self._ready.popleft()
+        queue = self._queues[user_id]
+        job = queue.popleft()
+        self._queued -= 1
+        self._running[user_id] = self._running.get(user_id, 0) + 1
+        if not queue:
+            del self._queues[user_id]
+        elif self._running[user_id] < self.user_concurrency:
+            # Back of the line for their next job
+            self._ready.append(user_id)
+        return job
+
+    def _release(self, user_id: int):
+        self._running[user_id] -= 1
+        if not self._running[user_id]:
+            del self._running[user_id]
+        if user_id in self._queues and self._running.get(user_id, 0) == self.user_concurrency - 1:
+            self._ready.append(user_id)
+            self._wakeup.set()
+
+    async def _work(self):
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            job = self._take()
+            try:
+                await self._run(job)
+            finally:
+                self._release(job.user_id)
+
+    async def _run(self, job: GenerationJob):
+        started = time.time()
+        job._update(status=RUNNING, started_at=started)
+        # A task of its own, so cancel() can stop the work but not the worker
+        job.task = asyncio.ensure_future(job.work(job))
+        try:
+            result = await job.task
+            job._update(status=SUCCEEDED, result=result, finished_at=time.time())
+            self._stats["succeeded"] += 1
+        except asyncio.CancelledError:
+            if not job.cancelled:
+                # The worker itself is being stopped
+                job._update(status=FAILED, error="Server shutting down", error_status=status.HTTP_503_SERVICE_UNAVAILABLE, finished_at=time.time())
+                raise
+            job._update(status=FAILED, error="Cancelled", error_status=CLIENT_CLOSED_REQUEST, finished_at=time.time())
+        except HTTPException as e:
+            job._update(status=FAILED, error=e.detail, error_status=e.status_code, error_headers=e.headers, finished_at=time.time())
+            self._stats["failed"] += 1
+        except Exception as e:
+            print(f"Generation job {job.id} failed: {str(e)}")
+            job._update(status=FAILED, error=str(e), error_status=status.HTTP_500_INTERNAL_SERVER_ERROR, finished_at=time.time())
+            self._stats["failed"] += 1
+        finally:
+            # Unless a waiting request already took the outcome and left
+            if job.id in self._jobs:
+                job.size = job.payload_size()
+                self._stored_bytes += job.size
+                self._expiry.append((time.monotonic() + self.job_ttl, job.id))
+                self._sweep()
+
+        waited = (started - job.created_at) * 1000
+        took = (job.finished_at - started) * 1000
+        self._stats["wait_ms_total"] += waited
+        self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited)
+        self._stats["run_ms_total"] += took
+        self._stats["run_ms_max"] = max(self._stats["run_ms_max"], took)
+
+    def stats(self) -> dict:
+        """Queue depth and timings for /api/metrics."""
+        finished = self._stats["succeeded"] + self._stats["failed"]
+        return {
+            "workers": self.workers,
+            "queued": self._queued,
+            "running": sum(self._running.values()),
+            "users_waiting": len(self._queues),
+            "jobs": len(self._jobs),
+            "stored_bytes": self._stored_bytes,
+            "max_bytes": self.max_bytes,
+            "evicted": self._stats["evicted"],
+            "submitted": self._stats["submitted"],
+            "succeeded": self._stats["succeeded"],
+            "failed": self._stats["failed"],
+            "cancelled": self._stats["cancelled"],
+            "rejected": self._stats["rejected"],
+            "wait_ms_avg": round(self._stats["wait_ms_total"] / finished, 1) if finished else 0.0,
+            "wait_ms_max": round(self._stats["wait_ms_max"], 1),
+            "run_ms_avg": round(self._stats["run_ms_total"] / finished, 1) if finished else 0.0,
+            "run_ms_max": round(self._stats["run_ms_max"], 1),
+        }
+
+generation_queue = GenerationQueue()
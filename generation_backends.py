@@ -0,0 +1,432 @@
+import asyncio
+import base64
+import hashlib
+import math
+import os
+import random
+import struct
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Callable, Optional, Tuple
+
+import httpx
+from together import AsyncTogether, DefaultAsyncHttpxClient
+from together import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+# Key for the Together API, only ever read from the environment
+TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
+
+# Which image generator is called: "together" for the hosted API, "stub" for
+# a local stand-in that draws a flat image from the prompt, for development
+# and tests without the provider. The stand-in is only ever used when asked
+# for, so a deploy missing its key fails at startup instead of publishing it.
+IMAGE_BACKEND = os.environ.get("IMAGE_BACKEND", "together")
+
+# What the provider is asked for
+IMAGE_MODEL = os.environ.get("IMAGE_MODEL", "black-forest-labs/FLUX.1-schnell-Free")
+IMAGE_SIZE = int(os.environ.get("IMAGE_SIZE", "1024"))  # Reduced size for faster generation
+IMAGE_STEPS = int(os.environ.get("IMAGE_STEPS", "4"))
+
+# Connections to the provider kept open between calls
+TOGETHER_MAX_CONNECTIONS = int(os.environ.get("TOGETHER_MAX_CONNECTIONS", "20"))
+
+# Time the stand-in takes per image: seconds, or a distribution to sample
+# from, see parse_latency()
+STUB_LATENCY = os.environ.get("STUB_LATENCY", "1.0")
+
+# Share of stand-in calls that fail, to exercise retries and the breaker
+STUB_ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", "0"))
+
+# Time one call may take before it is abandoned and counted as failed
+GENERATION_TIMEOUT = float(os.environ.get("GENERATION_TIMEOUT", "60"))  # seconds
+
+# Further attempts after a call fails or times out
+GENERATION_RETRIES = int(os.environ.get("GENERATION_RETRIES", "2"))
+
+# Base of the exponential backoff between attempts; each wait is drawn
+# uniformly below it so retries from many requests spread out
+GENERATION_RETRY_BACKOFF = float(os.environ.get("GENERATION_RETRY_BACKOFF", "0.5"))  # seconds
+
+# Send a second, identical call when the first has not answered after this
+# long and take whichever finishes first; 0 disables hedging
+GENERATION_HEDGE_AFTER = float(os.environ.get("GENERATION_HEDGE_AFTER", "0"))  # seconds
+
+# Consecutive failed calls that open the circuit, and how long it stays
+# open before one trial call is let through
+GENERATION_BREAKER_FAILURES = int(os.environ.get("GENERATION_BREAKER_FAILURES", "5"))
+GENERATION_BREAKER_COOLDOWN = float(os.environ.get("GENERATION_BREAKER_COOLDOWN", "30"))  # seconds
+
+class CircuitOpenError(Exception):
+    """The provider has been failing; calls are refused until the cooldown ends."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Image generation is temporarily unavailable")
+        self.retry_after = retry_after
+
+class GenerationTimeout(Exception):
+    """A call took longer than its deadline."""
+
+class GenerationBackend(ABC):
+    """
+    Something that turns a prompt into an image.
+
+    name and params identify what decides the image besides the prompt,
+    so identical requests can share results.
+    """
+
+    name = ""
+    params: dict = {}
+
+    @abstractmethod
+    async def generate(self, prompt: str) -> str:
+        """One base64 encoded image."""
+
+    async def generate_variants(self, prompt: str, n: int) -> AsyncIterator[str]:
+        """n images of one prompt, each yielded as soon as it is ready."""
+        # Without a batched call, make single calls side by side
+        calls = [asyncio.ensure_future(self.generate(prompt)) for _ in range(n)]
+        try:
+            for call in asyncio.as_completed(calls):
+                yield await call
+        finally:
+            for call in calls:
+                call.cancel()
+
+    def retryable(self, error: Exception) -> bool:
+        """Whether a failed call may succeed if made again."""
+        return True
+
+    async def close(self):
+        pass
+
+class TogetherBackend(GenerationBackend):
+    """
+    FLUX through the Together API.
+
+    One client for the process, so calls reuse pooled keep-alive
+    connections instead of a TLS handshake each. The client's own timeout
+    and retries are off; ResilientBackend does both.
+    """
+
+    name = "together"
+
+    def __init__(self, api_key: Optional[str] = TOGETHER_API_KEY, model: str = IMAGE_MODEL, size: int = IMAGE_SIZE, steps: int = IMAGE_STEPS):
+        self.params = {"model": model, "width": size, "height": size, "steps": steps}
+        limits = httpx.Limits(max_connections=TOGETHER_MAX_CONNECTIONS, max_keepalive_connections=TOGETHER_MAX_CONNECTIONS)
+        self.client = AsyncTogether(
+            api_key=api_key,
+            max_retries=0,
+            timeout=None,
+            http_client=DefaultAsyncHttpxClient(limits=limits),
+        )
+
+    async def generate(self, prompt: str) -> str:
+        response = await self.client.images.generate(
+            prompt=prompt,
+            **self.params,
+            n=1,
+            response_format="base64"
+        )
+        if not getattr(response, "data", None):
+            raise ValueError("No image data received from API")
+        return response.data[0].b64_json
+
+    async def generate_variants(self, prompt: str, n: int) -> AsyncIterator[str]:
+        # One round trip for all of them; they arrive together
+        response = await self.client.images.generate(
+            prompt=prompt,
+            **self.params,
+            n=n,
+            response_format="base64"
+        )
+        if not getattr(response, "data", None):
+            raise ValueError("No image data received from API")
+        for image in response.data:
+            yield image.b64_json
+
+    def retryable(self, error: Exception) -> bool:
+        if isinstance(error, (APIConnectionError, APITimeoutError, RateLimitError)):
+            return True
+        if isinstance(error, APIStatusError):
+            # Rejected prompts and bad credentials fail the same way every time
+            return error.status_code >= 500
+        return True
+
+    async def close(self):
+        await self.client.close()
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    A sampler of stand-in latencies, in seconds, from a spec:
+
+        1.5                   always 1.5
+        uniform:0.5:3         uniform between 0.5 and 3
+        lognormal:2:0.5       log-normal with median 2 and sigma 0.5
+        tail:1:0.05:20        1, except 5% of calls take 20
+    """
+    kind, _, args = spec.partition(":")
+    try:
+        if not args:
+            latency = float(kind)
+            return lambda: latency
+        values = [float(value) for value in args.split(":")]
+        if kind == "uniform":
+            low, high = values
+            return lambda: random.uniform(low, high)
+        if kind == "lognormal":
+            median, sigma = values
+            return lambda: random.lognormvariate(math.log(median), sigma)
+        if kind == "tail":
+            usual, share, slow = values
+            return lambda: slow if random.random() < share else usual
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency {spec!r}")
+
+def _png(color: Tuple[int, int, int], size: int) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    # Filter byte 0 then RGB pixels, for every row
+    rows = (b"\x00" + bytes(color) * size) * size
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+class StubBackend(GenerationBackend):
+    """
+    A local stand-in for the provider.
+
+    Draws a flat PNG whose colour is derived from the prompt, so the same
+    prompt gives the same image, after a latency sampled from a
+    distribution; error_rate of the calls fail instead. Each variant of
+    a batch gets its own colour.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: str = STUB_LATENCY, error_rate: float = STUB_ERROR_RATE, size: int = 256):
+        self.latency = parse_latency(str(latency))
+        self.error_rate = error_rate
+        self.size = size
+        self.params = {"size": size}
+        self.calls = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency())
+        if random.random() < self.error_rate:
+            raise ConnectionError("Stub provider failure")
+        return self._draw(prompt)
+
+    def _draw(self, seed: str) -> str:
+        color = tuple(hashlib.sha256(seed.encode("utf-8")).digest()[:3])
+        return base64.b64encode(_png(color, self.size)).decode("ascii")
+
+    async def generate_variants(self, prompt: str, n: int) -> AsyncIterator[str]:
+        # One call for the batch, with each image finishing after its own
+        # sampled latency, like a provider that streams its results
+        self.calls += 1
+        if random.random() < self.error_rate:
+            await asyncio.sleep(self.latency())
+            raise ConnectionError("Stub provider failure")
+        elapsed = 0.0
+        for index, latency in enumerate(sorted(self.latency() for _ in range(n))):
+            await asyncio.sleep(latency - elapsed)
+            elapsed = latency
+            yield self._draw(f"{prompt}\n{index}")
+
+class CircuitBreaker:
+    """
+    Fails calls fast while the provider is down.
+
+    Opens after failures consecutive failed calls; after cooldown seconds
+    one trial call goes through, and closes it again if it succeeds.
+    """
+
+    def __init__(self, failures: int = GENERATION_BREAKER_FAILURES, cooldown: float = GENERATION_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead."""
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return
+        self.stats["rejected"] += 1
+        retry_after = self.cooldown - (time.monotonic() - self.opened_at) if state == "open" else 1
+        raise CircuitOpenError(max(retry_after, 1))
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.trial_in_flight or self.consecutive_failures >= self.failures:
+            if self.opened_at is None or self.trial_in_flight:
+                self.stats["opened"] += 1
+            self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+    def record_neutral(self):
+        """A call that failed for a reason of its own, not the provider's health."""
+        self.trial_in_flight = False
+
+class ResilientBackend(GenerationBackend):
+    """
+    A backend wrapped with a deadline per call, retries with jittered
+    backoff, optional hedging and a circuit breaker.
+    """
+
+    def __init__(
+        self,
+        backend: GenerationBackend,
+        timeout: float = GENERATION_TIMEOUT,
+        retries: int = GENERATION_RETRIES,
+        backoff: float = GENERATION_RETRY_BACKOFF,
+        hedge_after: float = GENERATION_HEDGE_AFTER,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.backend = backend
+        self.name = backend.name
+        self.params = backend.params
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self._stats = {"calls": 0, "batches": 0, "attempts": 0, "retries": 0, "timeouts": 0, "failures": 0, "hedges": 0, "hedge_wins": 0}
+
+    async def _attempt(self, prompt: str) -> str:
+        self._stats["attempts"] += 1
+        try:
+            return await asyncio.wait_for(self.backend.generate(prompt), self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise GenerationTimeout(f"No image after {self.timeout:g} seconds")
+
+    async def _hedged(self, prompt: str) -> str:
+        if self.hedge_after <= 0:
+            return await self._attempt(prompt)
+
+        first = asyncio.ensure_future(self._attempt(prompt))
+        attempts = {first}
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_after)
+            if not done:
+                self._stats["hedges"] += 1
+                attempts.add(asyncio.ensure_future(self._attempt(prompt)))
+            # The first attempt to succeed wins; fail only once both have
+            error = None
+            while attempts:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not first:
+                            self._stats["hedge_wins"] += 1
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _after_failure(self, error: Exception, attempt: int):
+        """Record a failed attempt; re-raise it unless another one should follow."""
+        if not (isinstance(error, GenerationTimeout) or self.backend.retryable(error)):
+            self.breaker.record_neutral()
+            raise error
+        self.breaker.record_failure()
+        self._stats["failures"] += 1
+        if attempt == self.retries:
+            raise error
+        self._stats["retries"] += 1
+        await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def generate(self, prompt: str) -> str:
+        self._stats["calls"] += 1
+        for attempt in range(self.retries + 1):
+            self.breaker.before_call()
+            try:
+                image_data = await self._hedged(prompt)
+            except asyncio.CancelledError:
+                self.breaker.record_neutral()
+                raise
+            except Exception as e:
+                await self._after_failure(e, attempt)
+                continue
+            self.breaker.record_success()
+            return image_data
+
+    async def generate_variants(self, prompt: str, n: int) -> AsyncIterator[str]:
+        """
+        A batch under the same deadline, retries and breaker as one image.
+
+        The deadline covers the whole batch. Only a batch that failed
+        before its first image is retried; once images have gone out, a
+        failure ends the batch short instead. Batches are not hedged.
+        """
+        self._stats["batches"] += 1
+        for attempt in range(self.retries + 1):
+            self.breaker.before_call()
+            self._stats["attempts"] += 1
+            variants = self.backend.generate_variants(prompt, n)
+            deadline = time.monotonic() + self.timeout
+            yielded = 0
+            try:
+                while True:
+                    try:
+                        image_data = await asyncio.wait_for(variants.__anext__(), max(deadline - time.monotonic(), 0))
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        self._stats["timeouts"] += 1
+                        raise GenerationTimeout(f"No image after {self.timeout:g} seconds")
+                    yielded += 1
+                    yield image_data
+            except (asyncio.CancelledError, GeneratorExit):
+                self.breaker.record_neutral()
+                raise
+            except Exception as e:
+                if yielded:
+                    print(f"Image batch ended after {yielded} of {n} images: {str(e)}")
+                    self.breaker.record_failure()
+                    self._stats["failures"] += 1
+                    return
+                await self._after_failure(e, attempt)
+                continue
+            finally:
+                await variants.aclose()
+            self.breaker.record_success()
+            return
+
+    async def close(self):
+        await self.backend.close()
+
+    def stats(self) -> dict:
+        return {**self._stats, "breaker": self.breaker.state, **self.breaker.stats}
+
+_BACKENDS = {"together": TogetherBackend, "stub": StubBackend}
+
+def build_backend(name: str = IMAGE_BACKEND) -> ResilientBackend:
+    """The configured backend, wrapped with deadlines, retries and the breaker."""
+    if name not in _BACKENDS:
+        raise ValueError(f"IMAGE_BACKEND must be one of {', '.join(_BACKENDS)}, not {name!r}")
+    if name == "together" and not TOGETHER_API_KEY:
+        raise ValueError("TOGETHER_API_KEY is not set; set it, or IMAGE_BACKEND=stub for development")
+    return ResilientBackend(_BACKENDS[name]())
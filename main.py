@@ -2,31 +2,85 @@ import uvicorn
 from fastapi import FastAPI, Request, Depends, HTTPException, status, Header
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 import aiosqlite
 import base64
 from typing import Optional
-import jwt
-from datetime import datetime, timedelta
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 
-from database import initialize_database, DATABASE_PATH
-from routers import user, post
+from database import initialize_database, DATABASE_PATH, db_pool, write_queue
+from storage import migrate_inline_images
+from derivatives import backfill_derivatives, shutdown_pool
+from counters import reconcile_periodically, reconcile_stats
+from pagination import NEXT_CURSOR_HEADER
+from trending import ensure_scores, rebase_periodically, decay, TRENDING_HALF_LIFE_HOURS
+from timelines import trim_periodically, timeline_stats
+from social_graph import social_graph, check_periodically
+from user_cache import user_cache
+from passwords import shutdown_executor, password_stats
+from generation import generation_queue, generation_stats, close_generator
+from previews import preview_store
+from middleware import AuthMiddleware
+from repositories import repository
+from routers import user, post, image
 from auth import (
     get_current_user, 
     get_current_user_optional, 
-    get_token_from_request, 
+    get_current_admin,
+    get_auth,
     oauth2_scheme,
-    oauth2_scheme_optional,
-    SECRET_KEY,
-    ALGORITHM
+    oauth2_scheme_optional
 )
 
 # Initialize the database
 initialize_database()
 
+async def migrate_images():
+    """Move inline images to the image store, then generate missing thumbnails."""
+    await migrate_inline_images()
+    await backfill_derivatives()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background jobs on startup and stop them on shutdown."""
+    # imageshare.db holds the image store with every backend
+    await db_pool.open()
+    write_queue.start()
+    await repository.open()
+    # Follow lists and checks are served from memory
+    await social_graph.load()
+    # Image generations run on a fixed pool of workers, not in the request
+    generation_queue.start()
+    
+    tasks = []
+    if repository.name == "sqlite":
+        # Move images still stored inline in imageshare.db to the image store
+        tasks.append(asyncio.create_task(migrate_images()))
+        # Repair any drift in the denormalized like/follow/post counters
+        tasks.append(asyncio.create_task(reconcile_periodically()))
+    # Keep trending scores decayed to the current time
+    await ensure_scores()
+    tasks.append(asyncio.create_task(rebase_periodically()))
+    # Keep home timelines at their bounded length
+    tasks.append(asyncio.create_task(trim_periodically()))
+    # Repair any drift between the social graph and the followers table
+    tasks.append(asyncio.create_task(check_periodically()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await generation_queue.stop()
+    await close_generator()
+    shutdown_pool()
+    shutdown_executor()
+    await repository.close()
+    await write_queue.stop()
+    await db_pool.close()
+
 # Create FastAPI app
-app = FastAPI(title="ImageShare", description="A social media app for sharing AI-generated images")
+app = FastAPI(title="ImageShare", description="A social media app for sharing AI-generated images", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -35,6 +89,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all methods
     allow_headers=["*"],  # Allow all headers
+    expose_headers=[NEXT_CURSOR_HEADER],  # Let cross-origin clients page through lists
 )
 
 # Mount static files
@@ -46,17 +101,15 @@ templates = Jinja2Templates(directory="templates")
 # Include routers
 app.include_router(user.router)
 app.include_router(post.router)
+app.include_router(image.router)
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Render the home page or landing page based on authentication status."""
-    # Extract token
-    token = await get_token_from_request(request)
-    
-    # Get user if token exists
-    user = await get_current_user_optional(token) if token else None
+    # A valid token is enough to pick the page; no database access
+    auth = await get_auth(request)
     
-    if user:
+    if auth.authenticated:
         # User is authenticated, render the home page
         return templates.TemplateResponse("index.html", {"request": request})
     else:
@@ -67,10 +120,9 @@ async def home(request: Request):
 async def login_page(request: Request):
     """Render the login page."""
     # Check if user is already logged in
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    auth = await get_auth(request)
     
-    if user:
+    if auth.authenticated:
         # Already logged in, redirect to home
         return RedirectResponse(url="/", status_code=302)
     
@@ -80,10 +132,9 @@ async def login_page(request: Request):
 async def register_page(request: Request):
     """Render the registration page."""
     # Check if user is already logged in
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    auth = await get_auth(request)
     
-    if user:
+    if auth.authenticated:
         # Already logged in, redirect to home
         return RedirectResponse(url="/", status_code=302)
     
@@ -97,11 +148,10 @@ async def explore_page(request: Request):
 @app.get("/create", response_class=HTMLResponse)
 async def create_post_page(request: Request):
     """Render the create post page."""
-    # Extract token and check authentication
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Authorized from the token claims alone
+    auth = await get_auth(request)
     
-    if not user:
+    if not auth.authenticated:
         # Not authenticated, redirect to login
         return RedirectResponse(url="/login?next=/create", status_code=302)
     
@@ -110,25 +160,23 @@ async def create_post_page(request: Request):
 @app.get("/profile", response_class=HTMLResponse)
 async def profile_page(request: Request):
     """Render the user's profile page."""
-    # Extract token and check authentication
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Authorized from the token claims alone
+    auth = await get_auth(request)
     
-    if not user:
+    if not auth.authenticated:
         # Not authenticated, redirect to login
         return RedirectResponse(url="/login?next=/profile", status_code=302)
     
     # Render profile with the user's username
-    return templates.TemplateResponse("profile.html", {"request": request, "username": user["username"]})
+    return templates.TemplateResponse("profile.html", {"request": request, "username": auth.username})
 
 @app.get("/profile/{username}", response_class=HTMLResponse)
 async def user_profile_page(request: Request, username: str):
     """Render another user's profile page."""
-    # Extract token and check authentication
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Authorized from the token claims alone
+    auth = await get_auth(request)
     
-    if not user:
+    if not auth.authenticated:
         # Not authenticated, redirect to login
         return RedirectResponse(url=f"/login?next=/profile/{username}", status_code=302)
     
@@ -137,20 +185,15 @@ async def user_profile_page(request: Request, username: str):
 @app.get("/post/{post_id}", response_class=HTMLResponse)
 async def view_post_page(request: Request, post_id: int):
     """Render the page to view a specific post."""
-    # Extract token to check if user is authenticated (but don't require it)
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
-    
     return templates.TemplateResponse("view_post.html", {"request": request, "post_id": post_id})
 
 @app.get("/settings", response_class=HTMLResponse)
 async def settings_page(request: Request):
     """Render the user settings page."""
-    # Extract token and check authentication
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Authorized from the token claims alone
+    auth = await get_auth(request)
     
-    if not user:
+    if not auth.authenticated:
         # Not authenticated, redirect to login
         return RedirectResponse(url="/login?next=/settings", status_code=302)
     
@@ -159,11 +202,10 @@ async def settings_page(request: Request):
 @app.get("/followers/{username}", response_class=HTMLResponse)
 async def followers_page(request: Request, username: str):
     """Render the followers page for a user."""
-    # Extract token and check authentication
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Authorized from the token claims alone
+    auth = await get_auth(request)
     
-    if not user:
+    if not auth.authenticated:
         # Not authenticated, redirect to login
         return RedirectResponse(url=f"/login?next=/followers/{username}", status_code=302)
     
@@ -172,11 +214,10 @@ async def followers_page(request: Request, username: str):
 @app.get("/following/{username}", response_class=HTMLResponse)
 async def following_page(request: Request, username: str):
     """Render the following page for a user."""
-    # Extract token and check authentication
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Authorized from the token claims alone
+    auth = await get_auth(request)
     
-    if not user:
+    if not auth.authenticated:
         # Not authenticated, redirect to login
         return RedirectResponse(url=f"/login?next=/following/{username}", status_code=302)
     
@@ -192,12 +233,48 @@ async def health_check():
     """API endpoint for health checking."""
     return {"status": "healthy", "version": "1.0.0"}
 
+@app.get("/api/metrics")
+async def metrics(current_user: dict = Depends(get_current_admin)):
+    """Internal counters for tuning the storage layer; admins only."""
+    return {
+        "database": db_pool.stats(),
+        "writes": write_queue.stats(),
+        "counters": reconcile_stats,
+        "timelines": timeline_stats,
+        "social_graph": {**social_graph.memory(), **social_graph.stats},
+        "user_cache": user_cache.stats(),
+        "passwords": password_stats(),
+        "generation": generation_queue.stats(),
+        "generator": generation_stats(),
+        "previews": preview_store.stats(),
+    }
+
+@app.get("/api/trending")
+async def trending_debug(limit: int = 20, current_user: dict = Depends(get_current_admin)):
+    """Top trending posts with the inputs behind their scores; admins only."""
+    epoch, half_life = await repository.posts.trending_state()
+    rows = await repository.posts.trending(min(max(limit, 1), 100))
+    
+    return {
+        "half_life_hours": half_life / 3600,
+        "configured_half_life_hours": TRENDING_HALF_LIFE_HOURS,
+        "epoch": datetime.fromtimestamp(epoch, timezone.utc).isoformat(),
+        "posts": [
+            {
+                **row,
+                "updated_at": datetime.fromtimestamp(row["updated_at"], timezone.utc).isoformat(),
+                # Comparable across rebases, unlike the stored score
+                "decayed_score": round(decay(row["score"], epoch, half_life), 6),
+            }
+            for row in rows
+        ],
+    }
+
 @app.get("/api/auth/status")
 async def auth_status(request: Request):
     """Check user's authentication status."""
-    # Extract token
-    token = await get_token_from_request(request)
-    user = await get_current_user_optional(token) if token else None
+    # Confirms the user still exists, unlike the page routes
+    user = await get_current_user_optional(request)
     
     if user:
         return {
@@ -208,80 +285,8 @@ async def auth_status(request: Request):
     else:
         return {"authenticated": False}
 
-@app.middleware("http")
-async def auth_middleware(request: Request, call_next):
-    """Middleware to handle authentication and redirects."""
-    # Public paths that don't require authentication
-    public_paths = [
-        "/login", 
-        "/register", 
-        "/static", 
-        "/users/token", 
-        "/users/register", 
-        "/api/health",
-        "/api/auth/status",
-        "/explore",
-        "/",
-    ]
-    
-    # Check if current path is in public paths or starts with one
-    is_public = False
-    for path in public_paths:
-        if request.url.path == path or request.url.path.startswith(path + "/"):
-            is_public = True
-            break
-        
-    # API paths that return JSON responses for 401
-    api_paths = ["/users/", "/posts/"]
-    is_api = False
-    for path in api_paths:
-        if request.url.path.startswith(path):
-            is_api = True
-            break
-    
-    # Continue processing for public paths
-    if is_public:
-        return await call_next(request)
-    
-    # Check for token
-    token = await get_token_from_request(request)
-    if not token:
-        if is_api:
-            # API paths return JSON error
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"detail": "Not authenticated"}
-            )
-        else:
-            # UI paths redirect to login
-            return RedirectResponse(
-                url=f"/login?next={request.url.path}",
-                status_code=status.HTTP_302_FOUND
-            )
-    
-    # Verify token
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if not username:
-            raise jwt.PyJWTError("Invalid token")
-    except jwt.PyJWTError:
-        if is_api:
-            # API paths return JSON error
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"detail": "Invalid token"}
-            )
-        else:
-            # UI paths redirect to login
-            return RedirectResponse(
-                url=f"/login?next={request.url.path}",
-                status_code=status.HTTP_302_FOUND
-            )
-    
-    # Token is valid, continue processing
-    response = await call_next(request)
-    return response
+# Added last so it runs first, in front of CORS like the decorator it replaced
+app.add_middleware(AuthMiddleware)
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
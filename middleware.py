@@ -0,0 +1,88 @@
+import re
+from typing import Dict
+
+from fastapi import status
+from fastapi.responses import JSONResponse, RedirectResponse
+from starlette.requests import Request
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from auth import get_auth
+
+# Paths that don't require authentication, matched exactly or as a prefix
+# followed by "/"
+PUBLIC_PATHS = (
+    "/login",
+    "/register",
+    "/static",
+    "/images",
+    "/users/token",
+    "/users/register",
+    "/api/health",
+    "/api/auth/status",
+    "/explore",
+    "/",
+)
+
+# Path prefixes that answer 401 with JSON instead of redirecting to login
+API_PREFIXES = ("/users/", "/posts/")
+
+PUBLIC, API, PAGE = 0, 1, 2
+
+_PUBLIC_PATTERN = re.compile("(?:" + "|".join(re.escape(path) for path in PUBLIC_PATHS) + ")(?:/|$)")
+
+# Classification of paths already seen. Bounded, since post ids and image
+# hashes make the set of paths open-ended; past the limit paths are
+# classified on every request.
+_CLASSIFIED_LIMIT = 4096
+_classified: Dict[str, int] = {}
+
+def classify(path: str) -> int:
+    """PUBLIC, API or PAGE for a request path."""
+    kind = _classified.get(path)
+    if kind is None:
+        if _PUBLIC_PATTERN.match(path):
+            kind = PUBLIC
+        elif path.startswith(API_PREFIXES):
+            kind = API
+        else:
+            kind = PAGE
+        if len(_classified) < _CLASSIFIED_LIMIT:
+            _classified[path] = kind
+    return kind
+
+class AuthMiddleware:
+    """
+    Reject unauthenticated requests to private routes.
+
+    A plain ASGI middleware: public routes are passed straight to the app
+    after one dictionary lookup, and responses are never wrapped, so
+    streaming and file responses go out as the app sends them. The token
+    is decoded into request.state.auth, where handlers find it again.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or classify(scope["path"]) == PUBLIC:
+            await self.app(scope, receive, send)
+            return
+
+        auth = await get_auth(Request(scope))
+        if not auth.authenticated:
+            if classify(scope["path"]) == API:
+                # API paths return JSON error
+                response = JSONResponse(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    content={"detail": "Invalid token" if auth.token else "Not authenticated"}
+                )
+            else:
+                # UI paths redirect to login
+                response = RedirectResponse(
+                    url=f"/login?next={scope['path']}",
+                    status_code=status.HTTP_302_FOUND
+                )
+            await response(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
@@ -0,0 +1,456 @@
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import DATABASE_PATH
+
+def _create_base_tables(conn: sqlite3.Connection):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        bio TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        prompt TEXT NOT NULL,
+        image_data TEXT NOT NULL DEFAULT '',
+        caption TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS followers (
+        follower_id INTEGER NOT NULL,
+        followed_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (follower_id, followed_id),
+        FOREIGN KEY (follower_id) REFERENCES users (id),
+        FOREIGN KEY (followed_id) REFERENCES users (id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS likes (
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, post_id),
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (post_id) REFERENCES posts (id)
+    )
+    ''')
+
+def _add_image_store(conn: sqlite3.Connection):
+    # Databases from before the image store may already have some of these
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(posts)")}
+    for name, column_type in (("image_hash", "TEXT"), ("image_size", "INTEGER"), ("image_mime", "TEXT")):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE posts ADD COLUMN {name} {column_type}")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_image_hash ON posts (image_hash)")
+
+    # Resized/re-encoded copies of stored images, themselves stored by hash
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS image_variants (
+        source_hash TEXT NOT NULL,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        format TEXT NOT NULL,
+        image_hash TEXT NOT NULL,
+        image_size INTEGER NOT NULL,
+        PRIMARY KEY (source_hash, width, format)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_variants_image_hash ON image_variants (image_hash)")
+
+def _add_secondary_indexes(conn: sqlite3.Connection):
+    # Profile grids and feeds: one user's posts, newest first
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_created ON posts (user_id, created_at)")
+    # Explore "latest"
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_created ON posts (created_at)")
+    # Like counts per post; the primary key only covers lookups by user
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_likes_post ON likes (post_id)")
+    # Follower lists and counts; the primary key only covers lookups by follower
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_followers_followed ON followers (followed_id, follower_id)")
+
+# Triggers run inside the writing transaction, so the counts are exact
+# whichever code path inserts or deletes the rows
+_COUNTER_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS likes_count_insert AFTER INSERT ON likes BEGIN
+        UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS likes_count_delete AFTER DELETE ON likes BEGIN
+        UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS followers_count_insert AFTER INSERT ON followers BEGIN
+        UPDATE users SET follower_count = follower_count + 1 WHERE id = NEW.followed_id;
+        UPDATE users SET following_count = following_count + 1 WHERE id = NEW.follower_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS followers_count_delete AFTER DELETE ON followers BEGIN
+        UPDATE users SET follower_count = follower_count - 1 WHERE id = OLD.followed_id;
+        UPDATE users SET following_count = following_count - 1 WHERE id = OLD.follower_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_count_insert AFTER INSERT ON posts BEGIN
+        UPDATE users SET post_count = post_count + 1 WHERE id = NEW.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_count_delete AFTER DELETE ON posts BEGIN
+        UPDATE users SET post_count = post_count - 1 WHERE id = OLD.user_id;
+    END
+    """,
+)
+
+def _add_counters(conn: sqlite3.Connection):
+    # Counts shown on every post and profile, kept on the rows so reads do
+    # not aggregate likes/followers/posts per row
+    conn.execute("ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE users ADD COLUMN follower_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE users ADD COLUMN following_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE users ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0")
+
+    conn.execute("UPDATE posts SET like_count = (SELECT COUNT(*) FROM likes WHERE post_id = posts.id)")
+    conn.execute("""
+        UPDATE users SET
+            follower_count = (SELECT COUNT(*) FROM followers WHERE followed_id = users.id),
+            following_count = (SELECT COUNT(*) FROM followers WHERE follower_id = users.id),
+            post_count = (SELECT COUNT(*) FROM posts WHERE user_id = users.id)
+    """)
+
+    for trigger in _COUNTER_TRIGGERS:
+        conn.execute(trigger)
+
+    # Explore "popular"
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_popular ON posts (like_count, created_at)")
+
+def _add_pagination_indexes(conn: sqlite3.Connection):
+    # Keyset pages of follower/following lists and liked posts, newest first
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_followers_followed_created ON followers (followed_id, created_at, follower_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_followers_follower_created ON followers (follower_id, created_at, followed_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_likes_user_created ON likes (user_id, created_at, post_id)")
+
+def _add_trending(conn: sqlite3.Connection):
+    # Decayed engagement per post, maintained by trending.py
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS post_trending (
+        post_id INTEGER PRIMARY KEY,
+        score REAL NOT NULL,
+        engagement INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trending_score ON post_trending (score)")
+
+    # The epoch scores are relative to, and the half-life they were built with
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS trending_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        epoch REAL NOT NULL,
+        half_life REAL NOT NULL
+    )
+    ''')
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS posts_trending_delete AFTER DELETE ON posts BEGIN
+        DELETE FROM post_trending WHERE post_id = OLD.id;
+    END
+    """)
+
+# Keep the external-content FTS index in step with posts
+_POSTS_FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts (rowid, prompt, caption) VALUES (NEW.id, NEW.prompt, NEW.caption);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, prompt, caption) VALUES ('delete', OLD.id, OLD.prompt, OLD.caption);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF prompt, caption ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, prompt, caption) VALUES ('delete', OLD.id, OLD.prompt, OLD.caption);
+        INSERT INTO posts_fts (rowid, prompt, caption) VALUES (NEW.id, NEW.prompt, NEW.caption);
+    END
+    """,
+)
+
+def _add_posts_fts(conn: sqlite3.Connection):
+    # Full-text index over prompt and caption; the text itself stays in posts.
+    # prefix= keeps 2 and 3 character prefix queries on the index
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+        prompt, caption,
+        content = 'posts', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """)
+    conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+    for trigger in _POSTS_FTS_TRIGGERS:
+        conn.execute(trigger)
+
+_USERS_FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, email) VALUES (NEW.id, NEW.username, NEW.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, email) VALUES ('delete', OLD.id, OLD.username, OLD.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, email ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, email) VALUES ('delete', OLD.id, OLD.username, OLD.email);
+        INSERT INTO users_fts (rowid, username, email) VALUES (NEW.id, NEW.username, NEW.email);
+    END
+    """,
+)
+
+def _add_user_search(conn: sqlite3.Connection):
+    # Case-insensitive username prefixes for typeahead
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)")
+
+    # Substring matches anywhere in a username or email
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, email,
+        content = 'users', content_rowid = 'id',
+        tokenize = 'trigram'
+    )
+    """)
+    conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    for trigger in _USERS_FTS_TRIGGERS:
+        conn.execute(trigger)
+
+def _add_timelines(conn: sqlite3.Connection):
+    # Materialized home feeds; the key is the feed order, so a page is one
+    # range of the primary key
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS timeline (
+        user_id INTEGER NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        post_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, created_at, post_id)
+    ) WITHOUT ROWID
+    """)
+    # Removing a deleted post from every timeline it was copied to
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timeline_post ON timeline (post_id)")
+    # Finding the accounts large enough to be merged into feeds on read
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_follower_count ON users (follower_count)")
+
+    # Start every timeline with the newest 800 posts (the default
+    # TIMELINE_LENGTH) by the user and everyone they follow
+    conn.execute("""
+    INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+    SELECT user_id, created_at, post_id FROM (
+        SELECT user_id, created_at, post_id,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, post_id DESC) AS position
+        FROM (
+            SELECT f.follower_id AS user_id, p.created_at, p.id AS post_id
+            FROM followers f JOIN posts p ON p.user_id = f.followed_id
+            UNION ALL
+            SELECT user_id, created_at, id FROM posts
+        )
+        WHERE created_at IS NOT NULL
+    )
+    WHERE position <= 800
+    """)
+
+# Ordered schema changes. Append new steps at the end and never edit or
+# renumber one that has shipped; each step runs once per database.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "Create users, posts, followers and likes tables", _create_base_tables),
+    (2, "Add image store columns and image_variants", _add_image_store),
+    (3, "Add secondary indexes for feeds, profiles and counts", _add_secondary_indexes),
+    (4, "Add like, follower, following and post counters", _add_counters),
+    (5, "Add indexes for paging follow lists and liked posts", _add_pagination_indexes),
+    (6, "Add the trending score table", _add_trending),
+    (7, "Add the full-text index over post prompts and captions", _add_posts_fts),
+    (8, "Add the username prefix and trigram indexes for user search", _add_user_search),
+    (9, "Add materialized home timelines", _add_timelines),
+]
+
+def current_version(conn: sqlite3.Connection) -> int:
+    """Highest migration applied to the database, 0 for a new one."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(path: str = DATABASE_PATH) -> int:
+    """
+    Bring the database schema up to date.
+
+    Runs under BEGIN IMMEDIATE, so when several workers start at once the
+    first one migrates while the others wait for the lock and then find
+    nothing left to do. A failing step rolls back every step of the run.
+    Returns the resulting schema version.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        version = current_version(conn)
+
+        for step_version, description, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            started = time.perf_counter()
+            step(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (step_version, description)
+            )
+            version = step_version
+            print(f"Applied migration {step_version}: {description} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+
+        conn.execute("COMMIT")
+        return version
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def hot_queries() -> Dict[str, Tuple[str, tuple]]:
+    """
+    Queries on the request path that must be served from an index.
+
+    Built from the statements the SQLite repository, the image store and
+    the thumbnail lookup actually run, so the check cannot drift from the
+    served SQL. Parameters are placeholders; only the plan matters.
+    Queries that may walk an index in order are listed in ORDERED_WALKS.
+    """
+    # Imported here because those modules import database, which imports
+    # this module to run the migrations
+    from repositories import sqlite as queries
+    from derivatives import variants_query
+    from storage import IMAGE_REFERENCE_QUERY
+    from timelines import FANOUT_BATCH_SIZE, TIMELINE_LENGTH, TIMELINE_MERGE_FOLLOWERS
+    from social_graph import LOAD_CHUNK_SIZE
+
+    created = "2024-01-01 00:00:00"
+    page = 25
+    return {
+        "explore latest": queries.explore_query("latest", None, 1, [created, 100], page),
+        "explore popular": queries.explore_query("popular", None, 1, [5, created, 100], page),
+        "explore trending": queries.explore_query("trending", None, 1, [2.5, 100], page, epoch=0.0),
+        "explore category": queries.explore_query("latest", '"landscape"*', 1, [created, 100], page),
+        "explore category popular": queries.explore_query("popular", '"landscape"*', 1, [5, created, 100], page),
+        "explore category trending": queries.explore_query("trending", '"landscape"*', 1, [2.5, 100], page, epoch=0.0),
+        "post batch": (queries.POST_BATCH_QUERY, (1, "[3, 1, 2]")),
+        "user posts": queries.user_posts_query(1, 1, [created, 100], page),
+        "single post": queries.post_query(1, 1),
+        "feed": queries.feed_query(1, [2], [created, 100], page),
+        "feed merged accounts": (queries.MERGED_ACCOUNTS_QUERY, (TIMELINE_MERGE_FOLLOWERS, 1)),
+        "timeline fan-out": (queries.FAN_OUT_FOLLOWERS_QUERY, (1, 0, FANOUT_BATCH_SIZE)),
+        "timeline trim": (queries.TIMELINE_TRIM_QUERY, (1, 1, TIMELINE_LENGTH)),
+        "timeline delete": (queries.TIMELINE_DELETE_POST_QUERY, (1,)),
+        "liked posts": queries.liked_posts_query(1, [created, 100], page),
+        "profile": (queries.USER_BY_USERNAME_QUERY, ("alice",)),
+        "follow list users": (queries.USERS_BY_ID_QUERY, ("[1, 2, 3]",)),
+        "social graph load": (queries.FOLLOW_EDGES_QUERY, (1, 1, LOAD_CHUNK_SIZE)),
+        "post search": queries.post_search_query('"cat"*', 1, [1.5, 100], page),
+        "user search": queries.user_search_query("ann", 20),
+        "like toggle": (queries.LIKE_LOOKUP_QUERY, (1, 1)),
+        "like count": (queries.LIKE_COUNT_QUERY, (1,)),
+        "image references": (IMAGE_REFERENCE_QUERY, ("0" * 64,)),
+        "thumbnails": variants_query(["0" * 64, "1" * 64]),
+    }
+
+# The unfiltered explore tabs walk their sort index in order and stop after
+# LIMIT rows (ORDER BY ... LIMIT), which is only cheap without a filter, so
+# this is allowed per query and not for any query touching the index
+ORDERED_WALKS = {
+    "explore latest": "idx_posts_created",
+    "explore popular": "idx_posts_popular",
+    "explore trending": "idx_trending_score",
+}
+
+_SCAN = re.compile(r"^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?$")
+
+def full_scans(conn: sqlite3.Connection, sql: str, params: tuple, ordered_index: Optional[str] = None) -> List[str]:
+    """
+    Plan steps of a query that read a whole table or index.
+
+    A scan through ordered_index is allowed, since with a LIMIT it stops
+    after the first rows, and so is reading back a materialized subquery,
+    whose own steps are checked.
+    """
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    materialized = {row[3].split()[1] for row in plan if row[3].startswith("MATERIALIZE ")}
+    scans = []
+    for row in plan:
+        match = _SCAN.match(row[3])
+        if match and match.group(1) != "CONSTANT" and match.group(1) not in materialized and (ordered_index is None or match.group(2) != ordered_index):
+            scans.append(row[3])
+    return scans
+
+def check(path: Optional[str] = None) -> bool:
+    """
+    Verify that no hot query needs a full scan.
+
+    Without a path the schema is built in a scratch database, so the plans
+    are the ones SQLite picks without table statistics, as in production.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        path = path or os.path.join(scratch, "check.db")
+        migrate(path)
+        conn = sqlite3.connect(path)
+        ok = True
+        try:
+            for name, (sql, params) in hot_queries().items():
+                scans = full_scans(conn, sql, params, ORDERED_WALKS.get(name))
+                if scans:
+                    ok = False
+                    print(f"FAIL {name}: {'; '.join(scans)}")
+                else:
+                    print(f"ok   {name}")
+        finally:
+            conn.close()
+    return ok
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    path = sys.argv[2] if len(sys.argv) > 2 else None
+
+    if command == "migrate":
+        print(f"Schema version {migrate(path or DATABASE_PATH)}")
+    elif command == "check":
+        sys.exit(0 if check(path) else 1)
+    else:
+        print("Usage: python migrations.py migrate|check [database]")
+        sys.exit(1)
@@ -31,18 +31,32 @@ class UserProfile(User):
     following_count: int = 0
     post_count: int = 0
     is_following: bool = False
+    follows_you: bool = False
 
 class PostBase(BaseModel):
     prompt: str
     caption: Optional[str] = None
 
 class PostCreate(PostBase):
-    pass
+    # Token from generate-preview; publishes that image instead of generating one
+    preview_token: Optional[str] = None
+    # Generate a new variation instead of reusing a recent image of the same prompt
+    fresh: bool = False
+
+class PreviewCreate(PostCreate):
+    # Images to generate in one batched call and choose between
+    variants: int = Field(1, ge=1)
+
+class GenerationJobCreate(PreviewCreate):
+    # Publish the image as a post when it is ready, instead of only previewing it
+    publish: bool = False
 
 class Post(PostBase):
     id: int
     user_id: int
-    image_data: str
+    image_data: Optional[str] = None
+    image_hash: Optional[str] = None
+    image_url: Optional[str] = None
     created_at: datetime
     like_count: int = 0
     liked_by_user: bool = False
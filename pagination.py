@@ -0,0 +1,85 @@
+import base64
+import binascii
+import json
+import os
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Response, status
+
+# Page size used when a list endpoint is called without ?limit=
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "24"))
+
+# Largest ?limit= a client may ask for
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "100"))
+
+# Response header carrying the cursor of the next page; absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def page_size(limit: Optional[int], default: int = DEFAULT_PAGE_SIZE) -> int:
+    """Clamp a requested page size to 1..MAX_PAGE_SIZE."""
+    if limit is None:
+        return min(default, MAX_PAGE_SIZE)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def encode_cursor(key: list) -> str:
+    """Pack the sort key of the last row of a page into an opaque token."""
+    raw = json.dumps(key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _cursor_value_ok(value, expected: type) -> bool:
+    # bool is an int subclass, and a float column can hold whole numbers
+    if isinstance(value, bool):
+        return False
+    if expected is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, expected)
+
+def decode_cursor(cursor: Optional[str], types: Sequence[type]) -> Optional[list]:
+    """
+    Unpack a token made by encode_cursor(); 400 if it was tampered with.
+
+    types gives the expected type of each element of the key, so a cursor
+    with the right length but the wrong values never reaches the query.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(raw)
+    except (binascii.Error, ValueError):
+        key = None
+    if (
+        not isinstance(key, list)
+        or len(key) != len(types)
+        or not all(_cursor_value_ok(value, expected) for value, expected in zip(key, types))
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return key
+
+def keyset_condition(columns: List[str]) -> str:
+    """
+    WHERE clause selecting the rows after a cursor in a descending sort.
+
+    Compares row values, so SQLite can seek straight to the position in an
+    index on the same columns instead of skipping over earlier rows.
+    """
+    placeholders = ", ".join("?" for _ in columns)
+    return f"({', '.join(columns)}) < ({placeholders})"
+
+def paginate(rows: list, limit: int, key: Callable[[dict], list], response: Response) -> Tuple[List, Optional[str]]:
+    """
+    Trim a page fetched with LIMIT limit + 1 and set the next-page header.
+
+    The extra row only tells whether another page exists; the cursor is
+    the key of the last row actually returned.
+    """
+    rows = list(rows)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key(rows[-1]))
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows, next_cursor
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+from fastapi import HTTPException, status
+
+# bcrypt cost factor for new hashes; each step doubles the work. Stored
+# hashes with another cost are replaced on the user's next login.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+
+# Threads doing bcrypt work; bcrypt releases the GIL while it runs
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", "2"))
+
+# Hashes and checks queued or running at once before new ones get a 503
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", "32"))
+
+class _Timing:
+    """Count, mean and max of one duration."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+_executor: Optional[ThreadPoolExecutor] = None
+_in_flight = 0
+_queue_wait = _Timing()
+_compute = _Timing()
+_counts = {"hashes": 0, "checks": 0, "rehashes": 0, "rejected": 0, "max_in_flight": 0}
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+    return _executor
+
+def shutdown_executor():
+    """Stop the bcrypt threads, called on app shutdown."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def _timed(submitted: float, fn, *args):
+    # Runs on a bcrypt thread
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, started - submitted, time.perf_counter() - started
+
+async def _run(fn, *args):
+    global _in_flight
+    if _in_flight >= PASSWORD_QUEUE_LIMIT:
+        _counts["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign-ins at once, please try again",
+            headers={"Retry-After": "1"},
+        )
+
+    _in_flight += 1
+    _counts["max_in_flight"] = max(_counts["max_in_flight"], _in_flight)
+    try:
+        loop = asyncio.get_running_loop()
+        result, waited, took = await loop.run_in_executor(_get_executor(), _timed, time.perf_counter(), fn, *args)
+    finally:
+        _in_flight -= 1
+
+    _queue_wait.record(waited)
+    _compute.record(took)
+    return result
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+async def hash_password(password: str) -> str:
+    """bcrypt hash of a password at BCRYPT_ROUNDS, computed off the event loop."""
+    _counts["hashes"] += 1
+    hashed = await _run(_hash, password.encode("utf-8"), BCRYPT_ROUNDS)
+    return hashed.decode("utf-8")
+
+async def check_password(password: str, hashed: str) -> bool:
+    """Whether a password matches a stored hash, checked off the event loop."""
+    _counts["checks"] += 1
+    return await _run(bcrypt.checkpw, password.encode("utf-8"), hashed.encode("utf-8"))
+
+def needs_rehash(hashed: str) -> bool:
+    """Whether a stored hash uses another cost than BCRYPT_ROUNDS."""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def record_rehash():
+    _counts["rehashes"] += 1
+
+def password_stats() -> dict:
+    """Queue and timing counters for /api/metrics."""
+    return {
+        "rounds": BCRYPT_ROUNDS,
+        "workers": PASSWORD_WORKERS,
+        "queue_limit": PASSWORD_QUEUE_LIMIT,
+        "in_flight": _in_flight,
+        **_counts,
+        "queue_wait": _queue_wait.as_dict(),
+        "compute": _compute.as_dict(),
+    }
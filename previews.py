@@ -0,0 +1,111 @@
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+
+# Memory given to generated previews waiting to be published, per worker;
+# the oldest are dropped past it
+PREVIEW_STORE_BYTES = int(os.environ.get("PREVIEW_STORE_MB", "256")) * 1024 * 1024
+
+# How long a preview can be published after it was generated
+PREVIEW_TTL = float(os.environ.get("PREVIEW_TTL", "1800"))  # seconds
+
+class PreviewStore:
+    """
+    Generated images waiting to be published, keyed by an opaque token.
+
+    generate_preview stores its image here and hands the token to the
+    client, which sends it back with create_post so the image the user
+    saw is published without generating another one. A token only works
+    for the user it was issued to, and only once: publishing takes it out
+    of the store before anything is saved.
+    """
+
+    def __init__(self, max_bytes: int = PREVIEW_STORE_BYTES, ttl: float = PREVIEW_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # token -> (expiry on the monotonic clock, user id, prompt, image), oldest first
+        self._previews: "OrderedDict[str, Tuple[float, int, str, str]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {"stored": 0, "hits": 0, "misses": 0, "expirations": 0, "evictions": 0, "restored": 0, "generated_on_publish": 0}
+
+    def _drop(self, token: str):
+        _, _, _, image_data = self._previews.pop(token)
+        self._bytes -= len(image_data)
+
+    def _expire(self):
+        # Entries share one TTL, so the oldest expire first
+        now = time.monotonic()
+        while self._previews:
+            token, (expires, _, _, _) = next(iter(self._previews.items()))
+            if expires > now:
+                break
+            self._drop(token)
+            self._stats["expirations"] += 1
+
+    def _store(self, token: str, user_id: int, prompt: str, image_data: str):
+        self._previews[token] = (time.monotonic() + self.ttl, user_id, prompt, image_data)
+        self._bytes += len(image_data)
+
+        while self._bytes > self.max_bytes and len(self._previews) > 1:
+            self._drop(next(iter(self._previews)))
+            self._stats["evictions"] += 1
+
+    def put(self, user_id: int, prompt: str, image_data: str) -> str:
+        """Keep a generated image for its user and return its token."""
+        self._expire()
+        token = secrets.token_urlsafe(16)
+        self._store(token, user_id, prompt, image_data)
+        self._stats["stored"] += 1
+        return token
+
+    def pop(self, token: str, user_id: int, prompt: str) -> str:
+        """
+        Take a user's preview of prompt out of the store and return its image.
+
+        Runs without awaiting, so of two requests publishing the same token
+        only the first gets the image. 410 if it expired, was already taken
+        or is not theirs; 400, leaving it in place, if it is of another prompt.
+        """
+        self._expire()
+        entry = self._previews.get(token)
+        if entry is None or entry[1] != user_id:
+            self._stats["misses"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_410_GONE,
+                detail="Preview expired, please generate the image again"
+            )
+        if entry[2] != prompt:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The preview was generated from a different prompt"
+            )
+        self._drop(token)
+        self._stats["hits"] += 1
+        return entry[3]
+
+    def restore(self, token: str, user_id: int, prompt: str, image_data: str):
+        """Put back a preview taken by pop() when publishing it failed, with a fresh TTL."""
+        self._expire()
+        self._store(token, user_id, prompt, image_data)
+        self._stats["restored"] += 1
+
+    def record_generated(self):
+        """Count a post published from a fresh generation instead of a preview."""
+        self._stats["generated_on_publish"] += 1
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "entries": len(self._previews),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+preview_store = PreviewStore()
@@ -0,0 +1,21 @@
+import os
+
+from repositories.base import Repository, UserRepository, PostRepository, LikeRepository, FollowerRepository, TimelineRepository
+
+# Where users, posts, likes and followers live: "sqlite" or "postgres"
+DATABASE_BACKEND = os.environ.get("DATABASE_BACKEND", "sqlite")
+
+# asyncpg connection string, used with DATABASE_BACKEND=postgres
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgresql://localhost/imageshare")
+
+def create_repository(backend: str = DATABASE_BACKEND) -> Repository:
+    """Build the repository for a backend; asyncpg is only needed for postgres."""
+    if backend == "sqlite":
+        from repositories.sqlite import SQLiteRepository
+        return SQLiteRepository()
+    if backend == "postgres":
+        from repositories.postgres import PostgresRepository
+        return PostgresRepository(DATABASE_URL)
+    raise ValueError(f"Unknown DATABASE_BACKEND: {backend}")
+
+repository = create_repository()
@@ -0,0 +1,192 @@
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+# List methods take the decoded cursor of the previous page as key (None
+# for the first page) and return up to limit rows as dicts, sorted
+# descending by the fields the cursor is built from. Handlers fetch
+# limit + 1 rows and hand them to pagination.paginate().
+#
+# Writes run in one transaction each and raise HTTPException for the
+# same conditions the handlers used to check themselves.
+
+class UserRepository(ABC):
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[dict]:
+        """A user row by id, None if there is none."""
+
+    @abstractmethod
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        """A user row by username, None if there is none."""
+
+    @abstractmethod
+    async def get_many(self, user_ids: List[int]) -> List[dict]:
+        """Public fields of the users among user_ids that exist, in no particular order."""
+
+    @abstractmethod
+    async def create(self, username: str, email: str, password_hash: str) -> dict:
+        """Insert a user; 400 if the username or email is taken."""
+
+    @abstractmethod
+    async def update(self, user_id: int, fields: dict) -> dict:
+        """Set some of email, bio and password and return the updated row."""
+
+    @abstractmethod
+    async def search(self, query: str, limit: int) -> List[dict]:
+        """
+        Users matching query: exact username, then username prefix, then
+        username or email containing it, ties broken by follower count.
+        """
+
+class FollowerRepository(ABC):
+    # Follow lists and checks are answered by social_graph.py, which
+    # loads the table through edges() and is told about every toggle
+
+    @abstractmethod
+    async def toggle(self, follower_id: int, followed_id: int, followed_at: int) -> str:
+        """
+        Follow or unfollow; returns "followed" or "unfollowed", 404 for an
+        unknown user. A new follow is recorded at followed_at (Unix time).
+        """
+
+    @abstractmethod
+    async def edges(self, after: Tuple[int, int], limit: int) -> List[Tuple[int, int, int]]:
+        """
+        Up to limit (follower_id, followed_id, followed_at) rows after the
+        pair after, in (follower_id, followed_id) order; followed_at is Unix time.
+        """
+
+class PostRepository(ABC):
+    # Row fields each explore sort is keyed on, the trending one starting
+    # with the epoch its scores are relative to
+    EXPLORE_KEYS = {
+        "latest": ["created_at", "id"],
+        "popular": ["like_count", "created_at", "id"],
+        "trending": ["trending_epoch", "trending_score", "id"],
+    }
+
+    # Types of the EXPLORE_KEYS fields, checked when a cursor is decoded
+    EXPLORE_KEY_TYPES = {
+        "latest": (str, int),
+        "popular": (int, str, int),
+        "trending": (float, float, int),
+    }
+
+    @abstractmethod
+    async def get(self, post_id: int, viewer_id: Optional[int]) -> Optional[dict]:
+        """A full post row with username and liked_by_user, None if there is none."""
+
+    @abstractmethod
+    async def get_many(self, post_ids: List[int], viewer_id: Optional[int]) -> List[dict]:
+        """Summaries of the posts among post_ids that exist, in no particular order."""
+
+    @abstractmethod
+    async def create(self, user_id: int, prompt: str, caption: Optional[str], image: dict) -> int:
+        """Insert a post for an image already in the blob store and give it a trending score."""
+
+    @abstractmethod
+    async def delete(self, post_id: int, user_id: int) -> List[str]:
+        """
+        Delete one of user_id's posts, 404 if there is no such post.
+
+        Returns the blobs that became unreferenced, for storage.delete_blobs().
+        """
+
+    @abstractmethod
+    async def references_image(self, image_hash: str) -> bool:
+        """Whether any post still uses an image."""
+
+    @abstractmethod
+    async def by_user(self, user_id: int, viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        """Summaries of a user's posts; sorted by (created_at, id)."""
+
+    @abstractmethod
+    async def feed(self, user_id: int, key: Optional[list], limit: int) -> List[dict]:
+        """
+        Summaries of posts by user_id and everyone they follow; sorted by (created_at, id).
+
+        Reads the materialized timeline, merged with the latest posts of
+        followed accounts that have at least TIMELINE_MERGE_FOLLOWERS.
+        """
+
+    @abstractmethod
+    async def explore(self, sort: str, category: Optional[str], viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        """
+        Summaries for the explore tabs, sorted by EXPLORE_KEYS[sort].
+
+        category is free text the prompt or caption must match. A trending
+        key from before a rebase is converted to the current epoch.
+        """
+
+    @abstractmethod
+    async def search(self, text: str, viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        """
+        Summaries matching text with prompt_snippet and caption_snippet,
+        matches wrapped in search.MATCH_START/MATCH_END; sorted by
+        (relevance, id). Empty if text has nothing searchable.
+        """
+
+    @abstractmethod
+    async def trending_state(self) -> Tuple[float, float]:
+        """Current (epoch, half_life in seconds) of the trending scores."""
+
+    @abstractmethod
+    async def trending(self, limit: int) -> List[dict]:
+        """Top trending posts with the inputs behind their scores."""
+
+    @abstractmethod
+    async def rebuild_trending(self, half_life: float) -> Optional[int]:
+        """
+        Recompute all trending scores if they were built with another half-life.
+
+        Returns the number of posts scored, None if nothing needed doing.
+        """
+
+    @abstractmethod
+    async def rebase_trending(self, now: float) -> int:
+        """Move the trending epoch to now; returns how many posts dropped out."""
+
+class LikeRepository(ABC):
+    @abstractmethod
+    async def toggle(self, user_id: int, post_id: int) -> Tuple[str, int]:
+        """Like or unlike; returns ("liked" or "unliked", like_count), 404 for an unknown post."""
+
+    @abstractmethod
+    async def liked_posts(self, user_id: int, key: Optional[list], limit: int) -> List[dict]:
+        """Summaries of posts user_id liked, with liked_at; sorted by (liked_at, id)."""
+
+class TimelineRepository(ABC):
+    # Home timelines hold (user_id, created_at, post_id) entries. New posts
+    # go to their author's timeline right away and to the followers' in
+    # the background; follows, unfollows and deletes keep them in step.
+
+    @abstractmethod
+    async def fan_out(self, post_id: int, after_user_id: int, limit: int) -> Tuple[List[int], int]:
+        """
+        Add a post to the timelines of the next limit followers of its author
+        with ids above after_user_id.
+
+        Returns the follower ids reached in ascending order, empty once
+        there are no more, and the number of entries written.
+        """
+
+    @abstractmethod
+    async def trim(self, user_ids: List[int], length: int) -> int:
+        """Cut the timelines of user_ids down to length entries; returns how many were removed."""
+
+class Repository(ABC):
+    """All data access of the app, for one storage backend."""
+
+    name: str
+    users: UserRepository
+    posts: PostRepository
+    likes: LikeRepository
+    followers: FollowerRepository
+    timelines: TimelineRepository
+
+    @abstractmethod
+    async def open(self):
+        """Connect and bring the schema up to date."""
+
+    @abstractmethod
+    async def close(self):
+        """Release the connections."""
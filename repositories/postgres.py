@@ -0,0 +1,762 @@
+import itertools
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import asyncpg
+from fastapi import HTTPException, status
+
+from database import write_queue
+from pagination import keyset_condition
+from storage import release_image, IMAGE_REFERENCE_QUERY
+from timelines import TIMELINE_MERGE_FOLLOWERS, FOLLOW_BACKFILL_POSTS
+from trending import rescale, LIKE_WEIGHT, POST_WEIGHT, TRENDING_MIN_SCORE, TRENDING_HALF_LIFE_HOURS
+from search import (
+    tsquery, MATCH_START, MATCH_END, PROMPT_WEIGHT, CAPTION_WEIGHT, SNIPPET_TOKENS, USER_SEARCH_CANDIDATES
+)
+from repositories.base import Repository, UserRepository, FollowerRepository, PostRepository, LikeRepository, TimelineRepository
+
+# Connections kept open to the server
+POSTGRES_POOL_SIZE = int(os.environ.get("POSTGRES_POOL_SIZE", "10"))
+
+# Serializes schema setup when several app processes start at once
+_SCHEMA_LOCK_ID = 0x696d6773
+
+# Same tables as the SQLite schema, minus the legacy inline image column.
+# Timestamps are UTC with whole seconds like SQLite's CURRENT_TIMESTAMP, so
+# cursors look the same with either backend. Needs PostgreSQL 14 or newer.
+SCHEMA = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        bio TEXT,
+        created_at TIMESTAMP(0) NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        follower_count INTEGER NOT NULL DEFAULT 0,
+        following_count INTEGER NOT NULL DEFAULT 0,
+        post_count INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        prompt TEXT NOT NULL,
+        caption TEXT,
+        image_hash TEXT,
+        image_size INTEGER,
+        image_mime TEXT,
+        created_at TIMESTAMP(0) NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        like_count INTEGER NOT NULL DEFAULT 0,
+        search TSVECTOR GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', prompt), 'B') ||
+            setweight(to_tsvector('simple', coalesce(caption, '')), 'A')
+        ) STORED
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS followers (
+        follower_id INTEGER NOT NULL REFERENCES users (id),
+        followed_id INTEGER NOT NULL REFERENCES users (id),
+        created_at TIMESTAMP(0) NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        PRIMARY KEY (follower_id, followed_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS likes (
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+        created_at TIMESTAMP(0) NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        PRIMARY KEY (user_id, post_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS timeline (
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        created_at TIMESTAMP(0) NOT NULL,
+        post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_id, created_at, post_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS post_trending (
+        post_id INTEGER PRIMARY KEY REFERENCES posts (id) ON DELETE CASCADE,
+        score DOUBLE PRECISION NOT NULL,
+        engagement INTEGER NOT NULL,
+        updated_at DOUBLE PRECISION NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS trending_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        epoch DOUBLE PRECISION NOT NULL,
+        half_life DOUBLE PRECISION NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_posts_user_created ON posts (user_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_posts_created ON posts (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_posts_popular ON posts (like_count, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_posts_image_hash ON posts (image_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_posts_search ON posts USING gin (search)",
+    "CREATE INDEX IF NOT EXISTS idx_likes_post ON likes (post_id)",
+    "CREATE INDEX IF NOT EXISTS idx_likes_user_created ON likes (user_id, created_at, post_id)",
+    "CREATE INDEX IF NOT EXISTS idx_followers_followed_created ON followers (followed_id, created_at, follower_id)",
+    "CREATE INDEX IF NOT EXISTS idx_followers_follower_created ON followers (follower_id, created_at, followed_id)",
+    "CREATE INDEX IF NOT EXISTS idx_trending_score ON post_trending (score, post_id)",
+    "CREATE INDEX IF NOT EXISTS idx_followers_followed ON followers (followed_id, follower_id)",
+    "CREATE INDEX IF NOT EXISTS idx_timeline_post ON timeline (post_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_follower_count ON users (follower_count)",
+    # Typeahead: prefixes off a C-collated index, substrings off trigrams
+    'CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users ((lower(username) COLLATE "C"))',
+    "CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON users USING gin (email gin_trgm_ops)",
+    # Counters kept exact by triggers, as in the SQLite schema
+    """
+    CREATE OR REPLACE FUNCTION likes_count() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+        ELSE
+            UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION followers_count() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE users SET follower_count = follower_count + 1 WHERE id = NEW.followed_id;
+            UPDATE users SET following_count = following_count + 1 WHERE id = NEW.follower_id;
+        ELSE
+            UPDATE users SET follower_count = follower_count - 1 WHERE id = OLD.followed_id;
+            UPDATE users SET following_count = following_count - 1 WHERE id = OLD.follower_id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION posts_count() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE users SET post_count = post_count + 1 WHERE id = NEW.user_id;
+        ELSE
+            UPDATE users SET post_count = post_count - 1 WHERE id = OLD.user_id;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    "CREATE OR REPLACE TRIGGER likes_count AFTER INSERT OR DELETE ON likes FOR EACH ROW EXECUTE FUNCTION likes_count()",
+    "CREATE OR REPLACE TRIGGER followers_count AFTER INSERT OR DELETE ON followers FOR EACH ROW EXECUTE FUNCTION followers_count()",
+    "CREATE OR REPLACE TRIGGER posts_count AFTER INSERT OR DELETE ON posts FOR EACH ROW EXECUTE FUNCTION posts_count()",
+)
+
+# Fills the timelines of a database created before they existed, like
+# migration 9 of the SQLite schema
+TIMELINE_BACKFILL = """
+    INSERT INTO timeline (user_id, created_at, post_id)
+    SELECT user_id, created_at, post_id FROM (
+        SELECT user_id, created_at, post_id,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, post_id DESC) AS position
+        FROM (
+            SELECT f.follower_id AS user_id, p.created_at, p.id AS post_id
+            FROM followers f JOIN posts p ON p.user_id = f.followed_id
+            UNION
+            SELECT user_id, created_at, id FROM posts
+        ) entries
+    ) ranked
+    WHERE position <= 800
+"""
+
+# Columns selected by list endpoints, matching serializers.POST_SUMMARY_COLUMNS
+POST_SUMMARY_COLUMNS = """
+    p.id, p.user_id, p.prompt, p.caption, p.created_at, p.like_count, p.image_hash,
+    NULL AS image_data
+"""
+
+LIKED_BY_USER = "EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?) AS liked_by_user"
+
+# ts_headline() settings giving snippets like SQLite's snippet()
+HEADLINE_OPTIONS = (
+    f'StartSel="{MATCH_START}", StopSel="{MATCH_END}", '
+    f"MaxWords={SNIPPET_TOKENS}, MinWords={max(SNIPPET_TOKENS // 2, 1)}"
+)
+
+# 2 ** (seconds between a timestamp column and an epoch / half-life),
+# clamped because PostgreSQL raises on float underflow
+DECAY_SQL = "power(2, GREATEST((extract(epoch FROM {column})::float8 - ?) / ?, -1000))"
+
+# Queries are written with SQLite's ? placeholders so they can share the
+# pagination helpers, and numbered for asyncpg right before running
+def _numbered(query: str) -> str:
+    counter = itertools.count(1)
+    return re.sub(r"\?", lambda _: f"${next(counter)}", query)
+
+def _row(record) -> dict:
+    row = dict(record)
+    for name, value in row.items():
+        if isinstance(value, datetime):
+            row[name] = value.isoformat(sep=" ")
+    return row
+
+def _timestamp(value) -> datetime:
+    return datetime.fromisoformat(value)
+
+def _key(key: Optional[list], *types) -> Optional[list]:
+    """Give cursor values the types asyncpg expects for their columns."""
+    if not key:
+        return key
+    try:
+        return [convert(value) for convert, value in zip(types, key)]
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+def _like_pattern(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class PostgresUserRepository(UserRepository):
+    def __init__(self, db: "PostgresRepository"):
+        self.db = db
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        return await self.db.fetch_one("SELECT * FROM users WHERE id = ?", user_id)
+
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        return await self.db.fetch_one("SELECT * FROM users WHERE username = ?", username)
+
+    async def get_many(self, user_ids: List[int]) -> List[dict]:
+        return await self.db.fetch(
+            "SELECT id, username, email, bio, created_at FROM users WHERE id = ANY(?::integer[])",
+            user_ids
+        )
+
+    async def create(self, username: str, email: str, password_hash: str) -> dict:
+        try:
+            return await self.db.fetch_one(
+                "INSERT INTO users (username, email, password) VALUES (?, ?, ?) RETURNING *",
+                username, email, password_hash
+            )
+        except asyncpg.UniqueViolationError as e:
+            field = "Username" if e.constraint_name == "users_username_key" else "Email"
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{field} already registered"
+            )
+
+    async def update(self, user_id: int, fields: dict) -> dict:
+        set_clause = ", ".join(f"{field} = ?" for field in fields)
+        try:
+            return await self.db.fetch_one(
+                f"UPDATE users SET {set_clause} WHERE id = ? RETURNING *",
+                *fields.values(), user_id
+            )
+        except asyncpg.UniqueViolationError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email already registered"
+            )
+
+    async def search(self, query: str, limit: int) -> List[dict]:
+        prefix = _like_pattern(query.lower()) + "%"
+
+        candidates = """
+            (SELECT id FROM users
+             WHERE lower(username) COLLATE "C" LIKE ?
+             ORDER BY lower(username) COLLATE "C"
+             LIMIT ?)
+        """
+        params = [prefix, USER_SEARCH_CANDIDATES]
+        # Trigram indexes need at least three characters, as in SQLite
+        if len(query) >= 3:
+            contains = "%" + _like_pattern(query) + "%"
+            candidates += """
+                UNION
+                (SELECT id FROM users WHERE username ILIKE ? OR email ILIKE ? LIMIT ?)
+            """
+            params.extend([contains, contains, USER_SEARCH_CANDIDATES])
+
+        return await self.db.fetch(f"""
+            SELECT u.id, u.username, u.email, u.bio, u.created_at, u.follower_count,
+                  CASE
+                      WHEN lower(u.username) = ? THEN 0
+                      WHEN lower(u.username) COLLATE "C" LIKE ? THEN 1
+                      ELSE 2
+                  END AS match_rank
+            FROM users u
+            WHERE u.id IN ({candidates})
+            ORDER BY match_rank, u.follower_count DESC, u.username
+            LIMIT ?
+        """, query.lower(), prefix, *params, limit)
+
+class PostgresFollowerRepository(FollowerRepository):
+    def __init__(self, db: "PostgresRepository"):
+        self.db = db
+
+    async def toggle(self, follower_id: int, followed_id: int, followed_at: int) -> str:
+        async with self.db.transaction() as conn:
+            if await conn.fetchval(_numbered("SELECT 1 FROM users WHERE id = ?"), followed_id) is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="User not found"
+                )
+
+            unfollowed = await conn.fetchval(_numbered(
+                "DELETE FROM followers WHERE follower_id = ? AND followed_id = ? RETURNING 1"
+            ), follower_id, followed_id)
+            if unfollowed:
+                await conn.execute(_numbered(
+                    "DELETE FROM timeline WHERE user_id = ? AND post_id IN (SELECT id FROM posts WHERE user_id = ?)"
+                ), follower_id, followed_id)
+                return "unfollowed"
+
+            await conn.execute(_numbered("""
+                INSERT INTO followers (follower_id, followed_id, created_at)
+                VALUES (?, ?, to_timestamp(?) AT TIME ZONE 'utc')
+                ON CONFLICT DO NOTHING
+            """), follower_id, followed_id, followed_at)
+            # Start the timeline off with what the account posted recently
+            await conn.execute(_numbered("""
+                INSERT INTO timeline (user_id, created_at, post_id)
+                SELECT ?::integer, created_at, id FROM posts
+                WHERE user_id = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+                ON CONFLICT DO NOTHING
+            """), follower_id, followed_id, FOLLOW_BACKFILL_POSTS)
+            return "followed"
+
+    async def edges(self, after: Tuple[int, int], limit: int) -> List[Tuple[int, int, int]]:
+        async with self.db.pool.acquire() as conn:
+            records = await conn.fetch(_numbered("""
+                SELECT follower_id, followed_id, extract(epoch FROM created_at)::bigint
+                FROM followers
+                WHERE (follower_id, followed_id) > (?, ?)
+                ORDER BY follower_id, followed_id
+                LIMIT ?
+            """), *after, limit)
+            return [tuple(record) for record in records]
+
+class PostgresPostRepository(PostRepository):
+    def __init__(self, db: "PostgresRepository"):
+        self.db = db
+
+    async def get(self, post_id: int, viewer_id: Optional[int]) -> Optional[dict]:
+        return await self.db.fetch_one(f"""
+            SELECT p.id, p.user_id, p.prompt, p.caption, p.image_hash, p.image_size, p.image_mime,
+                  p.created_at, p.like_count, u.username, {LIKED_BY_USER}
+            FROM posts p
+            JOIN users u ON p.user_id = u.id
+            WHERE p.id = ?
+        """, viewer_id, post_id)
+
+    async def get_many(self, post_ids: List[int], viewer_id: Optional[int]) -> List[dict]:
+        return await self.db.fetch(f"""
+            SELECT {POST_SUMMARY_COLUMNS}, u.username, l.user_id IS NOT NULL AS liked_by_user
+            FROM posts p
+            JOIN users u ON p.user_id = u.id
+            LEFT JOIN likes l ON l.post_id = p.id AND l.user_id = ?
+            WHERE p.id = ANY(?::integer[])
+        """, viewer_id, post_ids)
+
+    async def create(self, user_id: int, prompt: str, caption: Optional[str], image: dict) -> int:
+        async with self.db.transaction() as conn:
+            post_id = await conn.fetchval(_numbered(
+                "INSERT INTO posts (user_id, prompt, image_hash, image_size, image_mime, caption) VALUES (?, ?, ?, ?, ?, ?) RETURNING id"
+            ), user_id, prompt, image['image_hash'], image['image_size'], image['image_mime'], caption)
+            await self._add_score(conn, post_id, POST_WEIGHT, time.time(), 0)
+            # Followers get it from timelines.fan_out()
+            await conn.execute(_numbered(
+                "INSERT INTO timeline (user_id, created_at, post_id) SELECT user_id, created_at, id FROM posts WHERE id = ?"
+            ), post_id)
+            return post_id
+
+    async def delete(self, post_id: int, user_id: int) -> List[str]:
+        async with self.db.transaction() as conn:
+            post = await conn.fetchrow(_numbered(
+                "SELECT image_hash FROM posts WHERE id = ? AND user_id = ? FOR UPDATE"
+            ), post_id, user_id)
+            if not post:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Post not found or you don't have permission to delete it"
+                )
+
+            # Timeline entries go with the post through ON DELETE CASCADE
+            await conn.execute(_numbered("DELETE FROM likes WHERE post_id = ?"), post_id)
+            await conn.execute(_numbered("DELETE FROM posts WHERE id = ?"), post_id)
+
+            image_hash = post["image_hash"]
+            shared = image_hash and await conn.fetchval(_numbered(IMAGE_REFERENCE_QUERY), image_hash)
+
+        if not image_hash or shared:
+            return []
+        # Variants are tracked next to the blobs in the local database
+        return await write_queue.submit(release_image, image_hash)
+
+    async def references_image(self, image_hash: str) -> bool:
+        return await self.db.fetch_one(IMAGE_REFERENCE_QUERY, image_hash) is not None
+
+    async def by_user(self, user_id: int, viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        query = f"""
+            SELECT {POST_SUMMARY_COLUMNS}, u.username, {LIKED_BY_USER}
+            FROM posts p
+            JOIN users u ON p.user_id = u.id
+            WHERE p.user_id = ?
+        """
+        params = [viewer_id, user_id]
+        if key:
+            query += " AND " + keyset_condition(["p.created_at", "p.id"])
+            params.extend(_key(key, _timestamp, int))
+        query += " ORDER BY p.created_at DESC, p.id DESC LIMIT ?"
+        params.append(limit)
+        return await self.db.fetch(query, *params)
+
+    async def feed(self, user_id: int, key: Optional[list], limit: int) -> List[dict]:
+        key = _key(key, _timestamp, int)
+        async with self.db.pool.acquire() as conn:
+            # Followed accounts too large to have been fanned out
+            merged = await conn.fetch(_numbered("""
+                SELECT u.id FROM users u
+                WHERE u.follower_count >= ?
+                  AND EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id)
+            """), TIMELINE_MERGE_FOLLOWERS, user_id)
+
+            params = [user_id]
+
+            def newest(table: str, id_column: str, owner_id: int) -> str:
+                query = f"SELECT {id_column} AS post_id, created_at FROM {table} WHERE user_id = ?"
+                params.append(owner_id)
+                if key:
+                    query += " AND " + keyset_condition(["created_at", id_column])
+                    params.extend(key)
+                query += f" ORDER BY created_at DESC, {id_column} DESC LIMIT ?"
+                params.append(limit)
+                return f"({query})"
+
+            # One primary key range of the timeline, plus one index range
+            # of posts per merged account
+            sources = [newest("timeline", "post_id", user_id)]
+            sources.extend(newest("posts", "id", row["id"]) for row in merged)
+            params.append(limit)
+
+            records = await conn.fetch(_numbered(f"""
+                SELECT {POST_SUMMARY_COLUMNS}, u.username, {LIKED_BY_USER}
+                FROM ({" UNION ".join(sources)}) t
+                JOIN posts p ON p.id = t.post_id
+                JOIN users u ON p.user_id = u.id
+                ORDER BY t.created_at DESC, t.post_id DESC
+                LIMIT ?
+            """), *params)
+            return [_row(record) for record in records]
+
+    async def explore(self, sort: str, category: Optional[str], viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        async with self.db.transaction() as conn:
+            params = []
+            columns = f"{POST_SUMMARY_COLUMNS}, u.username"
+            tables = "posts p JOIN users u ON p.user_id = u.id"
+            if sort == "popular":
+                sort_columns = ["p.like_count", "p.created_at", "p.id"]
+                key = _key(key, int, _timestamp, int)
+            elif sort == "trending":
+                sort_columns = ["t.score", "t.post_id"]
+                key = _key(key, float, float, int)
+                epoch, half_life = await self._trending_state(conn)
+                if key:
+                    # Scores were rebased since the previous page; convert the cursor
+                    cursor_epoch = key.pop(0)
+                    key[0] = rescale(key[0], cursor_epoch, epoch, half_life)
+                columns += ", ?::float8 AS trending_epoch, t.score AS trending_score"
+                params.append(epoch)
+                tables = "post_trending t JOIN posts p ON p.id = t.post_id JOIN users u ON p.user_id = u.id"
+            else:
+                sort_columns = ["p.created_at", "p.id"]
+                key = _key(key, _timestamp, int)
+
+            query = f"SELECT {columns}, {LIKED_BY_USER} FROM {tables}"
+            params.append(viewer_id)
+
+            conditions = []
+            category_match = tsquery(category) if category else None
+            if category_match:
+                conditions.append("p.search @@ to_tsquery('simple', ?)")
+                params.append(category_match)
+
+            if key:
+                conditions.append(keyset_condition(sort_columns))
+                params.extend(key)
+
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY " + ", ".join(f"{column} DESC" for column in sort_columns) + " LIMIT ?"
+            params.append(limit)
+
+            return [_row(record) for record in await conn.fetch(_numbered(query), *params)]
+
+    async def search(self, text: str, viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        match = tsquery(text)
+        if match is None:
+            return []
+
+        # Weights are listed D, C, B, A and must be at most 1; the prompt is B and the caption A
+        top = max(PROMPT_WEIGHT, CAPTION_WEIGHT)
+        relevance = f"ts_rank('{{0, 0, {PROMPT_WEIGHT / top}, {CAPTION_WEIGHT / top}}}', p.search, q)"
+
+        query = f"""
+            SELECT {POST_SUMMARY_COLUMNS}, u.username, {relevance} AS relevance,
+                  ts_headline('simple', p.prompt, q, ?) AS prompt_snippet,
+                  ts_headline('simple', p.caption, q, ?) AS caption_snippet,
+                  {LIKED_BY_USER}
+            FROM posts p
+            CROSS JOIN to_tsquery('simple', ?) q
+            JOIN users u ON p.user_id = u.id
+            WHERE p.search @@ q
+        """
+        params = [HEADLINE_OPTIONS, HEADLINE_OPTIONS, viewer_id, match]
+        if key:
+            query += " AND " + keyset_condition([relevance, "p.id"])
+            params.extend(_key(key, float, int))
+        query += " ORDER BY relevance DESC, p.id DESC LIMIT ?"
+        params.append(limit)
+        return await self.db.fetch(query, *params)
+
+    async def _trending_state(self, conn: asyncpg.Connection) -> Tuple[float, float]:
+        row = await conn.fetchrow("SELECT epoch, half_life FROM trending_state WHERE id = 1")
+        if row is None:
+            return time.time(), TRENDING_HALF_LIFE_HOURS * 3600
+        return row["epoch"], row["half_life"]
+
+    async def _add_score(self, conn: asyncpg.Connection, post_id: int, weight: float, at: float, engagement: int):
+        # Same scheme as trending.py: events are weighted relative to the epoch
+        epoch, half_life = await self._trending_state(conn)
+        score = rescale(weight, at, epoch, half_life)
+        await conn.execute(_numbered("""
+            INSERT INTO post_trending (post_id, score, engagement, updated_at)
+            VALUES (?, GREATEST(?::float8, 0), GREATEST(?::integer, 0), ?)
+            ON CONFLICT (post_id) DO UPDATE SET
+                score = GREATEST(post_trending.score + ?, 0),
+                engagement = GREATEST(post_trending.engagement + ?, 0),
+                updated_at = excluded.updated_at
+        """), post_id, score, engagement, time.time(), score, engagement)
+
+    async def _remove_like_score(self, conn: asyncpg.Connection, post_id: int, liked_at: float):
+        # Only updates, so a post that dropped out of trending stays out
+        epoch, half_life = await self._trending_state(conn)
+        await conn.execute(_numbered("""
+            UPDATE post_trending
+            SET score = GREATEST(score - ?, 0), engagement = GREATEST(engagement - 1, 0), updated_at = ?
+            WHERE post_id = ?
+        """), rescale(LIKE_WEIGHT, liked_at, epoch, half_life), time.time(), post_id)
+
+    async def trending_state(self) -> Tuple[float, float]:
+        async with self.db.pool.acquire() as conn:
+            return await self._trending_state(conn)
+
+    async def trending(self, limit: int) -> List[dict]:
+        return await self.db.fetch("""
+            SELECT t.post_id, t.score, t.engagement, t.updated_at, p.like_count, p.created_at
+            FROM post_trending t
+            JOIN posts p ON p.id = t.post_id
+            ORDER BY t.score DESC
+            LIMIT ?
+        """, limit)
+
+    async def rebuild_trending(self, half_life: float) -> Optional[int]:
+        async with self.db.transaction() as conn:
+            current = await conn.fetchval("SELECT half_life FROM trending_state WHERE id = 1 FOR UPDATE")
+            if current == half_life:
+                return None
+
+            now = time.time()
+            await conn.execute("DELETE FROM post_trending")
+            await conn.execute(_numbered(f"""
+                INSERT INTO post_trending (post_id, score, engagement, updated_at)
+                SELECT p.id,
+                       ?::float8 * {DECAY_SQL.format(column="p.created_at")}
+                         + COALESCE(SUM(?::float8 * {DECAY_SQL.format(column="l.created_at")}), 0),
+                       COUNT(l.post_id),
+                       ?::float8
+                FROM posts p
+                LEFT JOIN likes l ON l.post_id = p.id
+                GROUP BY p.id
+            """), POST_WEIGHT, now, half_life, LIKE_WEIGHT, now, half_life, now)
+            await conn.execute(_numbered("DELETE FROM post_trending WHERE score < ?"), TRENDING_MIN_SCORE)
+            await conn.execute(_numbered("""
+                INSERT INTO trending_state (id, epoch, half_life) VALUES (1, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET epoch = excluded.epoch, half_life = excluded.half_life
+            """), now, half_life)
+            return await conn.fetchval("SELECT COUNT(*) FROM posts")
+
+    async def rebase_trending(self, now: float) -> int:
+        async with self.db.transaction() as conn:
+            epoch, half_life = await self._trending_state(conn)
+            factor = rescale(1.0, epoch, now, half_life)
+            # Drop what would decay below the threshold first; multiplying
+            # it down could underflow, which PostgreSQL reports as an error
+            threshold = TRENDING_MIN_SCORE / factor if factor > 0 else float("inf")
+            pruned = await conn.fetchval(_numbered("""
+                WITH dropped AS (DELETE FROM post_trending WHERE score < ? RETURNING 1)
+                SELECT COUNT(*) FROM dropped
+            """), threshold)
+            await conn.execute(_numbered("UPDATE post_trending SET score = score * ?"), factor)
+            await conn.execute(_numbered("UPDATE trending_state SET epoch = ? WHERE id = 1"), now)
+            return pruned
+
+class PostgresLikeRepository(LikeRepository):
+    def __init__(self, db: "PostgresRepository"):
+        self.db = db
+
+    async def toggle(self, user_id: int, post_id: int) -> Tuple[str, int]:
+        posts = self.db.posts
+        async with self.db.transaction() as conn:
+            if await conn.fetchval(_numbered("SELECT 1 FROM posts WHERE id = ?"), post_id) is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Post not found"
+                )
+
+            liked_at = await conn.fetchval(_numbered("""
+                DELETE FROM likes WHERE user_id = ? AND post_id = ?
+                RETURNING extract(epoch FROM created_at)::bigint
+            """), user_id, post_id)
+
+            if liked_at is not None:
+                await posts._remove_like_score(conn, post_id, liked_at)
+                action = "unliked"
+            else:
+                # The trending score uses the same timestamp as the row
+                liked_at = int(time.time())
+                inserted = await conn.fetchval(_numbered("""
+                    INSERT INTO likes (user_id, post_id, created_at)
+                    VALUES (?, ?, to_timestamp(?) AT TIME ZONE 'utc')
+                    ON CONFLICT DO NOTHING
+                    RETURNING 1
+                """), user_id, post_id, liked_at)
+                if inserted:
+                    await posts._add_score(conn, post_id, LIKE_WEIGHT, liked_at, 1)
+                action = "liked"
+
+            like_count = await conn.fetchval(_numbered("SELECT like_count FROM posts WHERE id = ?"), post_id)
+            return action, like_count
+
+    async def liked_posts(self, user_id: int, key: Optional[list], limit: int) -> List[dict]:
+        query = f"""
+            SELECT {POST_SUMMARY_COLUMNS}, u.username, l.created_at AS liked_at,
+                  TRUE AS liked_by_user
+            FROM likes l
+            JOIN posts p ON p.id = l.post_id
+            JOIN users u ON p.user_id = u.id
+            WHERE l.user_id = ?
+        """
+        params = [user_id]
+        if key:
+            query += " AND " + keyset_condition(["l.created_at", "l.post_id"])
+            params.extend(_key(key, _timestamp, int))
+        query += " ORDER BY l.created_at DESC, l.post_id DESC LIMIT ?"
+        params.append(limit)
+        return await self.db.fetch(query, *params)
+
+class PostgresTimelineRepository(TimelineRepository):
+    def __init__(self, db: "PostgresRepository"):
+        self.db = db
+
+    async def fan_out(self, post_id: int, after_user_id: int, limit: int) -> Tuple[List[int], int]:
+        async with self.db.transaction() as conn:
+            user_ids = await conn.fetch(_numbered("""
+                SELECT f.follower_id FROM posts p
+                JOIN followers f ON f.followed_id = p.user_id
+                WHERE p.id = ? AND f.follower_id > ?
+                ORDER BY f.follower_id
+                LIMIT ?
+            """), post_id, after_user_id, limit)
+            if not user_ids:
+                return [], 0
+
+            user_ids = [row["follower_id"] for row in user_ids]
+            written = await conn.fetchval(_numbered("""
+                WITH written AS (
+                    INSERT INTO timeline (user_id, created_at, post_id)
+                    SELECT follower_id, p.created_at, p.id
+                    FROM posts p, unnest(?::integer[]) AS follower_id
+                    WHERE p.id = ?
+                    ON CONFLICT DO NOTHING
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM written
+            """), user_ids, post_id)
+            return user_ids, written
+
+    async def trim(self, user_ids: List[int], length: int) -> int:
+        async with self.db.transaction() as conn:
+            removed = 0
+            for user_id in user_ids:
+                # Everything from the entry at position length onwards
+                removed += await conn.fetchval(_numbered("""
+                    WITH removed AS (
+                        DELETE FROM timeline WHERE user_id = ? AND (created_at, post_id) <= (
+                            SELECT created_at, post_id FROM timeline WHERE user_id = ?
+                            ORDER BY created_at DESC, post_id DESC
+                            LIMIT 1 OFFSET ?
+                        )
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) FROM removed
+                """), user_id, user_id, length)
+            return removed
+
+class PostgresRepository(Repository):
+    """
+    A PostgreSQL server reached through asyncpg.
+
+    Image blobs and their variants stay on local disk and in the SQLite
+    database next to them; only users, posts, likes and followers move.
+    """
+
+    name = "postgres"
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool: Optional[asyncpg.Pool] = None
+        self.users = PostgresUserRepository(self)
+        self.posts = PostgresPostRepository(self)
+        self.likes = PostgresLikeRepository(self)
+        self.followers = PostgresFollowerRepository(self)
+        self.timelines = PostgresTimelineRepository(self)
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=POSTGRES_POOL_SIZE)
+        async with self.transaction() as conn:
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK_ID)
+            new_timelines = await conn.fetchval("SELECT to_regclass('timeline') IS NULL")
+            for statement in SCHEMA:
+                await conn.execute(statement)
+            if new_timelines:
+                await conn.execute(TIMELINE_BACKFILL)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+
+    async def fetch(self, query: str, *params) -> List[dict]:
+        async with self.pool.acquire() as conn:
+            return [_row(record) for record in await conn.fetch(_numbered(query), *params)]
+
+    async def fetch_one(self, query: str, *params) -> Optional[dict]:
+        async with self.pool.acquire() as conn:
+            record = await conn.fetchrow(_numbered(query), *params)
+        return _row(record) if record else None
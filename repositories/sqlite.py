@@ -0,0 +1,563 @@
+import json
+import time
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from database import db_pool, write_queue
+from pagination import keyset_condition
+from serializers import POST_SUMMARY_COLUMNS
+from storage import release_image, IMAGE_REFERENCE_QUERY
+from timelines import TIMELINE_MERGE_FOLLOWERS, FOLLOW_BACKFILL_POSTS
+from trending import trending_state, rescale, record_post, record_like, record_unlike, rebase_scores, rebuild_scores
+from search import (
+    fts_query, snippet_sql, trigram_query, prefix_range,
+    MATCH_START, MATCH_END, PROMPT_WEIGHT, CAPTION_WEIGHT, USER_SEARCH_CANDIDATES
+)
+from repositories.base import Repository, UserRepository, FollowerRepository, PostRepository, LikeRepository, TimelineRepository
+
+# Reads go through db_pool, writes through write_queue, so the single
+# writer and group commit from database.py apply to every repository call
+
+# The statements below are also what `python migrations.py check` runs
+# EXPLAIN QUERY PLAN on, so the plan check always sees the SQL that is
+# actually served. Fixed statements are constants; the ones that depend
+# on the request are built by the *_query() functions, which return the
+# SQL together with its parameters.
+
+USER_BY_USERNAME_QUERY = "SELECT * FROM users WHERE username = ?"
+
+USERS_BY_ID_QUERY = """
+    SELECT id, username, email, bio, created_at FROM users
+    WHERE id IN (SELECT value FROM json_each(?))
+"""
+
+FOLLOW_EDGES_QUERY = """
+    SELECT follower_id, followed_id, COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+    FROM followers
+    WHERE (follower_id, followed_id) > (?, ?)
+    ORDER BY follower_id, followed_id
+    LIMIT ?
+"""
+
+# The ids go in as one JSON array so every batch size shares a
+# statement; the viewer's likes are one primary key probe per post
+POST_BATCH_QUERY = f"""
+    SELECT {POST_SUMMARY_COLUMNS}, u.username, l.user_id IS NOT NULL as liked_by_user
+    FROM posts p
+    JOIN users u ON p.user_id = u.id
+    LEFT JOIN likes l ON l.post_id = p.id AND l.user_id = ?
+    WHERE p.id IN (SELECT value FROM json_each(?))
+"""
+
+# Followed accounts too large to have been fanned out; a short range of
+# idx_users_follower_count
+MERGED_ACCOUNTS_QUERY = """
+    SELECT u.id FROM users u
+    WHERE u.follower_count >= ?
+      AND EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id)
+"""
+
+TIMELINE_DELETE_POST_QUERY = "DELETE FROM timeline WHERE post_id = ?"
+
+LIKE_LOOKUP_QUERY = "SELECT CAST(strftime('%s', created_at) AS INTEGER) FROM likes WHERE user_id = ? AND post_id = ?"
+
+LIKE_COUNT_QUERY = "SELECT like_count FROM posts WHERE id = ?"
+
+FAN_OUT_FOLLOWERS_QUERY = """
+    SELECT f.follower_id FROM posts p
+    JOIN followers f ON f.followed_id = p.user_id
+    WHERE p.id = ? AND f.follower_id > ?
+    ORDER BY f.follower_id
+    LIMIT ?
+"""
+
+# Everything from the entry at position length onwards
+TIMELINE_TRIM_QUERY = """
+    DELETE FROM timeline WHERE user_id = ? AND (created_at, post_id) <= (
+        SELECT created_at, post_id FROM timeline WHERE user_id = ?
+        ORDER BY created_at DESC, post_id DESC
+        LIMIT 1 OFFSET ?
+    )
+"""
+
+def _liked_by_user(viewer_id: Optional[int], params: list) -> str:
+    if viewer_id:
+        params.append(viewer_id)
+        return "(SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user"
+    return "0 as liked_by_user"
+
+def user_search_query(query: str, limit: int) -> Tuple[str, list]:
+    low, high = prefix_range(query)
+    match = trigram_query(query)
+
+    # Candidates: a username prefix range off idx_users_username_nocase,
+    # plus trigram substring matches when the query is long enough
+    candidates = """
+        SELECT id FROM (
+            SELECT id FROM users
+            WHERE username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE
+            ORDER BY username COLLATE NOCASE
+            LIMIT ?
+        )
+    """
+    params = [low, high, USER_SEARCH_CANDIDATES]
+    if match:
+        candidates += """
+            UNION
+            SELECT id FROM (SELECT rowid AS id FROM users_fts WHERE users_fts MATCH ? LIMIT ?)
+        """
+        params.extend([match, USER_SEARCH_CANDIDATES])
+
+    return f"""
+        SELECT u.id, u.username, u.email, u.bio, u.created_at, u.follower_count,
+              CASE
+                  WHEN u.username = ? COLLATE NOCASE THEN 0
+                  WHEN substr(u.username, 1, ?) = ? COLLATE NOCASE THEN 1
+                  ELSE 2
+              END as match_rank
+        FROM users u
+        WHERE u.id IN ({candidates})
+        ORDER BY match_rank, u.follower_count DESC, u.username
+        LIMIT ?
+    """, [query, len(query), query, *params, limit]
+
+def post_query(post_id: int, viewer_id: Optional[int]) -> Tuple[str, list]:
+    params = []
+    liked = _liked_by_user(viewer_id, params)
+    params.append(post_id)
+    return f"""
+        SELECT p.*, u.username, {liked}
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        WHERE p.id = ?
+    """, params
+
+def user_posts_query(user_id: int, viewer_id: Optional[int], key: Optional[list], limit: int) -> Tuple[str, list]:
+    params = []
+    liked = _liked_by_user(viewer_id, params)
+    query = f"""
+        SELECT {POST_SUMMARY_COLUMNS}, u.username, {liked}
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        WHERE p.user_id = ?
+    """
+    params.append(user_id)
+    if key:
+        query += " AND " + keyset_condition(["p.created_at", "p.id"])
+        params.extend(key)
+    query += " ORDER BY p.created_at DESC, p.id DESC LIMIT ?"
+    params.append(limit)
+    return query, params
+
+def feed_query(user_id: int, merged: List[int], key: Optional[list], limit: int) -> Tuple[str, list]:
+    params = [user_id]
+
+    def newest(table: str, id_column: str, owner_id: int) -> str:
+        query = f"SELECT {id_column} AS post_id, created_at FROM {table} WHERE user_id = ?"
+        params.append(owner_id)
+        if key:
+            query += " AND " + keyset_condition(["created_at", id_column])
+            params.extend(key)
+        query += f" ORDER BY created_at DESC, {id_column} DESC LIMIT ?"
+        params.append(limit)
+        return f"SELECT post_id, created_at FROM ({query})"
+
+    # One primary key range of the timeline, plus one index range of
+    # posts per merged account
+    sources = [newest("timeline", "post_id", user_id)]
+    sources.extend(newest("posts", "id", account_id) for account_id in merged)
+    params.append(limit)
+
+    return f"""
+        SELECT {POST_SUMMARY_COLUMNS}, u.username,
+              (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user
+        FROM ({" UNION ".join(sources)}) t
+        JOIN posts p ON p.id = t.post_id
+        JOIN users u ON p.user_id = u.id
+        ORDER BY t.created_at DESC, t.post_id DESC
+        LIMIT ?
+    """, params
+
+def explore_query(sort: str, category_match: Optional[str], viewer_id: Optional[int], key: Optional[list], limit: int,
+                  epoch: Optional[float] = None) -> Tuple[str, list]:
+    """Explore page SQL; for "trending" the key must already be rescaled to epoch."""
+    if sort == "popular":
+        sort_columns = ["p.like_count", "p.created_at", "p.id"]
+    elif sort == "trending":
+        # Top-K read straight off idx_trending_score
+        sort_columns = ["t.score", "t.post_id"]
+    else:
+        sort_columns = ["p.created_at", "p.id"]
+
+    params = []
+    columns = f"{POST_SUMMARY_COLUMNS}, u.username"
+    tables = "posts p JOIN users u ON p.user_id = u.id"
+    if sort == "trending":
+        columns += ", ? as trending_epoch, t.score as trending_score"
+        params.append(epoch)
+        tables = "post_trending t JOIN posts p ON p.id = t.post_id JOIN users u ON p.user_id = u.id"
+    if category_match:
+        # Start from the full-text matches and sort just those, rather than
+        # walking the sort index until enough posts happen to match, which
+        # reads all of it for a rare category
+        tables = f"posts_fts JOIN {tables}"
+
+    query = f"SELECT {columns}, {_liked_by_user(viewer_id, params)} FROM {tables}"
+
+    conditions = []
+    if category_match:
+        conditions.append("posts_fts MATCH ? AND p.id = posts_fts.rowid")
+        params.append(category_match)
+
+    # Continue after the last post of the previous page
+    if key:
+        conditions.append(keyset_condition(sort_columns))
+        params.extend(key)
+
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + ", ".join(f"{column} DESC" for column in sort_columns) + " LIMIT ?"
+    params.append(limit)
+    return query, params
+
+def post_search_query(match: str, viewer_id: Optional[int], key: Optional[list], limit: int) -> Tuple[str, list]:
+    # bm25() is lower for better matches, so negate it to sort descending like the other lists
+    relevance = f"-bm25(posts_fts, {PROMPT_WEIGHT}, {CAPTION_WEIGHT})"
+
+    params = [MATCH_START, MATCH_END, MATCH_START, MATCH_END]
+    query = f"""
+        SELECT {POST_SUMMARY_COLUMNS}, u.username, {relevance} as relevance,
+              {snippet_sql(0)} as prompt_snippet,
+              {snippet_sql(1)} as caption_snippet,
+              {_liked_by_user(viewer_id, params)}
+        FROM posts_fts
+        JOIN posts p ON p.id = posts_fts.rowid
+        JOIN users u ON p.user_id = u.id
+        WHERE posts_fts MATCH ?
+    """
+    params.append(match)
+    if key:
+        query += " AND " + keyset_condition([relevance, "p.id"])
+        params.extend(key)
+    query += " ORDER BY relevance DESC, p.id DESC LIMIT ?"
+    params.append(limit)
+    return query, params
+
+def liked_posts_query(user_id: int, key: Optional[list], limit: int) -> Tuple[str, list]:
+    query = f"""
+        SELECT {POST_SUMMARY_COLUMNS}, u.username, l.created_at as liked_at,
+              1 as liked_by_user
+        FROM likes l
+        JOIN posts p ON p.id = l.post_id
+        JOIN users u ON p.user_id = u.id
+        WHERE l.user_id = ?
+    """
+    params = [user_id]
+    if key:
+        query += " AND " + keyset_condition(["l.created_at", "l.post_id"])
+        params.extend(key)
+    query += " ORDER BY l.created_at DESC, l.post_id DESC LIMIT ?"
+    params.append(limit)
+    return query, params
+
+async def _fetch(query: str, params) -> List[dict]:
+    async with db_pool.read() as db:
+        cursor = await db.execute(query, params)
+        return [dict(row) for row in await cursor.fetchall()]
+
+async def _fetch_one(query: str, params) -> Optional[dict]:
+    async with db_pool.read() as db:
+        cursor = await db.execute(query, params)
+        row = await cursor.fetchone()
+    return dict(row) if row else None
+
+class SQLiteUserRepository(UserRepository):
+    async def get(self, user_id: int) -> Optional[dict]:
+        return await _fetch_one("SELECT * FROM users WHERE id = ?", (user_id,))
+
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        return await _fetch_one(USER_BY_USERNAME_QUERY, (username,))
+
+    async def get_many(self, user_ids: List[int]) -> List[dict]:
+        return await _fetch(USERS_BY_ID_QUERY, (json.dumps(user_ids),))
+
+    async def create(self, username: str, email: str, password_hash: str) -> dict:
+        async def insert_user(db):
+            # Check if username already exists
+            cursor = await db.execute(USER_BY_USERNAME_QUERY, (username,))
+            if await cursor.fetchone():
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Username already registered"
+                )
+
+            # Check if email already exists
+            cursor = await db.execute("SELECT * FROM users WHERE email = ?", (email,))
+            if await cursor.fetchone():
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Email already registered"
+                )
+
+            cursor = await db.execute(
+                "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                (username, email, password_hash)
+            )
+            cursor = await db.execute("SELECT * FROM users WHERE id = ?", (cursor.lastrowid,))
+            return dict(await cursor.fetchone())
+
+        return await write_queue.submit(insert_user)
+
+    async def update(self, user_id: int, fields: dict) -> dict:
+        set_clause = ", ".join(f"{field} = ?" for field in fields)
+
+        async def apply_update(db):
+            await db.execute(f"UPDATE users SET {set_clause} WHERE id = ?", [*fields.values(), user_id])
+            cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            return dict(await cursor.fetchone())
+
+        return await write_queue.submit(apply_update)
+
+    async def search(self, query: str, limit: int) -> List[dict]:
+        return await _fetch(*user_search_query(query, limit))
+
+class SQLiteFollowerRepository(FollowerRepository):
+    async def toggle(self, follower_id: int, followed_id: int, followed_at: int) -> str:
+        async def toggle_follow(db):
+            # Check if the user exists
+            cursor = await db.execute("SELECT * FROM users WHERE id = ?", (followed_id,))
+            if not await cursor.fetchone():
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="User not found"
+                )
+
+            cursor = await db.execute(
+                "DELETE FROM followers WHERE follower_id = ? AND followed_id = ?",
+                (follower_id, followed_id)
+            )
+            if cursor.rowcount:
+                await db.execute(
+                    "DELETE FROM timeline WHERE user_id = ? AND post_id IN (SELECT id FROM posts WHERE user_id = ?)",
+                    (follower_id, followed_id)
+                )
+                return "unfollowed"
+
+            await db.execute(
+                "INSERT INTO followers (follower_id, followed_id, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+                (follower_id, followed_id, followed_at)
+            )
+            # Start the timeline off with what the account posted recently
+            await db.execute("""
+                INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+                SELECT ?, created_at, id FROM posts
+                WHERE user_id = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, (follower_id, followed_id, FOLLOW_BACKFILL_POSTS))
+            return "followed"
+
+        return await write_queue.submit(toggle_follow)
+
+    async def edges(self, after: Tuple[int, int], limit: int) -> List[Tuple[int, int, int]]:
+        async with db_pool.read() as db:
+            cursor = await db.execute(FOLLOW_EDGES_QUERY, (*after, limit))
+            return [tuple(row) for row in await cursor.fetchall()]
+
+class SQLitePostRepository(PostRepository):
+    async def get(self, post_id: int, viewer_id: Optional[int]) -> Optional[dict]:
+        return await _fetch_one(*post_query(post_id, viewer_id))
+
+    async def get_many(self, post_ids: List[int], viewer_id: Optional[int]) -> List[dict]:
+        return await _fetch(POST_BATCH_QUERY, (viewer_id, json.dumps(post_ids)))
+
+    async def create(self, user_id: int, prompt: str, caption: Optional[str], image: dict) -> int:
+        async def insert_post(db):
+            cursor = await db.execute(
+                "INSERT INTO posts (user_id, prompt, image_data, image_hash, image_size, image_mime, caption) VALUES (?, ?, '', ?, ?, ?, ?)",
+                (user_id, prompt, image['image_hash'], image['image_size'], image['image_mime'], caption)
+            )
+            post_id = cursor.lastrowid
+            await record_post(db, post_id)
+            # Followers get it from timelines.fan_out()
+            await db.execute(
+                "INSERT INTO timeline (user_id, created_at, post_id) SELECT user_id, created_at, id FROM posts WHERE id = ?",
+                (post_id,)
+            )
+            return post_id
+
+        return await write_queue.submit(insert_post)
+
+    async def delete(self, post_id: int, user_id: int) -> List[str]:
+        async def remove_post(db):
+            # Check if the post exists and belongs to the user
+            cursor = await db.execute(
+                "SELECT * FROM posts WHERE id = ? AND user_id = ?",
+                (post_id, user_id)
+            )
+            post = await cursor.fetchone()
+
+            if not post:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Post not found or you don't have permission to delete it"
+                )
+
+            await db.execute("DELETE FROM likes WHERE post_id = ?", (post_id,))
+            await db.execute(TIMELINE_DELETE_POST_QUERY, (post_id,))
+            await db.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+
+            # Drop the image unless another post shares the same bytes
+            if not post['image_hash']:
+                return []
+            cursor = await db.execute(IMAGE_REFERENCE_QUERY, (post['image_hash'],))
+            if await cursor.fetchone() is not None:
+                return []
+            return await release_image(db, post['image_hash'])
+
+        return await write_queue.submit(remove_post)
+
+    async def references_image(self, image_hash: str) -> bool:
+        return await _fetch_one(IMAGE_REFERENCE_QUERY, (image_hash,)) is not None
+
+    async def by_user(self, user_id: int, viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        return await _fetch(*user_posts_query(user_id, viewer_id, key, limit))
+
+    async def feed(self, user_id: int, key: Optional[list], limit: int) -> List[dict]:
+        async with db_pool.read() as db:
+            cursor = await db.execute(MERGED_ACCOUNTS_QUERY, (TIMELINE_MERGE_FOLLOWERS, user_id))
+            merged = [row[0] for row in await cursor.fetchall()]
+
+            cursor = await db.execute(*feed_query(user_id, merged, key, limit))
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def explore(self, sort: str, category: Optional[str], viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        category_match = fts_query(category) if category else None
+
+        async with db_pool.read() as db:
+            epoch = None
+            if sort == "trending":
+                epoch, half_life = await trending_state(db)
+                if key:
+                    # Scores were rebased since the previous page; convert the cursor
+                    cursor_epoch = key.pop(0)
+                    key[0] = rescale(key[0], cursor_epoch, epoch, half_life)
+
+            cursor = await db.execute(*explore_query(sort, category_match, viewer_id, key, limit, epoch))
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def search(self, text: str, viewer_id: Optional[int], key: Optional[list], limit: int) -> List[dict]:
+        match = fts_query(text)
+        if match is None:
+            return []
+        return await _fetch(*post_search_query(match, viewer_id, key, limit))
+
+    async def trending_state(self) -> Tuple[float, float]:
+        async with db_pool.read() as db:
+            return await trending_state(db)
+
+    async def trending(self, limit: int) -> List[dict]:
+        return await _fetch("""
+            SELECT t.post_id, t.score, t.engagement, t.updated_at, p.like_count, p.created_at
+            FROM post_trending t
+            JOIN posts p ON p.id = t.post_id
+            ORDER BY t.score DESC
+            LIMIT ?
+        """, (limit,))
+
+    async def rebuild_trending(self, half_life: float) -> Optional[int]:
+        row = await _fetch_one("SELECT half_life FROM trending_state WHERE id = 1", ())
+        if row is not None and row["half_life"] == half_life:
+            return None
+        return await write_queue.submit(rebuild_scores, half_life)
+
+    async def rebase_trending(self, now: float) -> int:
+        return await write_queue.submit(rebase_scores, now)
+
+class SQLiteLikeRepository(LikeRepository):
+    async def toggle(self, user_id: int, post_id: int) -> Tuple[str, int]:
+        async def toggle_like(db):
+            # Check if the post exists
+            cursor = await db.execute("SELECT 1 FROM posts WHERE id = ?", (post_id,))
+            if not await cursor.fetchone():
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Post not found"
+                )
+
+            cursor = await db.execute(LIKE_LOOKUP_QUERY, (user_id, post_id))
+            like = await cursor.fetchone()
+
+            if like:
+                await db.execute(
+                    "DELETE FROM likes WHERE user_id = ? AND post_id = ?",
+                    (user_id, post_id)
+                )
+                await record_unlike(db, post_id, like[0])
+                action = "unliked"
+            else:
+                # The trending score uses the same timestamp as the row
+                liked_at = int(time.time())
+                await db.execute(
+                    "INSERT INTO likes (user_id, post_id, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+                    (user_id, post_id, liked_at)
+                )
+                await record_like(db, post_id, liked_at)
+                action = "liked"
+
+            # Already adjusted by the likes triggers
+            cursor = await db.execute(LIKE_COUNT_QUERY, (post_id,))
+            return action, (await cursor.fetchone())[0]
+
+        return await write_queue.submit(toggle_like)
+
+    async def liked_posts(self, user_id: int, key: Optional[list], limit: int) -> List[dict]:
+        return await _fetch(*liked_posts_query(user_id, key, limit))
+
+class SQLiteTimelineRepository(TimelineRepository):
+    async def fan_out(self, post_id: int, after_user_id: int, limit: int) -> Tuple[List[int], int]:
+        async def deliver(db):
+            cursor = await db.execute(FAN_OUT_FOLLOWERS_QUERY, (post_id, after_user_id, limit))
+            user_ids = [row[0] for row in await cursor.fetchall()]
+            if not user_ids:
+                return [], 0
+
+            cursor = await db.execute("""
+                INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+                SELECT value, p.created_at, p.id FROM posts p, json_each(?)
+                WHERE p.id = ?
+            """, (json.dumps(user_ids), post_id))
+            return user_ids, cursor.rowcount
+
+        return await write_queue.submit(deliver)
+
+    async def trim(self, user_ids: List[int], length: int) -> int:
+        async def trim_batch(db):
+            removed = 0
+            for user_id in user_ids:
+                cursor = await db.execute(TIMELINE_TRIM_QUERY, (user_id, user_id, length))
+                removed += cursor.rowcount
+            return removed
+
+        return await write_queue.submit(trim_batch)
+
+class SQLiteRepository(Repository):
+    """The single-file database from database.py."""
+
+    name = "sqlite"
+
+    def __init__(self):
+        self.users = SQLiteUserRepository()
+        self.posts = SQLitePostRepository()
+        self.likes = SQLiteLikeRepository()
+        self.followers = SQLiteFollowerRepository()
+        self.timelines = SQLiteTimelineRepository()
+
+    async def open(self):
+        # Schema and pool are set up by initialize_database() and main.py,
+        # which the image store needs with any backend
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,166 @@
+import os
+import re
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import anyio
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from storage import blob_store, is_valid_hash
+
+router = APIRouter(
+    prefix="/images",
+    tags=["images"],
+)
+
+# Blobs are content-addressed, so a URL always maps to the same bytes
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+@lru_cache(maxsize=4096)
+def _image_mime(image_hash: str) -> str:
+    """MIME type of a stored blob; safe to cache since blobs never change."""
+    return blob_store.mime(image_hash)
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag."""
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single byte range into an inclusive (start, end) pair.
+
+    Returns None when the header should be ignored (malformed or several
+    ranges) and raises ValueError when the range cannot be satisfied.
+    """
+    match = _RANGE_PATTERN.match(range_header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+
+    first, last = match.group(1), match.group(2)
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+class ImageResponse(Response):
+    """
+    Send a byte range of a file.
+
+    Uses the ASGI zero-copy or pathsend extensions when the server offers
+    them, so the kernel moves the bytes; otherwise streams the file in
+    chunks from a worker thread.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, media_type: str):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+        self.headers["content-length"] = str(self.count)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions") or {}
+        whole_file = self.start == 0 and self.status_code == status.HTTP_200_OK
+
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f.fileno(),
+                    "offset": self.start,
+                    "count": self.count,
+                    "more_body": False,
+                })
+        elif "http.response.pathsend" in extensions and whole_file:
+            await send({"type": "http.response.pathsend", "path": os.fspath(self.path)})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as f:
+                await f.seek(self.start)
+                remaining = self.count
+                more_body = True
+                while more_body:
+                    chunk = await f.read(min(self.chunk_size, remaining)) if remaining > 0 else b""
+                    remaining -= len(chunk)
+                    # An empty read means the file ended early; close the response anyway
+                    more_body = remaining > 0 and bool(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+@router.api_route("/{image_hash}", methods=["GET", "HEAD"])
+async def get_image(image_hash: str, request: Request):
+    """Serve image bytes from the content-addressed store."""
+    if not is_valid_hash(image_hash):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Image not found"
+        )
+
+    # The hash is the content, so it makes a strong validator
+    etag = f'"{image_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+    # Revalidation needs no disk access at all
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    path = blob_store.path(image_hash)
+    try:
+        size = (await anyio.to_thread.run_sync(os.stat, path)).st_size
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Image not found"
+        )
+
+    media_type = await anyio.to_thread.run_sync(_image_mime, image_hash)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={**headers, "Content-Range": f"bytes */{size}"}
+            )
+
+    if byte_range is None:
+        return ImageResponse(path, 0, size - 1, status.HTTP_200_OK, headers, media_type)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return ImageResponse(path, start, end, status.HTTP_206_PARTIAL_CONTENT, headers, media_type)
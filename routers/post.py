@@ -1,396 +1,416 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Form, Request, Response
-from fastapi.responses import JSONResponse
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Form, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Optional, Tuple
+import asyncio
 import base64
-import aiosqlite
 import json
 
-from together import Together
-from database import DATABASE_PATH
-from models import PostCreate, Post
-from auth import get_current_user, get_current_user_optional, get_token_from_request
+from database import db_pool
+from repositories import repository
+from models import PostCreate, PreviewCreate, Post, GenerationJobCreate
+from auth import get_current_user, get_current_user_optional
+from storage import save_image, delete_blobs
+from serializers import serialize_post, summarize_post, parse_fields, needs_variants, project
+from derivatives import schedule_derivatives, attach_variants
+from timelines import schedule_fanout
+from pagination import page_size, decode_cursor, paginate, MAX_PAGE_SIZE
+from search import highlight
+from generation import generation_queue, generate_image, generate_variants, GenerationJob, GENERATION_MAX_VARIANTS
+from previews import preview_store
 
 router = APIRouter(
     prefix="/posts",
     tags=["posts"],
 )
 
-# Initialize the Together API client
-together_client = Together(api_key="d292b79dda4f87085a633743a84dcc46ab4d70fdee4b25b7acb4691b80c7ad92")
+# Seconds between keep-alive comments on an idle job event stream
+JOB_EVENTS_HEARTBEAT = 15
 
-@router.post("/", response_model=Post)
-async def create_post(post_data: PostCreate, current_user: dict = Depends(get_current_user)):
-    """Create a new post with an AI-generated image."""
-    # Generate image using Together API
-    try:
-        prompt = post_data.prompt.strip()
-        if not prompt:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Prompt cannot be empty"
-            )
-            
-        response = await together_client.images.generate(
-            prompt=prompt,
-            model="black-forest-labs/FLUX.1-schnell-Free",
-            width=1024,  # Reduced size for faster generation
-            height=1024,
-            steps=4,
-            n=1,
-            response_format="b64_json",
-            stop=[]
+def _prompt(post_data: PostCreate) -> str:
+    prompt = post_data.prompt.strip()
+    if not prompt:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Prompt cannot be empty"
+        )
+    return prompt
+
+def _preview_work(prompt: str, post_data: PostCreate, user_id: int):
+    """Job work that generates an image and keeps it for publishing later."""
+    async def work(job: GenerationJob) -> dict:
+        image_data = await generate_image(prompt, fresh=post_data.fresh)
+        return {
+            "success": True,
+            "image_data": image_data,
+            "prompt": post_data.prompt,
+            # Sent back with create_post to publish this image
+            "preview_token": preview_store.put(user_id, prompt, image_data),
+            "expires_in": preview_store.ttl
+        }
+    return work
+
+def _variants_work(prompt: str, post_data: PreviewCreate, user_id: int):
+    """Job work that generates several images in one batch, adding each to the job as it arrives."""
+    async def work(job: GenerationJob) -> dict:
+        async for image_data in generate_variants(prompt, post_data.variants):
+            job.add_variant({
+                "index": len(job.variants),
+                "image_data": image_data,
+                # Sent back with create_post to publish this variant
+                "preview_token": preview_store.put(user_id, prompt, image_data)
+            })
+        # The images are on the job already, so the result only lists them
+        return {
+            "success": True,
+            "prompt": post_data.prompt,
+            "preview_tokens": [variant["preview_token"] for variant in job.variants],
+            "expires_in": preview_store.ttl
+        }
+    return work
+
+def _preview_job(prompt: str, post_data: PreviewCreate, user_id: int) -> GenerationJob:
+    if post_data.variants > GENERATION_MAX_VARIANTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {GENERATION_MAX_VARIANTS} variants per preview"
         )
+    if post_data.variants > 1:
+        return generation_queue.submit(user_id, "variants", prompt, _variants_work(prompt, post_data, user_id))
+    return generation_queue.submit(user_id, "preview", prompt, _preview_work(prompt, post_data, user_id))
+
+async def _create_post(prompt: str, post_data: PostCreate, user_id: int) -> dict:
+    """Publish the previewed image, or a newly generated one, as a post."""
+    if post_data.preview_token:
+        # Taken before saving, so a second request with the token gets a 410
+        image_data = preview_store.pop(post_data.preview_token, user_id, prompt)
+    else:
+        image_data = await generate_image(prompt, fresh=post_data.fresh)
+        preview_store.record_generated()
+    
+    # Once saving starts it finishes even if the job is cancelled, so a
+    # post is never left without its derivatives and fan-out
+    return await asyncio.shield(_save_post(prompt, post_data, user_id, image_data))
+
+async def _save_post(prompt: str, post_data: PostCreate, user_id: int, image_data: str) -> dict:
+    """Store the image and insert the post for it."""
+    post_id = None
+    try:
+        # Write the decoded bytes to the image store; the row only keeps the hash
+        image = await save_image(image_data)
+        
+        # Insert new post
+        post_id = await repository.posts.create(user_id, post_data.prompt, post_data.caption, image)
         
-        if not hasattr(response, 'data') or not response.data:
+        # Resize and re-encode for the grids off the event loop
+        schedule_derivatives(image['image_hash'])
+        
+        # Copy it to the followers' home timelines in batches
+        schedule_fanout(post_id, user_id)
+        
+        # Get the created post
+        post = await repository.posts.get(post_id, user_id)
+        if not post:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="No image data received from API"
+                detail="Error retrieving created post"
             )
-            
-        image_data = response.data[0].b64_json
     except Exception as e:
-        print(f"Image generation error: {str(e)}")
+        print(f"Database error: {str(e)}")
+        if post_data.preview_token and post_id is None:
+            # Nothing was published, so the user can try the same preview again
+            preview_store.restore(post_data.preview_token, user_id, prompt, image_data)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error generating image: {str(e)}"
+            detail=f"Error saving post: {str(e)}"
         )
     
+    return serialize_post(post)
+
+def _publish_work(prompt: str, post_data: PostCreate, user_id: int):
+    """Job work that publishes a post, generating its image unless it was previewed."""
+    async def work(job: GenerationJob) -> dict:
+        return await _create_post(prompt, post_data, user_id)
+    return work
+
+@router.post("/", response_model=Post)
+async def create_post(post_data: PostCreate, request: Request, current_user: dict = Depends(get_current_user)):
+    """Create a new post from a previewed image, or with a newly generated one."""
+    prompt = _prompt(post_data)
+    
+    if post_data.preview_token:
+        # Nothing to generate, so nothing to queue
+        return await _create_post(prompt, post_data, current_user['id'])
+    
+    # Runs on the generation workers like any other job; waits for the result
+    job = generation_queue.submit(current_user['id'], "post", prompt, _publish_work(prompt, post_data, current_user['id']))
+    return await generation_queue.wait(job, request)
+
+async def get_posts_by_ids(post_ids: List[int], viewer_id: Optional[int], fields: Optional[List[str]] = None) -> Tuple[List[dict], List[int]]:
+    """
+    Summaries of many posts in the order asked for, plus the ids that do not exist.
+
+    One query for the posts and the viewer's likes, one for the thumbnails.
+    """
+    post_ids = list(dict.fromkeys(post_ids))
+    rows = await repository.posts.get_many(post_ids, viewer_id)
+    found = {row["id"]: summarize_post(row) for row in rows}
+    
+    posts = [found[post_id] for post_id in post_ids if post_id in found]
+    missing = [post_id for post_id in post_ids if post_id not in found]
+    if posts and needs_variants(fields):
+        async with db_pool.read() as db:
+            await attach_variants(db, posts)
+    
+    return project(posts, fields), missing
+
+@router.get("/batch")
+async def get_posts_batch(request: Request, ids: str, fields: Optional[str] = None):
+    """Get several posts in one request, e.g. ?ids=3,1,2."""
+    fields = parse_fields(fields)
+    
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            
-            # Insert new post
-            cursor = await db.execute(
-                "INSERT INTO posts (user_id, prompt, image_data, caption) VALUES (?, ?, ?, ?)",
-                (current_user['id'], post_data.prompt, image_data, post_data.caption)
-            )
-            await db.commit()
-            
-            # Get the created post
-            post_id = cursor.lastrowid
-            cursor = await db.execute("""
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.id = ?
-            """, (current_user['id'], post_id))
-            post = await cursor.fetchone()
-            
-            if not post:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Error retrieving created post"
-                )
-        
-        return dict(post)
-    except Exception as e:
-        print(f"Database error: {str(e)}")
+        post_ids = [int(post_id) for post_id in ids.split(",") if post_id.strip()]
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error saving post: {str(e)}"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ids must be a comma separated list of post ids"
         )
+    if len(post_ids) > MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_PAGE_SIZE} ids per request"
+        )
+    
+    # Resolved once per request and shared with the auth middleware
+    current_user = await get_current_user_optional(request)
+    current_user_id = current_user["id"] if current_user else None
+    
+    posts, missing = await get_posts_by_ids(post_ids, current_user_id, fields)
+    
+    return {"posts": posts, "missing": missing}
 
 @router.get("/{post_id}", response_model=Post)
 async def get_post(post_id: int, request: Request):
     """Get a specific post."""
     # Get current user if authenticated
-    token = await get_token_from_request(request)
-    current_user = await get_current_user_optional(token) if token else None
+    current_user = await get_current_user_optional(request)
     current_user_id = current_user["id"] if current_user else None
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Build query with or without liked_by_user
-        if current_user_id:
-            query = """
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.id = ?
-            """
-            cursor = await db.execute(query, (current_user_id, post_id))
-        else:
-            query = """
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      0 as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.id = ?
-            """
-            cursor = await db.execute(query, (post_id,))
-        
-        post = await cursor.fetchone()
-    
+    post = await repository.posts.get(post_id, current_user_id)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Post not found"
         )
     
-    return dict(post)
+    return serialize_post(post)
 
 @router.post("/like/{post_id}")
 async def like_post(post_id: int, current_user: dict = Depends(get_current_user)):
     """Like or unlike a post."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Check if the post exists
-        cursor = await db.execute("SELECT * FROM posts WHERE id = ?", (post_id,))
-        if not await cursor.fetchone():
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Post not found"
-            )
-        
-        # Check if already liked
-        cursor = await db.execute(
-            "SELECT * FROM likes WHERE user_id = ? AND post_id = ?",
-            (current_user['id'], post_id)
-        )
-        
-        if await cursor.fetchone():
-            # Already liked, unlike
-            await db.execute(
-                "DELETE FROM likes WHERE user_id = ? AND post_id = ?",
-                (current_user['id'], post_id)
-            )
-            message = "Post unliked successfully"
-            action = "unliked"
-        else:
-            # Not liked, like
-            await db.execute(
-                "INSERT INTO likes (user_id, post_id) VALUES (?, ?)",
-                (current_user['id'], post_id)
-            )
-            message = "Post liked successfully"
-            action = "liked"
-        
-        # Get updated like count
-        cursor = await db.execute("SELECT COUNT(*) FROM likes WHERE post_id = ?", (post_id,))
-        like_count = (await cursor.fetchone())[0]
-        
-        await db.commit()
+    action, like_count = await repository.likes.toggle(current_user['id'], post_id)
+    message = "Post liked successfully" if action == "liked" else "Post unliked successfully"
     
     return {"message": message, "action": action, "like_count": like_count}
 
 @router.get("/", response_model=List[dict])
-async def get_explore_posts(request: Request, filter: str = "latest", page: int = 1, category: str = None):
-    """Get posts for the explore section."""
-    # Extract token from request to check if user is authenticated
-    token = await get_token_from_request(request)
-    current_user = await get_current_user_optional(token) if token else None
+async def get_explore_posts(
+    request: Request,
+    response: Response,
+    filter: str = "latest",
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    category: str = None,
+    fields: Optional[str] = None
+):
+    """Get posts for the explore section, one cursor page at a time."""
+    fields = parse_fields(fields)
+    
+    # Resolved once per request and shared with the auth middleware
+    current_user = await get_current_user_optional(request)
     current_user_id = current_user["id"] if current_user else None
     
-    limit = 12
-    offset = (page - 1) * limit
+    limit = page_size(limit, default=12)
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Base query
-        query = """
-            SELECT p.*, u.username, 
-                  (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count
-        """
-        
-        # Add liked_by_user field if user is authenticated
-        if current_user_id:
-            query += f", (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user"
-        else:
-            query += ", 0 as liked_by_user"
-            
-        query += """
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-        """
-        
-        # Add category filter if provided
-        params = []
-        if current_user_id:
-            params.append(current_user_id)
-            
-        if category:
-            query += " WHERE (p.caption LIKE ? OR p.prompt LIKE ?)"
-            params.extend([f"%{category}%", f"%{category}%"])
-        
-        # Add ordering based on filter type
-        if filter == "latest":
-            query += " ORDER BY p.created_at DESC"
-        elif filter == "popular":
-            query += " ORDER BY like_count DESC"
-        elif filter == "trending":
-            # Simplified trending algorithm - recent posts with high engagement
-            query += " ORDER BY (like_count * 10 + (julianday('now') - julianday(p.created_at)) * 86400) DESC"
-        else:
-            query += " ORDER BY p.created_at DESC"  # Default to latest
-        
-        # Add pagination
-        query += " LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-        
-        try:
-            cursor = await db.execute(query, params)
-            posts = [dict(row) for row in await cursor.fetchall()]
-            return posts
-        except Exception as e:
-            print(f"Database error: {str(e)}")
-            return []
+    # Row fields each filter is sorted by, all descending; the cursor holds
+    # the key of the last post shown
+    if filter not in repository.posts.EXPLORE_KEYS:
+        filter = "latest"  # Default to latest
+    sort_key = repository.posts.EXPLORE_KEYS[filter]
+    key = decode_cursor(page_cursor, repository.posts.EXPLORE_KEY_TYPES[filter])
+    
+    rows = await repository.posts.explore(filter, category, current_user_id, key, limit + 1)
+    rows, _ = paginate(rows, limit, lambda row: [row[field] for field in sort_key], response)
+    
+    posts = [summarize_post(row) for row in rows]
+    for post in posts:
+        post.pop("trending_epoch", None)
+        post.pop("trending_score", None)
+    if needs_variants(fields):
+        async with db_pool.read() as db:
+            await attach_variants(db, posts)
+    
+    return project(posts, fields)
 
 @router.get("/user/{user_id}", response_model=List[dict])
-async def get_user_posts(user_id: int, request: Request):
-    """Get posts from a specific user."""
-    # Extract token from request to check if user is authenticated
-    token = await get_token_from_request(request)
-    current_user = await get_current_user_optional(token) if token else None
+async def get_user_posts(
+    user_id: int,
+    request: Request,
+    response: Response,
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    fields: Optional[str] = None
+):
+    """Get posts from a specific user, newest first."""
+    fields = parse_fields(fields)
+    limit = page_size(limit)
+    key = decode_cursor(page_cursor, (str, int))
+    
+    # Resolved once per request and shared with the auth middleware
+    current_user = await get_current_user_optional(request)
     current_user_id = current_user["id"] if current_user else None
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Build query with or without liked_by_user
-        if current_user_id:
-            query = """
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.user_id = ?
-                ORDER BY p.created_at DESC
-            """
-            cursor = await db.execute(query, (current_user_id, user_id))
-        else:
-            query = """
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      0 as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.user_id = ?
-                ORDER BY p.created_at DESC
-            """
-            cursor = await db.execute(query, (user_id,))
-        
-        posts = [dict(row) for row in await cursor.fetchall()]
+    rows = await repository.posts.by_user(user_id, current_user_id, key, limit + 1)
+    rows, _ = paginate(rows, limit, lambda row: [row["created_at"], row["id"]], response)
     
-    return posts
+    posts = [summarize_post(row) for row in rows]
+    if needs_variants(fields):
+        async with db_pool.read() as db:
+            await attach_variants(db, posts)
+    
+    return project(posts, fields)
 
 @router.delete("/{post_id}")
 async def delete_post(post_id: int, current_user: dict = Depends(get_current_user)):
     """Delete a post."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Check if the post exists and belongs to the user
-        cursor = await db.execute(
-            "SELECT * FROM posts WHERE id = ? AND user_id = ?", 
-            (post_id, current_user['id'])
-        )
-        post = await cursor.fetchone()
-        
-        if not post:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Post not found or you don't have permission to delete it"
-            )
-        
-        # Delete all likes for this post
-        await db.execute("DELETE FROM likes WHERE post_id = ?", (post_id,))
-        
-        # Delete the post
-        await db.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-        await db.commit()
+    orphaned = await repository.posts.delete(post_id, current_user['id'])
+    
+    # Files go only once the rows are committed
+    await delete_blobs(orphaned, repository.posts.references_image)
     
     return {"message": "Post deleted successfully"}
 
 @router.post("/search")
-async def search_posts(search_term: str, request: Request):
-    """Search for posts by prompt or caption."""
-    search_pattern = f"%{search_term}%"
+async def search_posts(
+    search_term: str,
+    request: Request,
+    response: Response,
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    fields: Optional[str] = None
+):
+    """Search for posts by prompt or caption, best matches first."""
+    fields = parse_fields(fields)
+    limit = page_size(limit)
+    key = decode_cursor(page_cursor, (float, int))
     
-    # Extract token from request to check if user is authenticated
-    token = await get_token_from_request(request)
-    current_user = await get_current_user_optional(token) if token else None
+    # Resolved once per request and shared with the auth middleware
+    current_user = await get_current_user_optional(request)
     current_user_id = current_user["id"] if current_user else None
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Build query with or without liked_by_user
-        if current_user_id:
-            query = """
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.prompt LIKE ? OR p.caption LIKE ?
-                ORDER BY p.created_at DESC
-                LIMIT 50
-            """
-            cursor = await db.execute(query, (current_user_id, search_pattern, search_pattern))
-        else:
-            query = """
-                SELECT p.*, u.username, 
-                      (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                      0 as liked_by_user
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.prompt LIKE ? OR p.caption LIKE ?
-                ORDER BY p.created_at DESC
-                LIMIT 50
-            """
-            cursor = await db.execute(query, (search_pattern, search_pattern))
-        
-        posts = [dict(row) for row in await cursor.fetchall()]
+    rows = await repository.posts.search(search_term, current_user_id, key, limit + 1)
+    rows, _ = paginate(rows, limit, lambda row: [row["relevance"], row["id"]], response)
+    
+    posts = []
+    for row in rows:
+        post = summarize_post(row)
+        post.pop("relevance")
+        post["prompt_snippet"] = highlight(post["prompt_snippet"])
+        post["caption_snippet"] = highlight(post["caption_snippet"])
+        posts.append(post)
+    if needs_variants(fields):
+        async with db_pool.read() as db:
+            await attach_variants(db, posts)
     
-    return posts
+    return project(posts, fields)
 
 @router.post("/generate-preview")
-async def generate_preview(post_data: PostCreate, current_user: dict = Depends(get_current_user)):
-    """Generate an image preview without saving it as a post."""
-    try:
-        prompt = post_data.prompt.strip()
-        if not prompt:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Prompt cannot be empty"
-            )
-            
-        response = await together_client.images.generate(
-            prompt=prompt,
-            model="black-forest-labs/FLUX.1-schnell-Free",
-            width=1024,  # Reduced size for faster generation
-            height=1024,
-            steps=4,
-            n=1,
-            response_format="b64_json",
-            stop=[]
+async def generate_preview(post_data: PreviewCreate, request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    Generate an image preview without saving it as a post.
+    
+    The response's preview_token publishes this image through create_post.
+    With variants above 1 the images come from one batched call and the
+    response lists them, each with its own preview_token; /posts/jobs
+    streams them as they arrive instead.
+    """
+    prompt = _prompt(post_data)
+    
+    job = _preview_job(prompt, post_data, current_user['id'])
+    result = await generation_queue.wait(job, request)
+    if job.kind == "variants":
+        return {**result, "variants": job.variants}
+    return result
+
+def _own_job(job_id: str, current_user: dict) -> GenerationJob:
+    job = generation_queue.get(job_id)
+    if job is None or job.user_id != current_user['id']:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
         )
-        
-        if not hasattr(response, 'data') or not response.data:
+    return job
+
+@router.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_generation_job(job_data: GenerationJobCreate, response: Response, current_user: dict = Depends(get_current_user)):
+    """
+    Queue an image generation and return its job right away.
+    
+    With publish set the image becomes a post when it is ready; otherwise
+    the job's result is a preview like /generate-preview returns, and with
+    variants above 1 the images are added to the job's variants as they
+    arrive. Follow the job at /posts/jobs/{id} or /posts/jobs/{id}/events.
+    """
+    prompt = _prompt(job_data)
+    
+    if job_data.publish:
+        if job_data.variants > 1:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="No image data received from API"
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Publish one variant of a preview by its preview_token"
             )
-            
-        image_data = response.data[0].b64_json
-        
-        return {
-            "success": True,
-            "image_data": image_data,
-            "prompt": post_data.prompt
-        }
-    except Exception as e:
-        print(f"Image generation error: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error generating image: {str(e)}"
-        )
\ No newline at end of file
+        job = generation_queue.submit(current_user['id'], "post", prompt, _publish_work(prompt, job_data, current_user['id']))
+    else:
+        job = _preview_job(prompt, job_data, current_user['id'])
+    
+    response.headers["Location"] = f"/posts/jobs/{job.id}"
+    return job.as_dict()
+
+@router.get("/jobs/{job_id}")
+async def get_generation_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Poll a generation job; the result is included once it has succeeded."""
+    return jsonable_encoder(_own_job(job_id, current_user).as_dict())
+
+@router.get("/jobs/{job_id}/events")
+async def stream_generation_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """
+    Follow a generation job as Server-Sent Events.
+    
+    An event named after the status on every status change, and a
+    "variant" event for each image of a multi-variant preview as it
+    arrives; status events leave the variants out.
+    """
+    job = _own_job(job_id, current_user)
+    
+    async def events():
+        sent_status = None
+        sent_variants = 0
+        async for state in job.watch(JOB_EVENTS_HEARTBEAT):
+            if state is None:
+                # Comment line, keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            variants = state.pop("variants")
+            for variant in variants[sent_variants:]:
+                yield f"event: variant\ndata: {json.dumps(variant)}\n\n"
+            sent_variants = len(variants)
+            if state["status"] != sent_status:
+                sent_status = state["status"]
+                yield f"event: {sent_status}\ndata: {json.dumps(jsonable_encoder(state))}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
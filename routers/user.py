@@ -1,12 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, Response, Cookie
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Form, Response, Cookie
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta
 from typing import List, Optional
-import aiosqlite
+import time
 
-from database import DATABASE_PATH
+from database import db_pool
+from repositories import repository
+from serializers import summarize_post, parse_fields, needs_variants, project
+from derivatives import attach_variants
+from pagination import page_size, decode_cursor, paginate
+from social_graph import social_graph, followed_at, parse_key
+from timelines import mark_for_trim
+from user_cache import user_cache
 from models import UserCreate, User, UserProfile, Token, UserUpdate
 from auth import (
     get_password_hash, 
@@ -27,44 +34,16 @@ templates = Jinja2Templates(directory="templates")
 @router.post("/register", response_model=User)
 async def register_user(user_data: UserCreate, response: Response):
     """Register a new user."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Check if username already exists
-        cursor = await db.execute("SELECT * FROM users WHERE username = ?", (user_data.username,))
-        if await cursor.fetchone():
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already registered"
-            )
-        
-        # Check if email already exists
-        cursor = await db.execute("SELECT * FROM users WHERE email = ?", (user_data.email,))
-        if await cursor.fetchone():
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered"
-            )
-        
-        # Hash the password
-        hashed_password = get_password_hash(user_data.password)
-        
-        # Insert new user
-        cursor = await db.execute(
-            "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
-            (user_data.username, user_data.email, hashed_password)
-        )
-        await db.commit()
-        
-        # Get the created user
-        user_id = cursor.lastrowid
-        cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        user = await cursor.fetchone()
+    # Hash the password before taking the writer so it is not held during bcrypt
+    hashed_password = await get_password_hash(user_data.password)
+    
+    user = await repository.users.create(user_data.username, user_data.email, hashed_password)
+    user_cache.invalidate(user["id"], user["username"])
     
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user["username"]}, expires_delta=access_token_expires
+        data={"sub": user["username"], "uid": user["id"]}, expires_delta=access_token_expires
     )
     
     # Set cookie with the token
@@ -77,7 +56,7 @@ async def register_user(user_data: UserCreate, response: Response):
         path="/"
     )
     
-    return dict(user)
+    return user
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm = Depends()):
@@ -92,7 +71,7 @@ async def login_for_access_token(response: Response, form_data: OAuth2PasswordRe
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user["username"]}, expires_delta=access_token_expires
+        data={"sub": user["username"], "uid": user["id"]}, expires_delta=access_token_expires
     )
     
     # Set cookie with the token
@@ -125,91 +104,50 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
 async def update_user(user_data: UserUpdate, current_user: dict = Depends(get_current_user)):
     """Update the current user's profile."""
     update_fields = {}
-    update_values = []
     
     # Check which fields to update
     if user_data.email is not None:
         update_fields["email"] = user_data.email
-        update_values.append(user_data.email)
     
     if user_data.bio is not None:
         update_fields["bio"] = user_data.bio
-        update_values.append(user_data.bio)
     
     if user_data.password is not None:
-        update_fields["password"] = get_password_hash(user_data.password)
-        update_values.append(update_fields["password"])
+        update_fields["password"] = await get_password_hash(user_data.password)
     
     if not update_fields:
         return current_user  # Nothing to update
     
-    # Build the SQL query
-    set_clause = ", ".join([f"{field} = ?" for field in update_fields.keys()])
-    update_values.append(current_user["id"])
+    user = await repository.users.update(current_user["id"], update_fields)
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        await db.execute(
-            f"UPDATE users SET {set_clause} WHERE id = ?",
-            update_values
-        )
-        await db.commit()
-        
-        cursor = await db.execute("SELECT * FROM users WHERE id = ?", (current_user["id"],))
-        updated_user = await cursor.fetchone()
+    # Write through, so this worker's next request sees the change
+    user_cache.invalidate(user["id"])
+    user_cache.put(user)
     
-    return dict(updated_user)
+    return user
 
 @router.get("/profile/{username}", response_model=UserProfile)
 async def get_user_profile(username: str, request: Request):
     """Get a user's profile."""
     # Get current user if authenticated
-    from auth import get_token_from_request, get_current_user_optional
-    token = await get_token_from_request(request)
-    current_user = await get_current_user_optional(token) if token else None
+    current_user = await get_current_user_optional(request)
     current_user_id = current_user["id"] if current_user else None
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Get the user
-        cursor = await db.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = await cursor.fetchone()
-        
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
-        
-        # Get follower count
-        cursor = await db.execute("SELECT COUNT(*) FROM followers WHERE followed_id = ?", (user['id'],))
-        follower_count = (await cursor.fetchone())[0]
-        
-        # Get following count
-        cursor = await db.execute("SELECT COUNT(*) FROM followers WHERE follower_id = ?", (user['id'],))
-        following_count = (await cursor.fetchone())[0]
-        
-        # Get post count
-        cursor = await db.execute("SELECT COUNT(*) FROM posts WHERE user_id = ?", (user['id'],))
-        post_count = (await cursor.fetchone())[0]
-        
-        # Check if the current user is following this user (if authenticated)
-        is_following = False
-        if current_user_id:
-            cursor = await db.execute(
-                "SELECT * FROM followers WHERE follower_id = ? AND followed_id = ?",
-                (current_user_id, user['id'])
-            )
-            is_following = await cursor.fetchone() is not None
+    user = await repository.users.get_by_username(username)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
     
+    # Follow state and counts come from the in-memory graph; post_count
+    # is kept on the row
     return {
-        **dict(user),
-        "follower_count": follower_count,
-        "following_count": following_count,
-        "post_count": post_count,
-        "is_following": is_following
+        **user,
+        "follower_count": social_graph.follower_count(user['id']),
+        "following_count": social_graph.following_count(user['id']),
+        "is_following": bool(current_user_id) and social_graph.is_following(current_user_id, user['id']),
+        "follows_you": bool(current_user_id) and social_graph.is_following(user['id'], current_user_id)
     }
 
 @router.post("/follow/{user_id}")
@@ -221,142 +159,125 @@ async def follow_user(user_id: int, current_user: dict = Depends(get_current_use
             detail="You cannot follow yourself"
         )
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        # Check if the user exists
-        cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        if not await cursor.fetchone():
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
-        
-        # Check if already following
-        cursor = await db.execute(
-            "SELECT * FROM followers WHERE follower_id = ? AND followed_id = ?",
-            (current_user['id'], user_id)
-        )
-        
-        if await cursor.fetchone():
-            # Already following, unfollow
-            await db.execute(
-                "DELETE FROM followers WHERE follower_id = ? AND followed_id = ?",
-                (current_user['id'], user_id)
-            )
-            message = "Unfollowed successfully"
-            action = "unfollowed"
-        else:
-            # Not following, follow
-            await db.execute(
-                "INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)",
-                (current_user['id'], user_id)
-            )
-            message = "Followed successfully"
-            action = "followed"
-        
-        await db.commit()
+    # The row and the graph get the same follow time
+    now = int(time.time())
+    action = await repository.followers.toggle(current_user['id'], user_id, now)
+    if action == "followed":
+        social_graph.follow(current_user['id'], user_id, now)
+        # The follow copied the account's recent posts to the timeline
+        mark_for_trim(current_user['id'])
+    else:
+        social_graph.unfollow(current_user['id'], user_id)
+    message = "Followed successfully" if action == "followed" else "Unfollowed successfully"
     
     return {"message": message, "action": action}
 
 @router.get("/feed", response_model=List[dict])
-async def get_user_feed(current_user: dict = Depends(get_current_user)):
+async def get_user_feed(
+    response: Response,
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    fields: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """Get posts from users the current user follows."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        cursor = await db.execute("""
-            SELECT p.*, u.username, 
-                  (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                  (SELECT EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?)) as liked_by_user
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            WHERE p.user_id IN (
-                SELECT followed_id FROM followers WHERE follower_id = ?
-            ) OR p.user_id = ?
-            ORDER BY p.created_at DESC
-        """, (current_user['id'], current_user['id'], current_user['id']))
-        
-        posts = [dict(row) for row in await cursor.fetchall()]
+    fields = parse_fields(fields)
+    limit = page_size(limit)
+    key = decode_cursor(page_cursor, (str, int))
+    
+    rows = await repository.posts.feed(current_user['id'], key, limit + 1)
+    rows, _ = paginate(rows, limit, lambda row: [row["created_at"], row["id"]], response)
+    
+    posts = [summarize_post(row) for row in rows]
+    if needs_variants(fields):
+        async with db_pool.read() as db:
+            await attach_variants(db, posts)
     
-    return posts
+    return project(posts, fields)
+
+async def _follow_list(list_edges, user_id: int, current_user: dict, response: Response, page_cursor: Optional[str], limit: Optional[int]) -> List[dict]:
+    """One page of a follower or following list, most recent follow first."""
+    limit = page_size(limit)
+    key = parse_key(decode_cursor(page_cursor, (str, int)))
+    
+    # Ids and follow times from the graph, then one query for the user rows
+    edges = list_edges(user_id, key, limit + 1)
+    users = {row["id"]: row for row in await repository.users.get_many([other_id for other_id, _ in edges])}
+    
+    rows = [
+        {
+            **users[other_id],
+            "followed_at": followed_at(since),
+            "is_followed": social_graph.is_following(current_user['id'], other_id)
+        }
+        for other_id, since in edges if other_id in users
+    ]
+    rows, _ = paginate(rows, limit, lambda row: [row["followed_at"], row["id"]], response)
+    return rows
 
 @router.get("/followers/{user_id}", response_model=List[dict])
-async def get_followers(user_id: int, current_user: dict = Depends(get_current_user)):
+async def get_followers(
+    user_id: int,
+    response: Response,
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """Get a list of users who follow the specified user."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        cursor = await db.execute("""
-            SELECT u.id, u.username, u.email, u.bio, u.created_at,
-                  (SELECT EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id)) as is_followed
-            FROM users u
-            JOIN followers f ON u.id = f.follower_id
-            WHERE f.followed_id = ?
-            ORDER BY u.username
-        """, (current_user['id'], user_id))
-        
-        followers = [dict(row) for row in await cursor.fetchall()]
-    
-    return followers
+    return await _follow_list(social_graph.followers_page, user_id, current_user, response, page_cursor, limit)
 
 @router.get("/following/{user_id}", response_model=List[dict])
-async def get_following(user_id: int, current_user: dict = Depends(get_current_user)):
+async def get_following(
+    user_id: int,
+    response: Response,
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """Get a list of users the specified user follows."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        cursor = await db.execute("""
-            SELECT u.id, u.username, u.email, u.bio, u.created_at,
-                  (SELECT EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id)) as is_followed
-            FROM users u
-            JOIN followers f ON u.id = f.followed_id
-            WHERE f.follower_id = ?
-            ORDER BY u.username
-        """, (current_user['id'], user_id))
-        
-        following = [dict(row) for row in await cursor.fetchall()]
-    
-    return following
+    return await _follow_list(social_graph.following_page, user_id, current_user, response, page_cursor, limit)
 
 @router.get("/search/{query}", response_model=List[dict])
-async def search_users(query: str, current_user: dict = Depends(get_current_user)):
-    """Search for users by username or email."""
-    search_pattern = f"%{query}%"
+async def search_users(query: str, limit: Optional[int] = None, current_user: dict = Depends(get_current_user)):
+    """
+    Search for users by username or email, for typeahead.
+
+    Exact username matches come first, then usernames starting with the
+    query, then usernames or emails containing it; ties go to the user
+    with more followers.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    limit = page_size(limit, default=20)
     
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        cursor = await db.execute("""
-            SELECT u.id, u.username, u.email, u.bio, u.created_at,
-                  (SELECT EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id)) as is_followed
-            FROM users u
-            WHERE u.username LIKE ? OR u.email LIKE ?
-            ORDER BY u.username
-            LIMIT 20
-        """, (current_user['id'], search_pattern, search_pattern))
-        
-        users = [dict(row) for row in await cursor.fetchall()]
+    users = await repository.users.search(query, limit)
+    for user in users:
+        user["is_followed"] = social_graph.is_following(current_user['id'], user['id'])
     
     return users
 
 @router.get("/liked", response_model=List[dict])
-async def get_liked_posts(current_user: dict = Depends(get_current_user)):
-    """Get posts liked by the current user."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
-        cursor = await db.execute("""
-            SELECT p.*, u.username, 
-                  (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                  1 as liked_by_user
-            FROM posts p
-            JOIN users u ON p.user_id = u.id
-            JOIN likes l ON p.id = l.post_id
-            WHERE l.user_id = ?
-            ORDER BY l.created_at DESC
-        """, (current_user['id'],))
-        
-        liked_posts = [dict(row) for row in await cursor.fetchall()]
+async def get_liked_posts(
+    response: Response,
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    limit: Optional[int] = None,
+    fields: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get posts liked by the current user, most recent like first."""
+    fields = parse_fields(fields)
+    limit = page_size(limit)
+    key = decode_cursor(page_cursor, (str, int))
+    
+    rows = await repository.likes.liked_posts(current_user['id'], key, limit + 1)
+    rows, _ = paginate(rows, limit, lambda row: [row["liked_at"], row["id"]], response)
+    
+    liked_posts = [summarize_post(row) for row in rows]
+    for post in liked_posts:
+        post.pop("liked_at")
+    if needs_variants(fields):
+        async with db_pool.read() as db:
+            await attach_variants(db, liked_posts)
     
-    return liked_posts
\ No newline at end of file
+    return project(liked_posts, fields)
@@ -0,0 +1,69 @@
+import html
+import re
+from typing import Optional, Tuple
+
+# Relative weight of matches in the prompt and the caption for bm25()
+PROMPT_WEIGHT = 1.0
+CAPTION_WEIGHT = 2.0
+
+# Longest snippet returned per column, in tokens
+SNIPPET_TOKENS = 12
+
+# Query terms after the first this many are ignored
+MAX_QUERY_TERMS = 8
+
+# Control characters SQLite wraps matches in; swapped for <mark> after escaping
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# Users looked at per match kind (prefix, substring) before ranking; keeps
+# typeahead fast for very common fragments
+USER_SEARCH_CANDIDATES = 500
+
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+def fts_query(text: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 MATCH expression.
+
+    Every word must match, as a prefix so results show up while typing.
+    Words are quoted, so FTS5 operators in the input are matched literally.
+    Returns None when the text has no searchable words.
+    """
+    terms = _TERM.findall(text.lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+def tsquery(text: str) -> Optional[str]:
+    """The same query as fts_query(), for PostgreSQL's to_tsquery()."""
+    terms = _TERM.findall(text.lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    return " & ".join(f"'{term}':*" for term in terms)
+
+def snippet_sql(column: int) -> str:
+    """snippet() call for one posts_fts column, with placeholders for the markers."""
+    return f"snippet(posts_fts, {column}, ?, ?, '…', {SNIPPET_TOKENS})"
+
+def highlight(snippet: Optional[str]) -> Optional[str]:
+    """HTML-escape a snippet and mark up the matched terms."""
+    if not snippet:
+        return None
+    return html.escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+def trigram_query(text: str) -> Optional[str]:
+    """
+    MATCH expression finding text anywhere in users_fts.
+
+    The trigram tokenizer needs at least three characters; shorter input
+    returns None and is only matched as a username prefix.
+    """
+    text = text.strip()
+    if len(text) < 3:
+        return None
+    return '"' + text.replace('"', '""') + '"'
+
+def prefix_range(text: str) -> Tuple[str, str]:
+    """Bounds of the index range holding every string starting with text."""
+    return text, text + "\U0010ffff"
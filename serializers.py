@@ -0,0 +1,94 @@
+from fastapi import HTTPException, status
+from typing import List, Optional
+
+from storage import image_url
+
+# Columns selected by list endpoints; the inline image is only read for
+# rows that have not been moved to the image store yet
+POST_SUMMARY_COLUMNS = """
+    p.id, p.user_id, p.prompt, p.caption, p.created_at, p.like_count, p.image_hash,
+    CASE WHEN p.image_hash IS NULL THEN p.image_data END AS image_data
+"""
+
+# Fields a client can ask for with ?fields=
+POST_SUMMARY_FIELDS = (
+    "id",
+    "user_id",
+    "username",
+    "prompt",
+    "caption",
+    "created_at",
+    "like_count",
+    "liked_by_user",
+    "image_url",
+    "image_etag",
+    "thumbnail_url",
+    "image_srcset",
+    "image_srcset_avif",
+    "image_variants",
+    "prompt_snippet",
+    "caption_snippet",
+)
+
+# Fields that need the image_variants lookup
+VARIANT_FIELDS = {"thumbnail_url", "image_srcset", "image_srcset_avif", "image_variants"}
+
+def serialize_post(row) -> dict:
+    """Convert a post row to a dict that references its image by URL."""
+    post = dict(row)
+    if post.get("image_hash"):
+        # Inline copy was moved to the image store
+        post["image_data"] = None
+    post["image_url"] = image_url(post.get("image_hash"))
+    return post
+
+def summarize_post(row) -> dict:
+    """Build the compact representation of a post used by list endpoints."""
+    post = dict(row)
+    image_hash = post.pop("image_hash", None)
+    image_data = post.pop("image_data", None)
+
+    post["image_hash"] = image_hash
+    post["image_url"] = image_url(image_hash)
+    post["image_etag"] = f'"{image_hash}"' if image_hash else None
+    if image_data:
+        # Not migrated to the image store yet, keep the inline copy
+        post["image_data"] = image_data
+    return post
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Validate a comma separated ?fields= projection."""
+    if not fields:
+        return None
+
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in POST_SUMMARY_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+
+    # The id is always returned so clients can key the results
+    if "id" not in requested:
+        requested.insert(0, "id")
+    return requested
+
+def needs_variants(fields: Optional[List[str]]) -> bool:
+    """Whether the requested fields include any thumbnail information."""
+    return fields is None or bool(VARIANT_FIELDS.intersection(fields))
+
+def project(posts: List[dict], fields: Optional[List[str]]) -> List[dict]:
+    """Reduce summaries to the requested fields."""
+    if fields is None:
+        for post in posts:
+            post.pop("image_hash", None)
+        return posts
+
+    projected = []
+    for post in posts:
+        item = {field: post.get(field) for field in fields}
+        if "image_data" in post and "image_url" in fields:
+            item["image_data"] = post["image_data"]
+        projected.append(item)
+    return projected
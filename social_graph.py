@@ -0,0 +1,259 @@
+import asyncio
+import calendar
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+# How often the graph is compared with the followers table, 0 disables
+SOCIAL_GRAPH_CHECK_INTERVAL = float(os.environ.get("SOCIAL_GRAPH_CHECK_INTERVAL", "900"))  # seconds
+
+# Follow rows read per query while loading
+LOAD_CHUNK_SIZE = 50000
+
+# Format of followers.created_at, which follow list cursors carry
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class _Edges:
+    """
+    The users on the other side of one user's follows, in one direction.
+
+    ids is sorted for membership tests, with id_since holding each one's
+    follow time; order and since hold the same ids sorted by (follow time,
+    id), the order follow lists are paged in. Knowing the follow time lets
+    remove() find an id in order by binary search.
+    """
+
+    __slots__ = ("ids", "id_since", "order", "since")
+
+    def __init__(self):
+        self.ids = array("i")
+        self.id_since = array("q")
+        self.order = array("i")
+        self.since = array("q")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        index = bisect_left(self.ids, user_id)
+        return index < len(self.ids) and self.ids[index] == user_id
+
+    def _position(self, since: int, user_id: int) -> int:
+        # Entries before this one sort below (since, user_id)
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if (self.since[middle], self.order[middle]) < (since, user_id):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def add(self, user_id: int, since: int) -> bool:
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            return False
+        self.ids.insert(index, user_id)
+        self.id_since.insert(index, since)
+
+        # New follows are the latest, so this is almost always an append
+        if not self.order or (since, user_id) > (self.since[-1], self.order[-1]):
+            self.order.append(user_id)
+            self.since.append(since)
+        else:
+            position = self._position(since, user_id)
+            self.order.insert(position, user_id)
+            self.since.insert(position, since)
+        return True
+
+    def remove(self, user_id: int) -> bool:
+        index = bisect_left(self.ids, user_id)
+        if index == len(self.ids) or self.ids[index] != user_id:
+            return False
+        since = self.id_since[index]
+        del self.ids[index]
+        del self.id_since[index]
+
+        position = self._position(since, user_id)
+        del self.order[position]
+        del self.since[position]
+        return True
+
+    def page(self, key: Optional[Tuple[int, int]], limit: int) -> List[Tuple[int, int]]:
+        """Up to limit (user_id, since) pairs below key, latest first."""
+        end = self._position(*key) if key else len(self.order)
+        start = max(end - limit, 0)
+        return [(self.order[i], self.since[i]) for i in range(end - 1, start - 1, -1)]
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self) + sum(sys.getsizeof(column) for column in (self.ids, self.id_since, self.order, self.since))
+
+    @classmethod
+    def build(cls, pairs: List[Tuple[int, int]]) -> "_Edges":
+        """From (since, user_id) pairs, sorted and without duplicates."""
+        edges = cls()
+        edges.order = array("i", (user_id for _, user_id in pairs))
+        edges.since = array("q", (since for since, _ in pairs))
+        by_id = sorted((user_id, since) for since, user_id in pairs)
+        edges.ids = array("i", (user_id for user_id, _ in by_id))
+        edges.id_since = array("q", (since for _, since in by_id))
+        return edges
+
+_EMPTY = _Edges()
+
+def followed_at(since: int) -> str:
+    """A follow time as followers.created_at would show it."""
+    return datetime.fromtimestamp(since, timezone.utc).strftime(_TIMESTAMP_FORMAT)
+
+def parse_key(key: Optional[list]) -> Optional[Tuple[int, int]]:
+    """A follow list cursor as (since, user_id); 400 if it is malformed."""
+    if not key:
+        return None
+    try:
+        return calendar.timegm(time.strptime(key[0], _TIMESTAMP_FORMAT)), int(key[1])
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+class SocialGraph:
+    """
+    Who follows whom, held in memory.
+
+    Loaded from the followers table at startup and kept current by
+    follow_user, it answers follow lists, counts and follow checks
+    without a query. The app runs as one process, like the preview store
+    and generation queue; were it run with several workers, each would
+    hold its own copy and see follows made through the others only at
+    the next consistency check.
+    """
+
+    def __init__(self):
+        self.following: Dict[int, _Edges] = {}
+        self.followers: Dict[int, _Edges] = {}
+        # Follows and unfollows made while a load is reading the table
+        self._journal: Optional[list] = None
+        self.stats = {"loaded": False, "load_ms": 0, "checks": 0, "last_check_mismatches": 0}
+
+    def is_following(self, follower_id: int, followed_id: int) -> bool:
+        return followed_id in self.following.get(follower_id, _EMPTY)
+
+    def follower_count(self, user_id: int) -> int:
+        return len(self.followers.get(user_id, _EMPTY))
+
+    def following_count(self, user_id: int) -> int:
+        return len(self.following.get(user_id, _EMPTY))
+
+    def followers_page(self, user_id: int, key: Optional[Tuple[int, int]], limit: int) -> List[Tuple[int, int]]:
+        """(follower id, since) pairs, most recent follow first."""
+        return self.followers.get(user_id, _EMPTY).page(key, limit)
+
+    def following_page(self, user_id: int, key: Optional[Tuple[int, int]], limit: int) -> List[Tuple[int, int]]:
+        """(followed id, since) pairs, most recent follow first."""
+        return self.following.get(user_id, _EMPTY).page(key, limit)
+
+    def follow(self, follower_id: int, followed_id: int, since: int):
+        if self._journal is not None:
+            self._journal.append((True, follower_id, followed_id, since))
+        self.following.setdefault(follower_id, _Edges()).add(followed_id, since)
+        self.followers.setdefault(followed_id, _Edges()).add(follower_id, since)
+
+    def unfollow(self, follower_id: int, followed_id: int):
+        if self._journal is not None:
+            self._journal.append((False, follower_id, followed_id, 0))
+        self.following.get(follower_id, _EMPTY).remove(followed_id)
+        self.followers.get(followed_id, _EMPTY).remove(follower_id)
+
+    def memory(self) -> dict:
+        """Approximate bytes held, for /api/metrics."""
+        edges = sum(len(entry) for entry in self.following.values())
+        nbytes = sys.getsizeof(self.following) + sys.getsizeof(self.followers)
+        nbytes += sum(entry.nbytes() for entry in self.following.values())
+        nbytes += sum(entry.nbytes() for entry in self.followers.values())
+        return {
+            "users": len(set(self.following) | set(self.followers)),
+            "edges": edges,
+            "bytes": nbytes,
+            "bytes_per_edge": round(nbytes / edges, 1) if edges else 0,
+        }
+
+    async def _read(self) -> Tuple[Dict[int, _Edges], Dict[int, _Edges]]:
+        # Imported here because the repositories are built after this module
+        from repositories import repository
+
+        following: Dict[int, list] = {}
+        followers: Dict[int, list] = {}
+        after = (0, 0)
+        while True:
+            rows = await repository.followers.edges(after, LOAD_CHUNK_SIZE)
+            for follower_id, followed_id, since in rows:
+                following.setdefault(follower_id, []).append((since, followed_id))
+                followers.setdefault(followed_id, []).append((since, follower_id))
+            if len(rows) < LOAD_CHUNK_SIZE:
+                break
+            after = rows[-1][:2]
+
+        return (
+            {user_id: _Edges.build(sorted(pairs)) for user_id, pairs in following.items()},
+            {user_id: _Edges.build(sorted(pairs)) for user_id, pairs in followers.items()},
+        )
+
+    async def load(self) -> int:
+        """
+        Replace the graph with the contents of the followers table.
+
+        Returns how many users' follows differed from what was held.
+        """
+        started = time.perf_counter()
+        self._journal = []
+        try:
+            following, followers = await self._read()
+        finally:
+            journal, self._journal = self._journal, None
+
+        mismatches = 0
+        if self.stats["loaded"]:
+            for user_id in set(following) | set(self.following):
+                if following.get(user_id, _EMPTY).ids != self.following.get(user_id, _EMPTY).ids:
+                    mismatches += 1
+
+        self.following, self.followers = following, followers
+        # Changes that raced the read; replaying them again is harmless
+        for followed, follower_id, followed_id, since in journal:
+            if followed:
+                self.follow(follower_id, followed_id, since)
+            else:
+                self.unfollow(follower_id, followed_id)
+
+        self.stats["loaded"] = True
+        self.stats["load_ms"] = round((time.perf_counter() - started) * 1000)
+        return mismatches
+
+    async def check(self) -> int:
+        """Reload from the followers table and record how many users had drifted."""
+        mismatches = await self.load()
+        self.stats["checks"] += 1
+        self.stats["last_check_mismatches"] = mismatches
+        if mismatches:
+            print(f"Social graph differed from the followers table for {mismatches} users")
+        return mismatches
+
+social_graph = SocialGraph()
+
+async def check_periodically(interval: float = SOCIAL_GRAPH_CHECK_INTERVAL):
+    """Run social_graph.check() every interval seconds."""
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await social_graph.check()
+        except Exception as e:
+            print(f"Social graph check failed: {str(e)}")
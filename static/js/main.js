@@ -190,6 +190,84 @@ async function apiRequest(url, method = 'GET', data = null) {
     }
 }
 
+/**
+ * Cursor pagination helpers
+ *
+ * List endpoints return one page at a time and put the cursor of the next
+ * page in the X-Next-Cursor header; there is no header on the last page.
+ */
+function createPager(url) {
+    let cursor = null;
+    let done = false;
+    
+    return {
+        get done() {
+            return done;
+        },
+        async next() {
+            if (done) return [];
+            
+            const pageUrl = new URL(url, window.location.origin);
+            if (cursor) {
+                pageUrl.searchParams.set('cursor', cursor);
+            }
+            
+            const response = await fetch(pageUrl, { credentials: 'include' });
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.detail || 'Something went wrong');
+            }
+            
+            cursor = response.headers.get('X-Next-Cursor');
+            done = !cursor;
+            return await response.json();
+        }
+    };
+}
+
+function loadOnScroll(container, pager, render) {
+    // Fetch the next page whenever the end of the container scrolls into view
+    const sentinel = document.createElement('div');
+    sentinel.className = 'scroll-sentinel';
+    container.after(sentinel);
+    
+    let loading = false;
+    const observer = new IntersectionObserver(async entries => {
+        if (!entries[0].isIntersecting || loading) return;
+        
+        if (pager.done) {
+            observer.disconnect();
+            sentinel.remove();
+            return;
+        }
+        
+        loading = true;
+        try {
+            render(await pager.next());
+        } catch (error) {
+            console.error('Error loading more items:', error);
+            observer.disconnect();
+            sentinel.remove();
+            return;
+        } finally {
+            loading = false;
+        }
+        
+        // Re-observe so a sentinel that is still visible triggers again
+        observer.unobserve(sentinel);
+        observer.observe(sentinel);
+    }, { rootMargin: '600px' });
+    
+    observer.observe(sentinel);
+    
+    return {
+        stop() {
+            observer.disconnect();
+            sentinel.remove();
+        }
+    };
+}
+
 /**
  * Date formatting
  */
@@ -224,6 +302,47 @@ function loadImage(src) {
     });
 }
 
+/**
+ * Image source for a post: served from the image store when available,
+ * falling back to inline data for posts that have not been migrated yet
+ */
+function postImageSrc(post) {
+    if (post.image_url) {
+        return post.image_url;
+    }
+    return `data:image/jpeg;base64,${post.image_data}`;
+}
+
+/**
+ * Point an image element at the resized variants of a post image,
+ * letting the browser pick the smallest one that fits the tile and
+ * prefer AVIF over WebP when it supports it
+ */
+function setPostThumbnail(imgEl, post, sizes = '(max-width: 600px) 50vw, 300px') {
+    imgEl.src = post.thumbnail_url || postImageSrc(post);
+    if (post.image_srcset) {
+        imgEl.srcset = post.image_srcset;
+        imgEl.sizes = sizes;
+    }
+    if (post.image_srcset_avif && imgEl.parentNode) {
+        let picture = imgEl.parentNode;
+        if (picture.tagName !== 'PICTURE') {
+            picture = document.createElement('picture');
+            picture.style.display = 'contents';
+            imgEl.replaceWith(picture);
+            picture.appendChild(imgEl);
+        }
+        let source = picture.querySelector('source[type="image/avif"]');
+        if (!source) {
+            source = document.createElement('source');
+            source.type = 'image/avif';
+            picture.insertBefore(source, imgEl);
+        }
+        source.srcset = post.image_srcset_avif;
+        source.sizes = sizes;
+    }
+}
+
 /**
  * Like post functionality
  */
@@ -361,6 +480,8 @@ function dataURItoBlob(dataURI) {
 window.app = {
     showToast,
     apiRequest,
+    createPager,
+    loadOnScroll,
     formatDate,
     openModal,
     closeModal,
@@ -368,5 +489,7 @@ window.app = {
     followUser,
     validateForm,
     loadImage,
+    postImageSrc,
+    setPostThumbnail,
     dataURItoBlob
 };
\ No newline at end of file
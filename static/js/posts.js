@@ -140,7 +140,7 @@ function renderSinglePost(post, container) {
             </div>
             
             <div class="single-post-image">
-                <img src="data:image/jpeg;base64,${post.image_data}" alt="Post Image">
+                <img src="${window.app.postImageSrc(post)}" alt="Post Image">
             </div>
             
             <div class="single-post-actions">
@@ -177,15 +177,16 @@ function renderSinglePost(post, container) {
 /**
  * Create a new post
  */
-async function createPost(promptText, caption = '', imageData = null) {
+async function createPost(promptText, caption = '', previewToken = null) {
     try {
         const postData = {
             prompt: promptText,
             caption: caption
         };
         
-        if (imageData) {
-            postData.image_data = imageData;
+        if (previewToken) {
+            // Publish the image from /posts/generate-preview instead of a new one
+            postData.preview_token = previewToken;
         }
         
         const response = await window.app.apiRequest('/posts', 'POST', postData);
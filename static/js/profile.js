@@ -245,6 +245,9 @@ function setupTabs() {
     });
 }
 
+// Infinite scroll of the posts grid, replaced when the grid is reloaded
+let userPostsScroll = null;
+
 /**
  * Load user posts
  */
@@ -258,8 +261,13 @@ async function loadUserPosts(userId) {
         postsContainer.innerHTML = '';
         noPostsMessage.style.display = 'none';
         
-        // Fetch user posts
-        const posts = await window.app.apiRequest(`/posts/user/${userId}`);
+        // Fetch the first page of user posts
+        if (userPostsScroll) {
+            userPostsScroll.stop();
+            userPostsScroll = null;
+        }
+        const pager = window.app.createPager(`/posts/user/${userId}`);
+        const posts = await pager.next();
         
         loadingElement.style.display = 'none';
         
@@ -268,8 +276,9 @@ async function loadUserPosts(userId) {
             return;
         }
         
-        // Render posts
+        // Render posts, then load older ones as the user scrolls down
         renderProfilePosts(posts, postsContainer);
+        userPostsScroll = window.app.loadOnScroll(postsContainer, pager, more => renderProfilePosts(more, postsContainer));
     } catch (error) {
         console.error('Error loading user posts:', error);
         loadingElement.style.display = 'none';
@@ -324,7 +333,7 @@ function renderProfilePosts(posts, container) {
         
         // Set post image
         const imgEl = postEl.querySelector('.profile-post-image img');
-        imgEl.src = `data:image/jpeg;base64,${post.image_data}`;
+        window.app.setPostThumbnail(imgEl, post);
         
         // Set like count
         postEl.querySelector('.profile-post-likes span').textContent = post.like_count;
@@ -344,7 +353,7 @@ function showPostModal(post) {
     const modalContent = document.importNode(template.content, true).firstElementChild;
     
     // Set post image
-    modalContent.querySelector('.modal-post-image img').src = `data:image/jpeg;base64,${post.image_data}`;
+    modalContent.querySelector('.modal-post-image img').src = window.app.postImageSrc(post);
     
     // Set username
     modalContent.querySelector('.modal-post-user-info h3').textContent = post.username;
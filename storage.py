@@ -0,0 +1,297 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aiosqlite
+
+from database import db_pool, write_queue, initialize_database
+
+# Root directory of the content-addressed image store
+IMAGE_STORE_PATH = "media"
+
+# Legacy rows moved out of posts.image_data per migration batch
+MIGRATION_BATCH_SIZE = 25
+MIGRATION_BATCH_PAUSE = 0.05  # seconds, leaves room for request traffic between batches
+
+# Blobs written or reused this recently are never deleted, so a post being
+# created from the same bytes has time to commit its reference
+BLOB_DELETE_GRACE = 300  # seconds
+
+# Magic numbers used to detect the stored image type
+_MIME_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def sniff_mime(data: bytes) -> str:
+    """Detect the MIME type of an image from its leading bytes."""
+    for signature, mime in _MIME_SIGNATURES:
+        if data.startswith(signature):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis"):
+        return "image/avif"
+    return "application/octet-stream"
+
+def is_valid_hash(image_hash: str) -> bool:
+    """Check that a string looks like a SHA-256 hex digest."""
+    if len(image_hash) != 64:
+        return False
+    try:
+        int(image_hash, 16)
+    except ValueError:
+        return False
+    return image_hash == image_hash.lower()
+
+def image_url(image_hash: Optional[str]) -> Optional[str]:
+    """Public URL an image can be fetched from."""
+    if not image_hash:
+        return None
+    return f"/images/{image_hash}"
+
+class BlobStore:
+    """
+    Content-addressed store for image bytes.
+
+    Blobs are named by the SHA-256 of their contents and sharded into two
+    levels of directories (ab/cd/abcd...) so no single directory grows huge.
+    Writing the same bytes twice stores them once.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def path(self, image_hash: str) -> Path:
+        """Location of a blob on disk."""
+        return self.root / image_hash[:2] / image_hash[2:4] / image_hash
+
+    def exists(self, image_hash: str) -> bool:
+        return self.path(image_hash).is_file()
+
+    def put(self, data: bytes, image_hash: Optional[str] = None) -> dict:
+        """Store bytes and return their hash, size and MIME type."""
+        image_hash = image_hash or hashlib.sha256(data).hexdigest()
+        target = self.path(image_hash)
+
+        try:
+            # Already stored; mark it as in use so delete_blobs leaves it alone
+            os.utime(target)
+        except FileNotFoundError:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so readers never see a partial blob
+            fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as tmp:
+                    tmp.write(data)
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                os.replace(tmp_path, target)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+
+        return {
+            "image_hash": image_hash,
+            "image_size": len(data),
+            "image_mime": sniff_mime(data),
+        }
+
+    def read(self, image_hash: str) -> bytes:
+        return self.path(image_hash).read_bytes()
+
+    def mime(self, image_hash: str) -> str:
+        """Detect the MIME type of a stored blob."""
+        with open(self.path(image_hash), "rb") as f:
+            return sniff_mime(f.read(16))
+
+    def delete(self, image_hash: str, grace: float = 0) -> bool:
+        """
+        Remove a blob if it exists and was not written or reused within
+        grace seconds; False if it was kept for that reason.
+        """
+        path = self.path(image_hash)
+        try:
+            if grace and path.stat().st_mtime > time.time() - grace:
+                return False
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        return True
+
+blob_store = BlobStore(IMAGE_STORE_PATH)
+
+# Per-hash locks held while storing a blob and while deleting it, so a
+# blob is never reused between delete_blobs() checking it and unlinking
+# it; writes of different images do not wait for each other
+_blob_locks: Dict[str, asyncio.Lock] = {}
+_blob_lock_users: Dict[str, int] = {}
+
+# Deletions waiting out the grace period
+_pending = set()
+
+# Whether any post still uses an image, off idx_posts_image_hash
+IMAGE_REFERENCE_QUERY = "SELECT 1 FROM posts WHERE image_hash = ? LIMIT 1"
+
+@asynccontextmanager
+async def _blob_lock(image_hash: str):
+    lock = _blob_locks.setdefault(image_hash, asyncio.Lock())
+    _blob_lock_users[image_hash] = _blob_lock_users.get(image_hash, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _blob_lock_users[image_hash] -= 1
+        if not _blob_lock_users[image_hash]:
+            del _blob_lock_users[image_hash]
+            del _blob_locks[image_hash]
+
+def _decode(b64_data: str):
+    data = base64.b64decode(b64_data, validate=True)
+    return data, hashlib.sha256(data).hexdigest()
+
+async def save_image(b64_data: str) -> dict:
+    """Store a base64 encoded image without blocking the event loop."""
+    data, image_hash = await asyncio.to_thread(_decode, b64_data)
+    async with _blob_lock(image_hash):
+        return await asyncio.to_thread(blob_store.put, data, image_hash)
+
+async def release_image(db: aiosqlite.Connection, image_hash: str) -> List[str]:
+    """
+    Forget the variants of an image no post references any more.
+
+    The caller checks the posts, which may live in another database. Runs
+    inside a write and returns the blobs that became unreferenced; pass
+    them to delete_blobs() after the write has committed.
+    """
+    cursor = await db.execute("SELECT image_hash FROM image_variants WHERE source_hash = ?", (image_hash,))
+    variant_hashes = [row[0] for row in await cursor.fetchall()]
+    await db.execute("DELETE FROM image_variants WHERE source_hash = ?", (image_hash,))
+
+    orphans = []
+    for variant_hash in variant_hashes:
+        cursor = await db.execute("SELECT 1 FROM image_variants WHERE image_hash = ? LIMIT 1", (variant_hash,))
+        if await cursor.fetchone() is None:
+            orphans.append(variant_hash)
+    orphans.append(image_hash)
+    return orphans
+
+async def delete_blobs(
+    hashes: List[str],
+    references_image: Callable[[str], Awaitable[bool]],
+    grace: float = BLOB_DELETE_GRACE,
+):
+    """
+    Delete blobs returned by release_image(), skipping any that were reused since.
+
+    references_image tells whether a post uses a hash, usually
+    repository.posts.references_image, as posts may not live in the local
+    database. Blobs stored again within the grace period may belong to a
+    post whose row is not committed yet; they are checked again once it
+    has passed.
+    """
+    recent = []
+    for image_hash in hashes:
+        async with _blob_lock(image_hash):
+            if await references_image(image_hash):
+                continue
+            async with db_pool.read() as db:
+                cursor = await db.execute("SELECT 1 FROM image_variants WHERE image_hash = ? LIMIT 1", (image_hash,))
+                if await cursor.fetchone() is not None:
+                    continue
+            if not await asyncio.to_thread(blob_store.delete, image_hash, grace):
+                recent.append(image_hash)
+    if recent:
+        task = asyncio.create_task(_delete_later(recent, references_image, grace))
+        # Keep a reference so the task is not garbage collected while waiting
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+
+async def _delete_later(hashes: List[str], references_image: Callable[[str], Awaitable[bool]], grace: float):
+    await asyncio.sleep(grace)
+    try:
+        await delete_blobs(hashes, references_image, grace)
+    except Exception as e:
+        print(f"Deleting unreferenced blobs failed: {str(e)}")
+
+async def _apply_migration(db: aiosqlite.Connection, updates: list) -> int:
+    migrated = 0
+    for update in updates:
+        # Only clear the inline copy if nobody else migrated the row meanwhile
+        cursor = await db.execute("""
+            UPDATE posts
+            SET image_hash = ?, image_size = ?, image_mime = ?, image_data = ''
+            WHERE id = ? AND image_hash IS NULL
+        """, update)
+        migrated += cursor.rowcount
+    return migrated
+
+async def migrate_inline_images(batch_size: int = MIGRATION_BATCH_SIZE, pause: float = MIGRATION_BATCH_PAUSE) -> int:
+    """
+    Move base64 images still stored in posts.image_data into the blob store.
+
+    Rows are processed in small batches, each committed on its own, so the
+    app keeps serving while this runs. Progress lives in the table itself
+    (rows with image_hash still NULL), so an interrupted run simply picks up
+    where it left off the next time it is started.
+    """
+    migrated = 0
+    last_id = 0
+
+    while True:
+        async with db_pool.read() as db:
+            cursor = await db.execute("""
+                SELECT id, image_data FROM posts
+                WHERE id > ? AND image_hash IS NULL AND image_data != ''
+                ORDER BY id
+                LIMIT ?
+            """, (last_id, batch_size))
+            rows = await cursor.fetchall()
+
+        if not rows:
+            break
+
+        # Write the files first so the writer is only held for the updates
+        updates = []
+        for row in rows:
+            last_id = row["id"]
+            try:
+                info = await save_image(row["image_data"])
+            except (binascii.Error, ValueError) as e:
+                print(f"Skipping post {row['id']}: invalid image data ({e})")
+                continue
+            updates.append((info["image_hash"], info["image_size"], info["image_mime"], row["id"]))
+
+        migrated += await write_queue.submit(_apply_migration, updates)
+
+        await asyncio.sleep(pause)
+
+    if migrated:
+        print(f"Moved {migrated} inline images into the image store")
+    return migrated
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        print("Usage: python storage.py migrate")
+        sys.exit(1)
+    initialize_database()
+
+    async def main():
+        try:
+            await migrate_inline_images()
+        finally:
+            await write_queue.stop()
+            await db_pool.close()
+
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+# The app modules live at the top of the repository, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Images come from the local stand-in, never the hosted API
+os.environ.setdefault("IMAGE_BACKEND", "stub")
+
+from database import ConnectionPool, WriteQueue, DATABASE_PATH, initialize_database
+from trending import TRENDING_HALF_LIFE_HOURS
+import counters
+import derivatives
+import repositories.sqlite
+import storage
+
+# Tables the PostgreSQL suite empties before every test
+POSTGRES_TABLES = ("timeline", "likes", "followers", "post_trending", "trending_state", "posts", "users")
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+async def local_db(tmp_path, monkeypatch):
+    """
+    A scratch imageshare.db with its own pool and write queue.
+
+    Both backends need it: the SQLite repository keeps everything there,
+    the PostgreSQL one still records image variants in it.
+    """
+    # DATABASE_PATH and the image store are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    initialize_database()
+
+    pool = ConnectionPool(DATABASE_PATH)
+    queue = WriteQueue(pool)
+    await pool.open()
+    queue.start()
+    for module in (repositories.sqlite, storage, derivatives, counters):
+        monkeypatch.setattr(module, "db_pool", pool)
+        monkeypatch.setattr(module, "write_queue", queue)
+    try:
+        yield pool, queue
+    finally:
+        await queue.stop()
+        await pool.close()
+
+@pytest.fixture(params=["sqlite", "postgres"])
+async def repo(request, local_db, monkeypatch):
+    """
+    Every Repository implementation behind the same contract.
+
+    The PostgreSQL one runs against DATABASE_URL, which must point at a
+    scratch database: its tables are emptied before each test.
+    """
+    if request.param == "sqlite":
+        repository = repositories.sqlite.SQLiteRepository()
+    else:
+        dsn = os.environ.get("DATABASE_URL")
+        if not dsn:
+            pytest.skip("DATABASE_URL is not set")
+        # asyncpg is only needed for this backend
+        from repositories import postgres
+        _, queue = local_db
+        monkeypatch.setattr(postgres, "write_queue", queue)
+        repository = postgres.PostgresRepository(dsn)
+
+    await repository.open()
+    if request.param == "postgres":
+        async with repository.transaction() as conn:
+            await conn.execute(f"TRUNCATE {', '.join(POSTGRES_TABLES)} RESTART IDENTITY CASCADE")
+    # Sets up the trending epoch, as ensure_scores() does at startup
+    await repository.posts.rebuild_trending(TRENDING_HALF_LIFE_HOURS * 3600)
+    try:
+        yield repository
+    finally:
+        await repository.close()
@@ -0,0 +1,15 @@
+import pytest
+from fastapi import HTTPException
+
+import auth
+
+pytestmark = pytest.mark.anyio
+
+async def test_only_listed_users_are_admins(monkeypatch):
+    monkeypatch.setattr(auth, "ADMIN_USERNAMES", frozenset({"root"}))
+    root = {"id": 1, "username": "root"}
+    assert await auth.get_current_admin(root) == root
+
+    with pytest.raises(HTTPException) as forbidden:
+        await auth.get_current_admin({"id": 2, "username": "alice"})
+    assert forbidden.value.status_code == 403
@@ -0,0 +1,62 @@
+import pytest
+
+import repositories.sqlite
+from counters import reconcile_counters
+
+pytestmark = pytest.mark.anyio
+
+def _image(n: int = 0) -> dict:
+    return {"image_hash": f"{n:064x}", "image_size": 100 + n, "image_mime": "image/jpeg"}
+
+@pytest.fixture
+async def sqlite_repo(local_db):
+    """counters.py re-counts the SQLite tables only."""
+    repository = repositories.sqlite.SQLiteRepository()
+    await repository.open()
+    try:
+        yield repository
+    finally:
+        await repository.close()
+
+async def _counts(repo, user_id: int) -> tuple:
+    row = await repo.users.get(user_id)
+    return row["post_count"], row["follower_count"], row["following_count"]
+
+async def test_triggers_follow_every_change(repo):
+    alice = await repo.users.create("alice", "alice@example.com", "hash")
+    bob = await repo.users.create("bob", "bob@example.com", "hash")
+    post_id = await repo.posts.create(alice["id"], "a cat", None, _image())
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    await repo.likes.toggle(bob["id"], post_id)
+    assert await _counts(repo, alice["id"]) == (1, 1, 0)
+    assert await _counts(repo, bob["id"]) == (0, 0, 1)
+    assert (await repo.posts.get(post_id, None))["like_count"] == 1
+
+    # Deleting the post takes its likes with it
+    await repo.posts.delete(post_id, alice["id"])
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    assert await _counts(repo, alice["id"]) == (0, 0, 0)
+    assert await _counts(repo, bob["id"]) == (0, 0, 0)
+
+async def test_reconcile_repairs_drift(sqlite_repo, local_db):
+    repo = sqlite_repo
+    _, write_queue = local_db
+    alice = await repo.users.create("alice", "alice@example.com", "hash")
+    bob = await repo.users.create("bob", "bob@example.com", "hash")
+    post_id = await repo.posts.create(alice["id"], "a cat", None, _image())
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    await repo.likes.toggle(bob["id"], post_id)
+
+    async def corrupt(db):
+        await db.execute("UPDATE posts SET like_count = 7")
+        await db.execute("UPDATE users SET follower_count = 5 WHERE id = ?", (alice["id"],))
+    await write_queue.submit(corrupt)
+
+    stats = await reconcile_counters()
+    assert (stats["posts_repaired"], stats["users_repaired"]) == (1, 1)
+    assert (await repo.posts.get(post_id, None))["like_count"] == 1
+    assert await _counts(repo, alice["id"]) == (1, 1, 0)
+
+    # Nothing left to repair
+    stats = await reconcile_counters()
+    assert (stats["posts_repaired"], stats["users_repaired"]) == (0, 0)
@@ -0,0 +1,66 @@
+import pytest
+
+import repositories
+import storage
+from derivatives import attach_variants, available_formats, generate_derivatives, shutdown_pool, variants_query
+from generation_backends import StubBackend
+from storage import save_image
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not available_formats(), reason="Pillow cannot encode WebP or AVIF here"),
+]
+
+@pytest.fixture
+def posts(repo, monkeypatch):
+    """The repository, as derivatives.py finds it, with a worker pool started in this directory."""
+    monkeypatch.setattr(repositories, "repository", repo)
+    try:
+        yield repo.posts
+    finally:
+        # Workers resolve the relative image store path from where they started
+        shutdown_pool()
+
+async def _post(repo, width: int):
+    user = await repo.users.create("alice", "alice@example.com", "hash")
+    image = await save_image(StubBackend(size=width)._draw("a cat"))
+    return user, image, await repo.posts.create(user["id"], "a cat", None, image)
+
+async def _variants(local_db, source_hash: str) -> list:
+    pool, _ = local_db
+    async with pool.read() as db:
+        cursor = await db.execute(*variants_query([source_hash]))
+        return [tuple(row) for row in await cursor.fetchall()]
+
+async def test_variants_are_recorded(repo, posts, local_db):
+    _, image, _ = await _post(repo, 600)
+    await generate_derivatives(image["image_hash"])
+
+    variants = await _variants(local_db, image["image_hash"])
+    assert sorted((width, fmt) for _, width, fmt, _ in variants) == sorted(
+        (width, fmt) for width in (256, 512) for fmt in available_formats()
+    )
+    assert all(storage.blob_store.exists(variant_hash) for *_, variant_hash in variants)
+
+    pool, _ = local_db
+    async with pool.read() as db:
+        [post] = await attach_variants(db, [dict(image)])
+    assert post["thumbnail_url"] != storage.image_url(image["image_hash"])
+    assert post["image_srcset"].count("w, ") == 1
+
+async def test_small_images_get_one_width(repo, posts, local_db):
+    _, image, _ = await _post(repo, 100)
+    await generate_derivatives(image["image_hash"])
+    assert {width for _, width, _, _ in await _variants(local_db, image["image_hash"])} == {100}
+
+async def test_variants_of_a_deleted_post_are_released(repo, posts, local_db):
+    user, image, post_id = await _post(repo, 600)
+    # Deleted while its derivatives were still being made
+    await repo.posts.delete(post_id, user["id"])
+    await generate_derivatives(image["image_hash"])
+
+    assert await _variants(local_db, image["image_hash"]) == []
+    # The new variant blobs are recent, so their deletion waits out the grace period
+    assert storage._pending
+    for task in list(storage._pending):
+        task.cancel()
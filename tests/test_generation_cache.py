@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import generation
+from generation import GenerationCache, generate_image, normalize_prompt
+from generation_backends import ResilientBackend, StubBackend
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def stub(monkeypatch):
+    """A slow stand-in generator behind a fresh, empty cache."""
+    stub = StubBackend(latency="0.05")
+    monkeypatch.setattr(generation, "generator", ResilientBackend(stub))
+    monkeypatch.setattr(generation, "generation_cache", GenerationCache(max_bytes=1024 * 1024, ttl=60))
+    return stub
+
+def test_normalize_prompt():
+    assert normalize_prompt("  a\tred   cat\n") == "a red cat"
+    assert normalize_prompt("café") == normalize_prompt("café")
+
+async def test_identical_prompts_share_one_call(stub):
+    images = await asyncio.gather(*(generate_image("a red cat") for _ in range(5)))
+    assert stub.calls == 1
+    assert len(set(images)) == 1
+    assert not generation._in_flight
+
+    # Later requests are served from the cache, whatever the spacing
+    assert await generate_image(" a  red cat ") == images[0]
+    assert stub.calls == 1
+    assert generation.generation_cache.stats()["hits"] == 1
+
+async def test_fresh_bypasses_the_cache_and_calls_in_flight(stub):
+    await generate_image("a red cat")
+    assert stub.calls == 1
+
+    assert await generate_image("a red cat", fresh=True)
+    assert stub.calls == 2
+
+    # A fresh request does not wait on an identical call in progress either
+    pending = asyncio.ensure_future(generate_image("a blue cat"))
+    await asyncio.sleep(0)
+    await asyncio.gather(pending, generate_image("a blue cat", fresh=True))
+    assert stub.calls == 4
+
+def test_cache_is_bounded_by_bytes():
+    cache = GenerationCache(max_bytes=25, ttl=60)
+    for key in "abc":
+        cache.put(key, "x" * 10)
+    assert cache.get("a") is None
+    assert cache.get("c") == "x" * 10
+    assert cache.stats()["bytes"] == 20
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,226 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+
+import generation
+import generation_backends
+from auth import get_current_user
+from generation import CLIENT_CLOSED_REQUEST, FAILED, GenerationQueue, RUNNING, SUCCEEDED
+from generation_backends import GenerationBackend, ResilientBackend, StubBackend, build_backend
+from routers import post
+
+pytestmark = pytest.mark.anyio
+
+def _recorder(order: list, name: str, result: dict = None):
+    async def work(job):
+        order.append(name)
+        await asyncio.sleep(0)
+        return result or {"name": name}
+    return work
+
+def _sleeper(finished: list):
+    async def work(job):
+        await asyncio.sleep(10)
+        finished.append(job.id)
+        return {}
+    return work
+
+class _GoneRequest:
+    """A request whose client disconnects straight away."""
+    async def receive(self) -> dict:
+        await asyncio.sleep(0.01)
+        return {"type": "http.disconnect"}
+
+def _events(stream: str) -> list:
+    """(name, data) of each Server-Sent Event, skipping keep-alive comments."""
+    events = []
+    for block in stream.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+        if lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def _test_user(request: Request) -> dict:
+    return {"id": int(request.headers.get("X-User", "1"))}
+
+@pytest.fixture
+async def queue():
+    queue = GenerationQueue(workers=1)
+    yield queue
+    await queue.stop()
+
+@pytest.fixture
+async def client(monkeypatch):
+    """The posts router with a fresh job queue, a stub image backend and X-User for auth."""
+    queue = GenerationQueue(workers=2)
+    monkeypatch.setattr(post, "generation_queue", queue)
+    monkeypatch.setattr(generation, "generator", ResilientBackend(StubBackend(latency="0.02")))
+
+    app = FastAPI()
+    app.include_router(post.router)
+    app.dependency_overrides[get_current_user] = _test_user
+
+    queue.start()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            yield client
+    finally:
+        await queue.stop()
+
+async def test_users_take_turns(queue):
+    order = []
+    jobs = [queue.submit(1, "preview", f"a{n}", _recorder(order, f"a{n}")) for n in range(3)]
+    jobs.append(queue.submit(2, "preview", "b0", _recorder(order, "b0")))
+
+    queue.start()
+    await asyncio.gather(*(job.outcome() for job in jobs))
+    # User 2 does not wait behind all of user 1's queue
+    assert order == ["a0", "b0", "a1", "a2"]
+
+async def test_per_user_and_global_limits():
+    queue = GenerationQueue(workers=1, user_queue_limit=2, queue_limit=3)
+    for n in range(2):
+        queue.submit(1, "preview", f"a{n}", _recorder([], "a"))
+    with pytest.raises(HTTPException) as too_many:
+        queue.submit(1, "preview", "a2", _recorder([], "a"))
+    assert too_many.value.status_code == 429
+    assert too_many.value.headers["Retry-After"]
+
+    queue.submit(2, "preview", "b0", _recorder([], "b"))
+    with pytest.raises(HTTPException) as busy:
+        queue.submit(3, "preview", "c0", _recorder([], "c"))
+    assert busy.value.status_code == 503
+    assert queue.stats()["rejected"] == 2
+
+async def test_wait_forgets_the_job(queue):
+    queue.start()
+    job = queue.submit(1, "preview", "a", _recorder([], "a", {"image_data": "x" * 1000}))
+    assert await queue.wait(job) == {"image_data": "x" * 1000}
+    assert queue.get(job.id) is None
+    assert queue.stats()["stored_bytes"] == 0
+
+async def test_cancel_queued_job():
+    queue = GenerationQueue(workers=1)
+    job = queue.submit(1, "preview", "a", _recorder([], "a"))
+    queue.cancel(job)
+    assert job.status == FAILED
+    assert job.error_status == CLIENT_CLOSED_REQUEST
+    assert queue.stats()["queued"] == 0
+    assert queue.stats()["users_waiting"] == 0
+
+async def test_cancel_running_job(queue):
+    finished = []
+    queue.start()
+    job = queue.submit(1, "preview", "a", _sleeper(finished))
+    while job.status != RUNNING:
+        await asyncio.sleep(0.01)
+    queue.cancel(job)
+    with pytest.raises(HTTPException) as cancelled:
+        await job.outcome()
+    assert cancelled.value.status_code == CLIENT_CLOSED_REQUEST
+    assert finished == []
+    assert queue.stats()["cancelled"] == 1
+
+    # The worker carries on with the next job
+    later = queue.submit(1, "preview", "b", _recorder([], "b"))
+    assert await later.outcome() == {"name": "b"}
+
+async def test_wait_cancels_when_the_client_goes_away(queue):
+    finished = []
+    queue.start()
+    job = queue.submit(1, "post", "a", _sleeper(finished))
+    with pytest.raises(HTTPException):
+        await queue.wait(job, _GoneRequest())
+    assert job.cancelled
+    assert finished == []
+    assert queue.get(job.id) is None
+
+async def test_finished_jobs_are_capped_by_bytes():
+    queue = GenerationQueue(workers=1, max_bytes=2500)
+    queue.start()
+    try:
+        jobs = [queue.submit(1, "preview", f"a{n}", _recorder([], "a", {"image_data": "x" * 1000})) for n in range(3)]
+        for job in jobs:
+            await job.outcome()
+        assert queue.get(jobs[0].id) is None
+        assert [queue.get(job.id) for job in jobs[1:]] == jobs[1:]
+        assert queue.stats()["stored_bytes"] == 2000
+        assert queue.stats()["evicted"] == 1
+    finally:
+        await queue.stop()
+
+async def test_poll_job(client):
+    response = await client.post("/posts/jobs", json={"prompt": "a polled cat"})
+    assert response.status_code == 202
+    location = response.headers["Location"]
+    assert response.json()["status"] in ("queued", "running")
+
+    for _ in range(200):
+        job = (await client.get(location)).json()
+        if job["status"] == SUCCEEDED:
+            break
+        await asyncio.sleep(0.01)
+    assert job["status"] == SUCCEEDED
+    assert job["result"]["image_data"]
+    assert job["result"]["preview_token"]
+
+    assert (await client.get(location, headers={"X-User": "2"})).status_code == 404
+    assert (await client.get("/posts/jobs/missing")).status_code == 404
+
+async def test_event_stream_order(client):
+    response = await client.post("/posts/jobs", json={"prompt": "a streamed cat", "variants": 3})
+    location = response.headers["Location"]
+
+    events = _events((await client.get(f"{location}/events")).text)
+    names = [name for name, _ in events]
+    statuses = [name for name in names if name != "variant"]
+    # Status events follow the job's lifecycle, once each, ending with the outcome
+    assert statuses == [status for status in ("queued", "running", "succeeded") if status in statuses]
+    assert names[-1] == "succeeded"
+    # Every variant arrives, in order, before the final event
+    assert [data["index"] for name, data in events if name == "variant"] == [0, 1, 2]
+    assert "variants" not in events[-1][1]
+    assert events[-1][1]["result"]["preview_tokens"] == [data["preview_token"] for name, data in events if name == "variant"]
+
+async def test_late_event_stream_replays_the_variants(client):
+    response = await client.post("/posts/jobs", json={"prompt": "a finished cat", "variants": 2})
+    job = await post.generation_queue.get(response.json()["id"]).outcome()
+
+    # Opened after the job finished, the stream still has every image
+    events = _events((await client.get(f"{response.headers['Location']}/events")).text)
+    assert [name for name, _ in events] == ["variant", "variant", "succeeded"]
+    assert [data["preview_token"] for _, data in events[:2]] == job["preview_tokens"]
+
+async def test_variants_come_from_one_batched_call(client):
+    stub = generation.generator.backend
+    calls = stub.calls
+    response = await client.post("/posts/generate-preview", json={"prompt": "a batched cat", "variants": 3})
+    assert response.status_code == 200
+    variants = response.json()["variants"]
+    assert stub.calls == calls + 1
+    assert [variant["index"] for variant in variants] == [0, 1, 2]
+    assert len({variant["image_data"] for variant in variants}) == 3
+    assert response.json()["preview_tokens"] == [variant["preview_token"] for variant in variants]
+
+    response = await client.post("/posts/generate-preview", json={"prompt": "a batched cat", "variants": generation.GENERATION_MAX_VARIANTS + 1})
+    assert response.status_code == 400
+
+async def test_generate_preview_does_not_keep_the_job(client):
+    response = await client.post("/posts/generate-preview", json={"prompt": "a waited cat"})
+    assert response.status_code == 200
+    assert response.json()["image_data"]
+    assert post.generation_queue.stats()["jobs"] == 0
+    assert post.generation_queue.stats()["stored_bytes"] == 0
+
+def test_together_needs_an_api_key(monkeypatch):
+    monkeypatch.setattr(generation_backends, "TOGETHER_API_KEY", None)
+    with pytest.raises(ValueError):
+        build_backend("together")
+    assert isinstance(build_backend("stub").backend, StubBackend)
+
+def test_backends_must_implement_generate():
+    with pytest.raises(TypeError):
+        GenerationBackend()
@@ -0,0 +1,94 @@
+import base64
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException, Response
+
+from pagination import MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, decode_cursor, encode_cursor, page_size, paginate
+from routers import post
+import repositories.sqlite
+
+pytestmark = pytest.mark.anyio
+
+def _token(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+@pytest.fixture
+async def client(local_db, monkeypatch):
+    """The posts router on a scratch SQLite repository, without auth."""
+    repository = repositories.sqlite.SQLiteRepository()
+    monkeypatch.setattr(post, "repository", repository)
+    monkeypatch.setattr(post, "db_pool", local_db[0])
+    app = FastAPI()
+    app.include_router(post.router)
+
+    await repository.open()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            yield client, repository
+    finally:
+        await repository.close()
+
+def test_cursor_round_trip():
+    key = ["2024-01-01 12:00:00", 42]
+    assert decode_cursor(encode_cursor(key), (str, int)) == key
+    assert decode_cursor(None, (str, int)) is None
+    assert decode_cursor("", (str, int)) is None
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    _token(b"not json"),
+    _token(b'{"id": 1}'),
+    _token(b'["2024-01-01 12:00:00"]'),
+    _token(b'["2024-01-01 12:00:00", 1, 2]'),
+    _token(b'["2024-01-01 12:00:00", "1"]'),
+    _token(b'["2024-01-01 12:00:00", true]'),
+    _token(b'[null, 1]'),
+])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as rejected:
+        decode_cursor(cursor, (str, int))
+    assert rejected.value.status_code == 400
+
+def test_float_keys_accept_whole_numbers():
+    assert decode_cursor(encode_cursor([1700000000, 2.5, 3]), (float, float, int)) == [1700000000, 2.5, 3]
+
+def test_page_size_is_clamped():
+    assert page_size(None, default=12) == 12
+    assert page_size(0) == 1
+    assert page_size(MAX_PAGE_SIZE + 1) == MAX_PAGE_SIZE
+
+def test_paginate_sets_the_next_cursor_only_when_more_rows_exist():
+    rows = [{"id": n} for n in (5, 4, 3)]
+    response = Response()
+    page, cursor = paginate(rows, 2, lambda row: [row["id"]], response)
+    assert page == rows[:2]
+    assert decode_cursor(cursor, (int,)) == [4]
+    assert response.headers[NEXT_CURSOR_HEADER] == cursor
+
+    response = Response()
+    page, cursor = paginate(rows, 3, lambda row: [row["id"]], response)
+    assert page == rows
+    assert cursor is None
+    assert NEXT_CURSOR_HEADER not in response.headers
+
+async def test_explore_pages_follow_the_cursor_header(client):
+    client, repository = client
+    alice = await repository.users.create("alice", "alice@example.com", "hash")
+    image = {"image_hash": "0" * 64, "image_size": 100, "image_mime": "image/jpeg"}
+    post_ids = [await repository.posts.create(alice["id"], f"post {n}", None, image) for n in range(5)]
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = await client.get("/posts/", params=params)
+        assert response.status_code == 200
+        seen.extend(row["id"] for row in response.json())
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+        if cursor is None:
+            break
+    assert seen == post_ids[::-1]
+
+    response = await client.get("/posts/", params={"filter": "popular", "cursor": encode_cursor(["x", 1])})
+    assert response.status_code == 400
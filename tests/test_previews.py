@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from models import PostCreate
+from previews import PreviewStore
+from routers import post
+
+pytestmark = pytest.mark.anyio
+
+def test_pop_takes_the_preview_once():
+    store = PreviewStore()
+    token = store.put(1, "a cat", "image")
+
+    with pytest.raises(HTTPException) as other_user:
+        store.pop(token, 2, "a cat")
+    assert other_user.value.status_code == 410
+    with pytest.raises(HTTPException) as other_prompt:
+        store.pop(token, 1, "a dog")
+    assert other_prompt.value.status_code == 400
+
+    assert store.pop(token, 1, "a cat") == "image"
+    with pytest.raises(HTTPException) as taken:
+        store.pop(token, 1, "a cat")
+    assert taken.value.status_code == 410
+    assert store.stats()["bytes"] == 0
+
+def test_restore_puts_the_preview_back():
+    store = PreviewStore()
+    token = store.put(1, "a cat", "image")
+    image_data = store.pop(token, 1, "a cat")
+    store.restore(token, 1, "a cat", image_data)
+    assert store.pop(token, 1, "a cat") == "image"
+
+async def test_concurrent_publishes_of_one_preview(monkeypatch):
+    store = PreviewStore()
+    monkeypatch.setattr(post, "preview_store", store)
+
+    async def failing_save(image_data):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(post, "save_image", failing_save)
+
+    token = store.put(1, "a cat", "image")
+    post_data = PostCreate(prompt="a cat", preview_token=token)
+    outcomes = await asyncio.gather(
+        post._create_post("a cat", post_data, 1),
+        post._create_post("a cat", post_data, 1),
+        return_exceptions=True,
+    )
+    # Only one request takes the token; the other never reaches the save
+    assert sorted(outcome.status_code for outcome in outcomes) == [410, 500]
+    # The save failed, so the preview can still be published
+    assert store.pop(token, 1, "a cat") == "image"
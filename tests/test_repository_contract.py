@@ -0,0 +1,221 @@
+import pytest
+from fastapi import HTTPException
+
+from search import MATCH_START, MATCH_END
+
+# Every test runs once per backend through the repo fixture in conftest.py
+pytestmark = pytest.mark.anyio
+
+def _image(n: int = 0) -> dict:
+    return {"image_hash": f"{n:064x}", "image_size": 100 + n, "image_mime": "image/jpeg"}
+
+async def _user(repo, name: str) -> dict:
+    return await repo.users.create(name, f"{name}@example.com", "hash")
+
+async def _walk(fetch, key_fields, limit: int = 2) -> list:
+    """Page through a list method the way the handlers do; returns the ids per page."""
+    pages = []
+    key = None
+    while True:
+        rows = await fetch(key, limit + 1)
+        pages.append([row["id"] for row in rows[:limit]])
+        if len(rows) <= limit:
+            return pages
+        key = [rows[limit - 1][field] for field in key_fields]
+
+async def test_user_crud(repo):
+    alice = await _user(repo, "alice")
+    assert alice["username"] == "alice"
+    assert (await repo.users.get(alice["id"]))["email"] == "alice@example.com"
+    assert (await repo.users.get_by_username("alice"))["id"] == alice["id"]
+    assert await repo.users.get(alice["id"] + 100) is None
+    assert await repo.users.get_by_username("nobody") is None
+
+    updated = await repo.users.update(alice["id"], {"bio": "hello"})
+    assert updated["bio"] == "hello"
+
+    bob = await _user(repo, "bob")
+    users = await repo.users.get_many([alice["id"], bob["id"], bob["id"] + 100])
+    assert sorted(user["username"] for user in users) == ["alice", "bob"]
+    assert all("password" not in user for user in users)
+
+async def test_duplicate_user(repo):
+    await _user(repo, "alice")
+    with pytest.raises(HTTPException) as taken:
+        await repo.users.create("alice", "other@example.com", "hash")
+    assert taken.value.status_code == 400
+    with pytest.raises(HTTPException) as taken:
+        await repo.users.create("other", "alice@example.com", "hash")
+    assert taken.value.status_code == 400
+
+async def test_post_crud(repo):
+    alice = await _user(repo, "alice")
+    bob = await _user(repo, "bob")
+    post_id = await repo.posts.create(alice["id"], "a red cat", "caption", _image(1))
+
+    post = await repo.posts.get(post_id, bob["id"])
+    assert post["prompt"] == "a red cat"
+    assert post["caption"] == "caption"
+    assert post["username"] == "alice"
+    assert post["image_hash"] == _image(1)["image_hash"]
+    assert not post["liked_by_user"]
+
+    [summary] = await repo.posts.get_many([post_id, post_id + 100], bob["id"])
+    assert summary["id"] == post_id
+    assert summary["username"] == "alice"
+
+    with pytest.raises(HTTPException) as not_owner:
+        await repo.posts.delete(post_id, bob["id"])
+    assert not_owner.value.status_code == 404
+
+    await repo.posts.delete(post_id, alice["id"])
+    assert await repo.posts.get(post_id, None) is None
+    with pytest.raises(HTTPException) as gone:
+        await repo.posts.delete(post_id, alice["id"])
+    assert gone.value.status_code == 404
+
+async def test_like_toggle(repo):
+    alice = await _user(repo, "alice")
+    bob = await _user(repo, "bob")
+    post_id = await repo.posts.create(alice["id"], "a cat", None, _image())
+
+    assert await repo.likes.toggle(bob["id"], post_id) == ("liked", 1)
+    assert await repo.likes.toggle(alice["id"], post_id) == ("liked", 2)
+    assert (await repo.posts.get(post_id, bob["id"]))["liked_by_user"]
+    assert [row["id"] for row in await repo.likes.liked_posts(bob["id"], None, 10)] == [post_id]
+
+    assert await repo.likes.toggle(bob["id"], post_id) == ("unliked", 1)
+    assert not (await repo.posts.get(post_id, bob["id"]))["liked_by_user"]
+    assert await repo.likes.liked_posts(bob["id"], None, 10) == []
+
+    with pytest.raises(HTTPException) as missing:
+        await repo.likes.toggle(bob["id"], post_id + 100)
+    assert missing.value.status_code == 404
+
+async def test_follow_toggle(repo):
+    alice = await _user(repo, "alice")
+    bob = await _user(repo, "bob")
+
+    assert await repo.followers.toggle(bob["id"], alice["id"], 1700000000) == "followed"
+    assert await repo.followers.edges((0, 0), 10) == [(bob["id"], alice["id"], 1700000000)]
+
+    assert await repo.followers.toggle(bob["id"], alice["id"], 1700000100) == "unfollowed"
+    assert await repo.followers.edges((0, 0), 10) == []
+
+    with pytest.raises(HTTPException) as missing:
+        await repo.followers.toggle(bob["id"], alice["id"] + 100, 1700000000)
+    assert missing.value.status_code == 404
+
+async def test_follow_updates_feed(repo):
+    alice = await _user(repo, "alice")
+    bob = await _user(repo, "bob")
+    post_id = await repo.posts.create(alice["id"], "a cat", None, _image())
+
+    assert await repo.posts.feed(bob["id"], None, 10) == []
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    assert [row["id"] for row in await repo.posts.feed(bob["id"], None, 10)] == [post_id]
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    assert await repo.posts.feed(bob["id"], None, 10) == []
+
+async def test_counters(repo):
+    alice = await _user(repo, "alice")
+    bob = await _user(repo, "bob")
+    carol = await _user(repo, "carol")
+    first = await repo.posts.create(alice["id"], "one", None, _image(1))
+    await repo.posts.create(alice["id"], "two", None, _image(2))
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    await repo.followers.toggle(carol["id"], alice["id"], 1700000000)
+    await repo.followers.toggle(alice["id"], bob["id"], 1700000000)
+    await repo.likes.toggle(bob["id"], first)
+    await repo.likes.toggle(carol["id"], first)
+
+    alice_row = await repo.users.get(alice["id"])
+    assert (alice_row["post_count"], alice_row["follower_count"], alice_row["following_count"]) == (2, 2, 1)
+    assert (await repo.users.get(bob["id"]))["following_count"] == 1
+    assert (await repo.posts.get(first, None))["like_count"] == 2
+
+    await repo.followers.toggle(carol["id"], alice["id"], 1700000000)
+    await repo.likes.toggle(carol["id"], first)
+    await repo.posts.delete(first, alice["id"])
+
+    alice_row = await repo.users.get(alice["id"])
+    assert (alice_row["post_count"], alice_row["follower_count"]) == (1, 1)
+    assert (await repo.users.get(carol["id"]))["following_count"] == 0
+
+async def test_keyset_paging(repo):
+    alice = await _user(repo, "alice")
+    bob = await _user(repo, "bob")
+    post_ids = [await repo.posts.create(alice["id"], f"post {n}", None, _image(n)) for n in range(5)]
+    for post_id in post_ids[:3]:
+        await repo.likes.toggle(bob["id"], post_id)
+    await repo.likes.toggle(alice["id"], post_ids[1])
+    newest_first = post_ids[::-1]
+
+    pages = await _walk(lambda key, limit: repo.posts.by_user(alice["id"], bob["id"], key, limit), ["created_at", "id"])
+    assert pages == [newest_first[0:2], newest_first[2:4], newest_first[4:]]
+
+    pages = await _walk(lambda key, limit: repo.posts.explore("latest", None, bob["id"], key, limit), repo.posts.EXPLORE_KEYS["latest"])
+    assert sum(pages, []) == newest_first
+
+    pages = await _walk(lambda key, limit: repo.posts.explore("popular", None, bob["id"], key, limit), repo.posts.EXPLORE_KEYS["popular"])
+    assert sum(pages, []) == [post_ids[1], post_ids[2], post_ids[0], post_ids[4], post_ids[3]]
+
+    pages = await _walk(lambda key, limit: repo.posts.explore("trending", None, bob["id"], key, limit), repo.posts.EXPLORE_KEYS["trending"])
+    assert sorted(sum(pages, [])) == post_ids
+
+    pages = await _walk(lambda key, limit: repo.likes.liked_posts(bob["id"], key, limit), ["liked_at", "id"])
+    assert sorted(sum(pages, [])) == post_ids[:3]
+
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+    pages = await _walk(lambda key, limit: repo.posts.feed(bob["id"], key, limit), ["created_at", "id"])
+    assert sum(pages, []) == newest_first
+
+async def test_post_search(repo):
+    alice = await _user(repo, "alice")
+    cat = await repo.posts.create(alice["id"], "a red cat on a mat", "sleepy", _image(1))
+    await repo.posts.create(alice["id"], "a blue dog", "barking", _image(2))
+    captioned = await repo.posts.create(alice["id"], "a garden", "the cat is hiding", _image(3))
+
+    rows = await repo.posts.search("cat", alice["id"], None, 10)
+    assert sorted(row["id"] for row in rows) == sorted([cat, captioned])
+    by_id = {row["id"]: row for row in rows}
+    assert f"{MATCH_START}cat{MATCH_END}" in by_id[cat]["prompt_snippet"]
+    assert f"{MATCH_START}cat{MATCH_END}" in by_id[captioned]["caption_snippet"]
+
+    pages = await _walk(lambda key, limit: repo.posts.search("cat", None, key, limit), ["relevance", "id"], limit=1)
+    assert sorted(sum(pages, [])) == sorted([cat, captioned])
+
+    assert await repo.posts.search("zebra", None, None, 10) == []
+    assert await repo.posts.search("   ", None, None, 10) == []
+
+    garden = await repo.posts.explore("latest", "garden", None, None, 10)
+    assert [row["id"] for row in garden] == [captioned]
+
+async def test_user_search(repo):
+    for name in ("ann", "annabel", "joanna", "bob"):
+        await _user(repo, name)
+
+    assert [user["username"] for user in await repo.users.search("ann", 10)] == ["ann", "annabel", "joanna"]
+    assert [user["username"] for user in await repo.users.search("ANNA", 10)] == ["annabel", "joanna"]
+    assert [user["username"] for user in await repo.users.search("b", 10)] == ["bob"]
+    assert await repo.users.search("zed", 10) == []
+
+async def test_timeline_fan_out_and_trim(repo):
+    alice = await _user(repo, "alice")
+    followers = [await _user(repo, f"follower{n}") for n in range(3)]
+    for follower in followers:
+        await repo.followers.toggle(follower["id"], alice["id"], 1700000000)
+    post_ids = [await repo.posts.create(alice["id"], f"post {n}", None, _image(n)) for n in range(3)]
+
+    follower_ids = [follower["id"] for follower in followers]
+    for post_id in post_ids:
+        reached, written = await repo.timelines.fan_out(post_id, 0, 2)
+        assert (reached, written) == (follower_ids[:2], 2)
+        reached, written = await repo.timelines.fan_out(post_id, reached[-1], 2)
+        assert (reached, written) == (follower_ids[2:], 1)
+        assert await repo.timelines.fan_out(post_id, reached[-1], 2) == ([], 0)
+
+    assert await repo.timelines.trim(follower_ids[:2], 1) == 4
+    for follower_id in follower_ids[:2]:
+        assert [row["id"] for row in await repo.posts.feed(follower_id, None, 10)] == [post_ids[-1]]
+    assert len(await repo.posts.feed(follower_ids[2], None, 10)) == 3
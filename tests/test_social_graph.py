@@ -0,0 +1,51 @@
+import pytest
+
+import repositories
+from social_graph import SocialGraph, followed_at, parse_key
+
+pytestmark = pytest.mark.anyio
+
+def test_follow_and_unfollow():
+    graph = SocialGraph()
+    graph.follow(1, 2, 100)
+    graph.follow(3, 2, 200)
+    graph.follow(2, 1, 300)
+
+    assert graph.is_following(1, 2) and graph.is_following(2, 1)
+    assert not graph.is_following(2, 3)
+    assert (graph.follower_count(2), graph.following_count(2)) == (2, 1)
+
+    graph.unfollow(1, 2)
+    assert not graph.is_following(1, 2)
+    assert graph.followers_page(2, None, 10) == [(3, 200)]
+    # Unfollowing twice changes nothing
+    graph.unfollow(1, 2)
+    assert graph.follower_count(2) == 1
+
+def test_pages_are_latest_first():
+    graph = SocialGraph()
+    for user_id, since in ((5, 100), (3, 300), (4, 200), (6, 300)):
+        graph.follow(user_id, 1, since)
+
+    first = graph.followers_page(1, None, 3)
+    assert first == [(6, 300), (3, 300), (4, 200)]
+    # Cursors carry the follow time as the API shows it
+    key = parse_key([followed_at(first[-1][1]), first[-1][0]])
+    assert graph.followers_page(1, key, 3) == [(5, 100)]
+
+async def test_load_and_check_follow_the_table(repo, monkeypatch):
+    monkeypatch.setattr(repositories, "repository", repo)
+    alice = await repo.users.create("alice", "alice@example.com", "hash")
+    bob = await repo.users.create("bob", "bob@example.com", "hash")
+    await repo.followers.toggle(bob["id"], alice["id"], 1700000000)
+
+    graph = SocialGraph()
+    await graph.load()
+    assert graph.is_following(bob["id"], alice["id"])
+    assert graph.followers_page(alice["id"], None, 10) == [(bob["id"], 1700000000)]
+
+    # A follow the graph was not told about is picked up by the check
+    await repo.followers.toggle(alice["id"], bob["id"], 1700000100)
+    assert await graph.check() == 1
+    assert graph.is_following(alice["id"], bob["id"])
+    assert await graph.check() == 0
@@ -0,0 +1,67 @@
+import base64
+
+import pytest
+
+import storage
+from storage import blob_store, delete_blobs, save_image
+
+pytestmark = pytest.mark.anyio
+
+def _image(n: int = 0) -> str:
+    return base64.b64encode(b"\x89PNG\r\n\x1a\n" + bytes([n]) * 32).decode()
+
+async def _user(repo, name: str) -> dict:
+    return await repo.users.create(name, f"{name}@example.com", "hash")
+
+async def test_same_bytes_are_stored_once(local_db):
+    first = await save_image(_image(1))
+    second = await save_image(_image(1))
+    assert first == second
+    assert first["image_mime"] == "image/png"
+    assert blob_store.read(first["image_hash"]) == base64.b64decode(_image(1))
+    assert len(list(blob_store.root.rglob("*"))) == 3  # two directory levels and the blob
+    assert (await save_image(_image(2)))["image_hash"] != first["image_hash"]
+
+async def test_deleted_post_releases_its_image(repo):
+    alice = await _user(repo, "alice")
+    image = await save_image(_image(1))
+    post_id = await repo.posts.create(alice["id"], "a cat", None, image)
+
+    orphaned = await repo.posts.delete(post_id, alice["id"])
+    assert orphaned == [image["image_hash"]]
+    await delete_blobs(orphaned, repo.posts.references_image, grace=0)
+    assert not blob_store.exists(image["image_hash"])
+
+async def test_shared_image_is_kept(repo):
+    alice = await _user(repo, "alice")
+    image = await save_image(_image(1))
+    first = await repo.posts.create(alice["id"], "a cat", None, image)
+    await repo.posts.create(alice["id"], "the same cat", None, await save_image(_image(1)))
+
+    assert await repo.posts.delete(first, alice["id"]) == []
+    assert blob_store.exists(image["image_hash"])
+
+async def test_recreated_image_survives_the_delete(repo):
+    alice = await _user(repo, "alice")
+    image = await save_image(_image(1))
+    post_id = await repo.posts.create(alice["id"], "a cat", None, image)
+    orphaned = await repo.posts.delete(post_id, alice["id"])
+
+    # The same bytes are posted again before the blob is deleted
+    post_id = await repo.posts.create(alice["id"], "a cat", None, await save_image(_image(1)))
+    assert await repo.posts.references_image(image["image_hash"])
+    await delete_blobs(orphaned, repo.posts.references_image, grace=0)
+    assert blob_store.exists(image["image_hash"])
+    assert (await repo.posts.get(post_id, None))["image_hash"] == image["image_hash"]
+
+async def test_recent_blob_waits_out_the_grace_period(repo):
+    alice = await _user(repo, "alice")
+    image = await save_image(_image(1))
+    post_id = await repo.posts.create(alice["id"], "a cat", None, image)
+    orphaned = await repo.posts.delete(post_id, alice["id"])
+
+    await delete_blobs(orphaned, repo.posts.references_image, grace=60)
+    assert blob_store.exists(image["image_hash"])
+    assert storage._pending
+    for task in list(storage._pending):
+        task.cancel()
@@ -0,0 +1,55 @@
+import sys
+
+import pytest
+
+import repositories
+import timelines
+
+pytestmark = pytest.mark.anyio
+
+def _image(n: int = 0) -> dict:
+    return {"image_hash": f"{n:064x}", "image_size": 100 + n, "image_mime": "image/jpeg"}
+
+@pytest.fixture
+def small_limits(repo, monkeypatch):
+    """Accounts with two followers count as large; fan_out() uses repo."""
+    monkeypatch.setattr(repositories, "repository", repo)
+    monkeypatch.setattr(timelines, "TIMELINE_FANOUT_MAX_FOLLOWERS", 2)
+    for name in ("repositories.sqlite", "repositories.postgres"):
+        if name in sys.modules:
+            monkeypatch.setattr(sys.modules[name], "TIMELINE_MERGE_FOLLOWERS", 1)
+    monkeypatch.setattr(timelines, "timeline_stats", dict.fromkeys(timelines.timeline_stats, 0))
+    return repo
+
+async def test_large_accounts_are_merged_on_read(small_limits):
+    repo = small_limits
+    large = await repo.users.create("large", "large@example.com", "hash")
+    small = await repo.users.create("small", "small@example.com", "hash")
+    bob = await repo.users.create("bob", "bob@example.com", "hash")
+    carol = await repo.users.create("carol", "carol@example.com", "hash")
+    for follower in (bob, carol):
+        await repo.followers.toggle(follower["id"], large["id"], 1700000000)
+    await repo.followers.toggle(bob["id"], small["id"], 1700000000)
+
+    large_post = await repo.posts.create(large["id"], "a large post", None, _image(1))
+    await timelines.fan_out(large_post, large["id"])
+    small_post = await repo.posts.create(small["id"], "a small post", None, _image(2))
+    await timelines.fan_out(small_post, small["id"])
+
+    # Only the small account's post was copied, to its one follower
+    assert timelines.timeline_stats["posts_merged_on_read"] == 1
+    assert timelines.timeline_stats["posts_fanned_out"] == 1
+    assert timelines.timeline_stats["entries_written"] == 1
+
+    # Yet both feeds read the same as if everything had been fanned out
+    assert [row["id"] for row in await repo.posts.feed(bob["id"], None, 10)] == [small_post, large_post]
+    assert [row["id"] for row in await repo.posts.feed(carol["id"], None, 10)] == [large_post]
+
+    # Paging through a merged feed keeps the order
+    first = await repo.posts.feed(bob["id"], None, 1)
+    rest = await repo.posts.feed(bob["id"], [first[0]["created_at"], first[0]["id"]], 10)
+    assert [row["id"] for row in first + rest] == [small_post, large_post]
+
+    # Unfollowing a merged account drops its posts straight away
+    await repo.followers.toggle(carol["id"], large["id"], 1700000000)
+    assert await repo.posts.feed(carol["id"], None, 10) == []
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from trending import TRENDING_HALF_LIFE_HOURS
+
+pytestmark = pytest.mark.anyio
+
+HALF_LIFE = TRENDING_HALF_LIFE_HOURS * 3600
+
+def _image(n: int = 0) -> dict:
+    return {"image_hash": f"{n:064x}", "image_size": 100 + n, "image_mime": "image/jpeg"}
+
+async def _trending_ids(repo) -> list:
+    return [row["post_id"] for row in await repo.posts.trending(10)]
+
+async def test_unlike_does_not_bring_back_a_pruned_post(repo):
+    alice = await repo.users.create("alice", "alice@example.com", "hash")
+    post_id = await repo.posts.create(alice["id"], "a cat", None, _image())
+    await repo.likes.toggle(alice["id"], post_id)
+    assert await _trending_ids(repo) == [post_id]
+
+    # Long enough later that its score falls below the cut-off
+    assert await repo.posts.rebase_trending(time.time() + 30 * HALF_LIFE) == 1
+    assert await _trending_ids(repo) == []
+
+    assert await repo.likes.toggle(alice["id"], post_id) == ("unliked", 0)
+    assert await _trending_ids(repo) == []
+
+async def _liked_posts(repo, likes: list) -> list:
+    """A post per entry of likes, liked by that many users."""
+    alice = await repo.users.create("alice", "alice@example.com", "hash")
+    fans = [await repo.users.create(f"fan{n}", f"fan{n}@example.com", "hash") for n in range(max(likes))]
+    post_ids = []
+    for n, count in enumerate(likes):
+        post_id = await repo.posts.create(alice["id"], f"post {n}", None, _image(n))
+        for fan in fans[:count]:
+            await repo.likes.toggle(fan["id"], post_id)
+        post_ids.append(post_id)
+    return post_ids
+
+async def test_rebase_keeps_the_ranking(repo):
+    post_ids = await _liked_posts(repo, [1, 3, 2])
+    before = await repo.posts.trending(10)
+    assert [row["post_id"] for row in before] == [post_ids[1], post_ids[2], post_ids[0]]
+
+    # One half-life later every score is worth half, relative to the new epoch
+    assert await repo.posts.rebase_trending(time.time() + HALF_LIFE) == 0
+    after = await repo.posts.trending(10)
+    assert [row["post_id"] for row in after] == [row["post_id"] for row in before]
+    for old, new in zip(before, after):
+        assert new["score"] == pytest.approx(old["score"] / 2, rel=1e-3)
+        assert new["engagement"] == old["engagement"]
+
+async def test_trending_cursor_survives_a_rebase(repo):
+    post_ids = await _liked_posts(repo, [0, 1, 2, 3])
+    key_fields = repo.posts.EXPLORE_KEYS["trending"]
+
+    first = await repo.posts.explore("trending", None, None, None, 2)
+    key = [first[-1][field] for field in key_fields]
+    await repo.posts.rebase_trending(time.time() + HALF_LIFE)
+    rest = await repo.posts.explore("trending", None, None, key, 10)
+
+    # The cursor from before the rebase neither skips nor repeats a post
+    assert [row["id"] for row in first + rest] == post_ids[::-1]
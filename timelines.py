@@ -0,0 +1,116 @@
+import asyncio
+import os
+from typing import List
+
+# Posts kept on each home timeline; timelines that grew are trimmed periodically
+TIMELINE_LENGTH = int(os.environ.get("TIMELINE_LENGTH", "800"))
+
+# Posts by accounts with this many followers are not copied to every
+# follower's timeline; feeds read them from the posts table instead
+TIMELINE_FANOUT_MAX_FOLLOWERS = int(os.environ.get("TIMELINE_FANOUT_MAX_FOLLOWERS", "10000"))
+
+# Feeds merge in accounts from half that size, so someone hovering around
+# the limit never has posts that were neither copied nor merged
+TIMELINE_MERGE_FOLLOWERS = TIMELINE_FANOUT_MAX_FOLLOWERS // 2
+
+# Followers given a new post per write, so other writes interleave
+FANOUT_BATCH_SIZE = 500
+
+# Recent posts of a newly followed account copied to the follower's timeline
+FOLLOW_BACKFILL_POSTS = 50
+
+# How often timelines that grew are trimmed to TIMELINE_LENGTH, 0 disables the job
+TIMELINE_TRIM_INTERVAL = float(os.environ.get("TIMELINE_TRIM_INTERVAL", "3600"))  # seconds
+
+# Users whose timelines are trimmed per write
+TRIM_BATCH_SIZE = 200
+
+# Exposed through /api/metrics
+timeline_stats = {"posts_fanned_out": 0, "posts_merged_on_read": 0, "entries_written": 0, "entries_trimmed": 0, "timelines_trimmed": 0}
+
+# Fan-out tasks still running
+_pending = set()
+
+# Users whose timelines gained entries in this worker since the last trim;
+# no other timeline can have grown past TIMELINE_LENGTH. Lost on restart,
+# which only leaves those timelines long until their next post arrives.
+_untrimmed = set()
+
+def mark_for_trim(user_id: int):
+    """Have the next trim look at a timeline that just gained entries."""
+    _untrimmed.add(user_id)
+
+async def fan_out(post_id: int, author_id: int):
+    """Copy a new post to the timelines of its author's followers, a batch per write."""
+    # Imported here because the repositories use the constants above
+    from repositories import repository
+
+    # The author's own timeline got the post when it was created
+    mark_for_trim(author_id)
+
+    author = await repository.users.get(author_id)
+    if author is None:
+        return
+    if author["follower_count"] >= TIMELINE_FANOUT_MAX_FOLLOWERS:
+        timeline_stats["posts_merged_on_read"] += 1
+        return
+
+    after = 0
+    while True:
+        user_ids, written = await repository.timelines.fan_out(post_id, after, FANOUT_BATCH_SIZE)
+        if not user_ids:
+            break
+        timeline_stats["entries_written"] += written
+        _untrimmed.update(user_ids)
+        after = user_ids[-1]
+    timeline_stats["posts_fanned_out"] += 1
+
+async def _fan_out_logged(post_id: int, author_id: int):
+    try:
+        await fan_out(post_id, author_id)
+    except Exception as e:
+        print(f"Timeline fan-out failed for post {post_id}: {str(e)}")
+
+def schedule_fanout(post_id: int, author_id: int):
+    """Fan a new post out in the background without delaying the response."""
+    task = asyncio.create_task(_fan_out_logged(post_id, author_id))
+    # Keep a reference so the task is not garbage collected while running
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+async def trim_timelines() -> int:
+    """
+    Cut the timelines that grew since the last run down to TIMELINE_LENGTH
+    entries; returns how many were removed.
+    """
+    from repositories import repository
+
+    user_ids: List[int] = sorted(_untrimmed)
+    _untrimmed.clear()
+
+    trimmed = 0
+    for start in range(0, len(user_ids), TRIM_BATCH_SIZE):
+        batch = user_ids[start:start + TRIM_BATCH_SIZE]
+        try:
+            trimmed += await repository.timelines.trim(batch, TIMELINE_LENGTH)
+        except Exception:
+            # Leave the rest for the next run
+            _untrimmed.update(user_ids[start:])
+            raise
+        timeline_stats["timelines_trimmed"] += len(batch)
+
+    timeline_stats["entries_trimmed"] += trimmed
+    if trimmed:
+        print(f"Trimmed {trimmed} timeline entries")
+    return trimmed
+
+async def trim_periodically(interval: float = TIMELINE_TRIM_INTERVAL):
+    """Run trim_timelines() every interval seconds."""
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await trim_timelines()
+        except Exception as e:
+            print(f"Timeline trim failed: {str(e)}")
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import time
+from typing import Optional, Tuple
+
+import aiosqlite
+
+# Hours after which a like (or a new post) counts half as much
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", "6"))
+
+# How often scores are re-decayed to the current time
+TRENDING_REBASE_INTERVAL = float(os.environ.get("TRENDING_REBASE_INTERVAL", "3600"))  # seconds
+
+# Engagement weights
+LIKE_WEIGHT = 1.0
+POST_WEIGHT = 1.0  # so a brand new post can show up before its first like
+
+# Posts whose decayed score falls below this drop out of the trending table
+TRENDING_MIN_SCORE = 0.001
+
+# Scores are stored relative to an epoch: an event at time t adds
+# weight * 2 ** ((t - epoch) / half_life). Newer events add exponentially
+# more, which is the same ranking as decaying every score continuously,
+# but an event only ever touches its own post. The rebase task moves the
+# epoch forward and scales all scores down so they stay in float range.
+
+def _half_life() -> float:
+    return TRENDING_HALF_LIFE_HOURS * 3600
+
+async def trending_state(db: aiosqlite.Connection) -> Tuple[float, float]:
+    """Current (epoch, half_life in seconds), read in the caller's transaction."""
+    cursor = await db.execute("SELECT epoch, half_life FROM trending_state WHERE id = 1")
+    row = await cursor.fetchone()
+    if row is None:
+        return time.time(), _half_life()
+    return row[0], row[1]
+
+def _weight(weight: float, at: float, epoch: float, half_life: float) -> float:
+    return weight * 2 ** ((at - epoch) / half_life)
+
+def decay(score: float, epoch: float, half_life: float, now: Optional[float] = None) -> float:
+    """Value of a stored score as of now."""
+    now = time.time() if now is None else now
+    return score * 2 ** ((epoch - now) / half_life)
+
+def rescale(score: float, from_epoch: float, to_epoch: float, half_life: float) -> float:
+    """Express a score stored relative to one epoch relative to another."""
+    return score * 2 ** ((from_epoch - to_epoch) / half_life)
+
+async def _add(db: aiosqlite.Connection, post_id: int, weight: float, at: float, engagement: int):
+    epoch, half_life = await trending_state(db)
+    score = _weight(weight, at, epoch, half_life)
+    await db.execute("""
+        INSERT INTO post_trending (post_id, score, engagement, updated_at)
+        VALUES (?, MAX(?, 0), MAX(?, 0), ?)
+        ON CONFLICT (post_id) DO UPDATE SET
+            score = MAX(score + ?, 0),
+            engagement = MAX(engagement + ?, 0),
+            updated_at = excluded.updated_at
+    """, (post_id, score, engagement, time.time(), score, engagement))
+
+async def record_post(db: aiosqlite.Connection, post_id: int):
+    """Give a new post its initial score. Runs inside a write."""
+    await _add(db, post_id, POST_WEIGHT, time.time(), 0)
+
+async def record_like(db: aiosqlite.Connection, post_id: int, liked_at: float):
+    """Add a like made at liked_at to a post's score. Runs inside a write."""
+    await _add(db, post_id, LIKE_WEIGHT, liked_at, 1)
+
+async def record_unlike(db: aiosqlite.Connection, post_id: int, liked_at: float):
+    """
+    Take back what a like added when it was made. Runs inside a write.
+
+    A post that dropped out of the table stays out rather than coming
+    back with a score of 0.
+    """
+    epoch, half_life = await trending_state(db)
+    await db.execute("""
+        UPDATE post_trending
+        SET score = MAX(score - ?, 0), engagement = MAX(engagement - 1, 0), updated_at = ?
+        WHERE post_id = ?
+    """, (_weight(LIKE_WEIGHT, liked_at, epoch, half_life), time.time(), post_id))
+
+async def rebase_scores(db: aiosqlite.Connection, now: float) -> int:
+    """Move the epoch to now and scale all scores to match. Runs inside a write."""
+    epoch, half_life = await trending_state(db)
+    await db.execute("UPDATE post_trending SET score = score * ?", (rescale(1.0, epoch, now, half_life),))
+    await db.execute("UPDATE trending_state SET epoch = ? WHERE id = 1", (now,))
+    cursor = await db.execute("DELETE FROM post_trending WHERE score < ?", (TRENDING_MIN_SCORE,))
+    return cursor.rowcount
+
+async def rebuild_scores(db: aiosqlite.Connection, half_life: float) -> int:
+    """Recompute every score from the posts and likes tables. Runs inside a write."""
+    now = time.time()
+    scores = {}
+    engagement = {}
+
+    cursor = await db.execute("SELECT id, CAST(strftime('%s', created_at) AS INTEGER) FROM posts")
+    for post_id, created in await cursor.fetchall():
+        scores[post_id] = _weight(POST_WEIGHT, created, now, half_life)
+        engagement[post_id] = 0
+
+    cursor = await db.execute("SELECT post_id, CAST(strftime('%s', created_at) AS INTEGER) FROM likes")
+    for post_id, liked in await cursor.fetchall():
+        if post_id in scores:
+            scores[post_id] += _weight(LIKE_WEIGHT, liked, now, half_life)
+            engagement[post_id] += 1
+
+    await db.execute("DELETE FROM post_trending")
+    await db.executemany(
+        "INSERT INTO post_trending (post_id, score, engagement, updated_at) VALUES (?, ?, ?, ?)",
+        [(post_id, score, engagement[post_id], now) for post_id, score in scores.items() if score >= TRENDING_MIN_SCORE]
+    )
+    await db.execute("""
+        INSERT INTO trending_state (id, epoch, half_life) VALUES (1, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET epoch = excluded.epoch, half_life = excluded.half_life
+    """, (now, half_life))
+    return len(scores)
+
+async def ensure_scores():
+    """
+    Bring the trending table up to date before requests are served.
+
+    Rebuilds it on first start or after the half-life changed, otherwise
+    rebases it to the current time: new events add 2 ** (elapsed / half_life),
+    which after a long downtime would overflow before the periodic rebase
+    gets to run.
+    """
+    # Imported here because the SQLite repository uses the helpers above
+    from repositories import repository
+
+    scored = await repository.posts.rebuild_trending(_half_life())
+    if scored is not None:
+        print(f"Rebuilt trending scores for {scored} posts")
+        return
+
+    pruned = await repository.posts.rebase_trending(time.time())
+    if pruned:
+        print(f"Dropped {pruned} posts from trending")
+
+async def rebase_periodically(interval: float = TRENDING_REBASE_INTERVAL):
+    """Re-decay all scores to the current time every interval seconds."""
+    from repositories import repository
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            pruned = await repository.posts.rebase_trending(time.time())
+            if pruned:
+                print(f"Dropped {pruned} posts from trending")
+        except Exception as e:
+            print(f"Trending rebase failed: {str(e)}")
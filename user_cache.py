@@ -0,0 +1,118 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from repositories import repository
+
+# User rows kept per worker, 0 disables the cache
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
+# How long a row is served before it is read again; bounds how stale a row
+# changed through another worker can be
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "60"))  # seconds
+
+class UserCache:
+    """
+    Recently used user rows, keyed by id with a username index.
+
+    Rows are only trusted for what auth needs: identity, email, bio and
+    password hash, which change through update_user. The follower and
+    post counters on a cached row may lag; profiles read them elsewhere.
+    """
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # user id -> (expiry on the monotonic clock, row), least recently used first
+        self._rows: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+        self._ids: Dict[str, int] = {}
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and self.ttl > 0
+
+    def _drop(self, user_id: int) -> bool:
+        entry = self._rows.pop(user_id, None)
+        if entry is None:
+            return False
+        username = entry[1]["username"]
+        if self._ids.get(username) == user_id:
+            del self._ids[username]
+        return True
+
+    def _lookup(self, user_id: Optional[int]) -> Optional[dict]:
+        entry = self._rows.get(user_id) if user_id is not None else None
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+
+        expires, row = entry
+        if expires <= time.monotonic():
+            self._drop(user_id)
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return None
+
+        self._rows.move_to_end(user_id)
+        self._stats["hits"] += 1
+        # Callers may add fields to the dict they get
+        return dict(row)
+
+    def put(self, row: dict):
+        """Cache a row just read from or written to the database."""
+        if not self.enabled:
+            return
+        self._drop(row["id"])
+        self._rows[row["id"]] = (time.monotonic() + self.ttl, dict(row))
+        self._ids[row["username"]] = row["id"]
+
+        while len(self._rows) > self.size:
+            user_id, _ = next(iter(self._rows.items()))
+            self._drop(user_id)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, user_id: Optional[int] = None, username: Optional[str] = None):
+        """Forget a user, by id or username, after their row changed."""
+        if user_id is None and username is not None:
+            user_id = self._ids.get(username)
+        if user_id is not None and self._drop(user_id):
+            self._stats["invalidations"] += 1
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        """A user row by id, from the cache or the repository."""
+        if self.enabled:
+            row = self._lookup(user_id)
+            if row is not None:
+                return row
+
+        row = await repository.users.get(user_id)
+        if row is not None:
+            self.put(row)
+        return row
+
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        """A user row by username, from the cache or the repository."""
+        if self.enabled:
+            row = self._lookup(self._ids.get(username))
+            if row is not None:
+                return row
+
+        row = await repository.users.get_by_username(username)
+        if row is not None:
+            self.put(row)
+        return row
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._rows),
+            "size": self.size,
+            "ttl": self.ttl,
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+user_cache = UserCache()